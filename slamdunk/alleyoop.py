@@ -35,8 +35,10 @@ from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, SUPPRESS
 from os.path import basename
 
 from joblib import Parallel, delayed
-from dunks import deduplicator, stats, dump, tcounter
+from dunks import deduplicator, stats, dump, tcounter, qc
+from slamseq import SlamSeqFile
 from utils.misc import replaceExtension, estimateMaxReadLength
+from utils import ReferenceProvider
 from version import __version__
 
 ########################################################################
@@ -83,14 +85,29 @@ def createDir(directory):
         message("Creating output directory: " + directory)
         os.makedirs(directory)
             
-def runDedup(tid, bam, outputDirectory, tcMutations) :
+def runSamples(function, bams, n, *args):
+    # With at least as many samples as threads, samples run in parallel.
+    # Otherwise one after the other, each with n threads for chromosome shards
+    if(len(bams) >= n):
+        return Parallel(n_jobs=n, verbose=verbose)(delayed(function)(tid, bams[tid], *args) for tid in range(0, len(bams)))
+    return [ function(tid, bams[tid], *args, threads=n) for tid in range(0, len(bams)) ]
+            
+def runDedup(tid, bam, outputDirectory, tcMutations, compressionLevel = None, threads = 1) :
     outputBAM = os.path.join(outputDirectory, replaceExtension(basename(bam), ".bam", "_dedup"))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(bam), ".log", "_dedup"))
     log = getLogFile(outputLOG)
-    deduplicator.Dedup(bam, outputBAM, tcMutations, log)
+    deduplicator.Dedup(bam, outputBAM, tcMutations, log, threads=threads, compressionLevel=compressionLevel)
     closeLogFile(log)
     stepFinished()
     
+def runIndex(tid, bam) :
+    SlamSeqFile.writeSidecar(bam)
+    stepFinished()
+    
+def runPackReference(referenceFile) :
+    ReferenceProvider.writePackedReference(referenceFile)
+    stepFinished()
+    
 def runCollapse(tid, tcount, outputDirectory) :
     outputTCOUNT = os.path.join(outputDirectory, replaceExtension(basename(tcount), ".csv", "_collapsed"))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(tcount), ".log", "_collapsed"))
@@ -112,7 +129,7 @@ def runHalfLifes(bams, timepoints, outputDirectory) :
     closeLogFile(log)
     stepFinished()
     
-def runPositionalRates(tid, bam, ref, minQual, conversionThreshold, coverageCutoff, outputDirectory, snpDirectory) :
+def runPositionalRates(tid, bam, ref, minQual, conversionThreshold, coverageCutoff, outputDirectory, snpDirectory, bigWig = False, threads = 1) :
     outputBedGraphPrefix = os.path.join(outputDirectory, replaceExtension(basename(bam), "", "_positional_rates"))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(bam), ".log", "_positional_rates"))
     if(snpDirectory != None):
@@ -122,10 +139,10 @@ def runPositionalRates(tid, bam, ref, minQual, conversionThreshold, coverageCuto
     
     log = getLogFile(outputLOG)
         
-    tcounter.genomewideConversionRates(ref, inputSNP, bam, minQual, outputBedGraphPrefix, conversionThreshold, coverageCutoff, log)
+    tcounter.genomewideConversionRates(ref, inputSNP, bam, minQual, outputBedGraphPrefix, conversionThreshold, coverageCutoff, log, bigWig=bigWig, threads=threads)
     stepFinished()
     
-def runReadSeparator(tid, bam, ref, minQual, conversionThreshold, outputDirectory, snpDirectory) :
+def runReadSeparator(tid, bam, ref, minQual, conversionThreshold, outputDirectory, snpDirectory, threads = 1) :
     outputBAM = os.path.join(outputDirectory, replaceExtension(basename(bam), "", ""))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(bam), ".log", "_read_separator"))
     if(snpDirectory != None):
@@ -135,24 +152,24 @@ def runReadSeparator(tid, bam, ref, minQual, conversionThreshold, outputDirector
     
     log = getLogFile(outputLOG)
         
-    tcounter.genomewideReadSeparation(ref, inputSNP, bam, minQual, outputBAM, conversionThreshold, log)
+    tcounter.genomewideReadSeparation(ref, inputSNP, bam, minQual, outputBAM, conversionThreshold, log, threads)
     stepFinished()
     
-def runStatsRates(tid, bam, referenceFile, minMQ, outputDirectory) :
+def runStatsRates(tid, bam, referenceFile, minMQ, outputDirectory, threads = 1) :
     outputCSV = os.path.join(outputDirectory, replaceExtension(basename(bam), ".csv", "_overallrates"))
     outputPDF = os.path.join(outputDirectory, replaceExtension(basename(bam), ".pdf", "_overallrates"))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(bam), ".log", "_overallrates"))
     log = getLogFile(outputLOG)
-    stats.statsComputeOverallRates(referenceFile, bam, minMQ, outputCSV, outputPDF, log)
+    stats.statsComputeOverallRates(referenceFile, bam, minMQ, outputCSV, outputPDF, log, threads=threads)
     closeLogFile(log)
     stepFinished()
     
-def runStatsTCContext(tid, bam, referenceFile, minMQ, outputDirectory) :
+def runStatsTCContext(tid, bam, referenceFile, minMQ, outputDirectory, threads = 1) :
     outputCSV = os.path.join(outputDirectory, replaceExtension(basename(bam), ".csv", "_tccontext"))
     outputPDF = os.path.join(outputDirectory, replaceExtension(basename(bam), ".pdf", "_tccontext"))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(bam), ".log", "_tccontext"))
     log = getLogFile(outputLOG)
-    stats.statsComputeTCContext(referenceFile, bam, minMQ, outputCSV, outputPDF, log)
+    stats.statsComputeTCContext(referenceFile, bam, minMQ, outputCSV, outputPDF, log, threads=threads)
     closeLogFile(log)
     stepFinished()
 
@@ -201,7 +218,7 @@ def runSNPeval(tid, bam, ref, bed, maxLength, minQual, coverageCutoff, variantFr
     stepFinished()
 
     
-def runTcPerReadPos(tid, bam, referenceFile, minMQ, maxReadLength, outputDirectory, snpDirectory):
+def runTcPerReadPos(tid, bam, referenceFile, minMQ, maxReadLength, outputDirectory, snpDirectory, threads = 1):
     outputCSV = os.path.join(outputDirectory, replaceExtension(basename(bam), ".csv", "_tcperreadpos"))
     outputPDF = os.path.join(outputDirectory, replaceExtension(basename(bam), ".pdf", "_tcperreadpos"))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(bam), ".log", "_tcperreadpos"))
@@ -220,7 +237,7 @@ def runTcPerReadPos(tid, bam, referenceFile, minMQ, maxReadLength, outputDirecto
     
     print("Using " + str(maxReadLength) + " as maximum read length.",file=log)
     
-    stats.tcPerReadPos(referenceFile, bam, minMQ, maxReadLength, outputCSV, outputPDF, inputSNP, log)
+    stats.tcPerReadPos(referenceFile, bam, minMQ, maxReadLength, outputCSV, outputPDF, inputSNP, log, threads=threads)
     
     closeLogFile(log)
     stepFinished()
@@ -249,7 +266,41 @@ def runTcPerUtr(tid, bam, referenceFile, bed, minMQ, maxReadLength, outputDirect
     closeLogFile(log)
     stepFinished()
     
-def runDumpReadInfo(tid, bam, referenceFile, minMQ, outputDirectory, snpDirectory):
+# Output file suffixes of the qc metrics (same as for the single commands)
+qcSuffixes = {
+    "rates" : "_overallrates",
+    "tccontext" : "_tccontext",
+    "tcperreadpos" : "_tcperreadpos",
+    "tcperutrpos" : "_tcperutr",
+    "utrrates" : "_mutationrates_utr"
+}
+
+def runQC(tid, bam, referenceFile, minMQ, strictTCs, maxReadLength, metrics, outputDirectory, snpDirectory, utrFile, threads = 1):
+    outputLOG = os.path.join(outputDirectory, replaceExtension(basename(bam), ".log", "_qc"))
+    outputFiles = {}
+    for metric in metrics:
+        outputFiles[metric] = (os.path.join(outputDirectory, replaceExtension(basename(bam), ".csv", qcSuffixes[metric])), os.path.join(outputDirectory, replaceExtension(basename(bam), ".pdf", qcSuffixes[metric])))
+    if(snpDirectory != None):
+        inputSNP = os.path.join(snpDirectory, replaceExtension(basename(bam), ".vcf", "_snp"))
+    else:
+        inputSNP = None
+    
+    log = getLogFile(outputLOG)
+    
+    if ("tcperreadpos" in metrics or "tcperutrpos" in metrics or "utrrates" in metrics) :
+        if (maxReadLength == None) :
+            maxReadLength = estimateMaxReadLength(bam)
+        if (maxReadLength < 0) :
+            print("Could not reliable estimate maximum read length. Please specify --max-read-length parameter.")
+            sys.exit(0)
+        print("Using " + str(maxReadLength) + " as maximum read length.",file=log)
+    
+    qc.computeQC(referenceFile, bam, outputFiles, minMQ, maxReadLength, inputSNP, utrFile, strictTCs, log, threads=threads)
+    
+    closeLogFile(log)
+    stepFinished()
+    
+def runDumpReadInfo(tid, bam, referenceFile, minMQ, outputDirectory, snpDirectory, threads = 1):
     outputCSV = os.path.join(outputDirectory, replaceExtension(basename(bam), ".sdunk", "_readinfo"))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(bam), ".log", "_readinfo"))
     if(snpDirectory != None):
@@ -258,7 +309,7 @@ def runDumpReadInfo(tid, bam, referenceFile, minMQ, outputDirectory, snpDirector
         inputSNP = None
     log = getLogFile(outputLOG)
     
-    dump.dumpReadInfo(referenceFile, bam, minMQ, outputCSV, inputSNP, log)
+    dump.dumpReadInfo(referenceFile, bam, minMQ, outputCSV, inputSNP, log, threads=threads)
     
     closeLogFile(log)
     stepFinished()
@@ -285,8 +336,18 @@ def run():
     dedupparser.add_argument("-o", "--outputDir", type=str, required=True, dest="outputDir", default=SUPPRESS, help="Output directory for mapped BAM files.")
     dedupparser.add_argument("-tc", "--tcMutations", type=int, required=False, default = 0, dest="tcMutations", help="Only select reads with x number of T>C mutations.")
     dedupparser.add_argument("-t", "--threads", type=int, required=False, default=1, dest="threads", help="Thread number")
+    dedupparser.add_argument("--compression-level", type=int, required=False, dest="compressionLevel", choices=range(0, 10), help="BGZF compression level of deduplicated BAM files, e.g. 1 for fast intermediate files (default: htslib default)")
     dedupparser.add_argument('bam', action='store', help='Bam file(s)' , nargs="+")
     
+    # index command
+    indexparser = subparsers.add_parser('index', help='Write decoded reads of filtered BAM files to a sidecar used by count, rates, tcperreadpos and positional-tracks', formatter_class=ArgumentDefaultsHelpFormatter)
+    indexparser.add_argument('bam', action='store', help='Bam file(s)' , nargs="+")
+    indexparser.add_argument("-t", "--threads", type=int, required=False, default=1, dest="threads", help="Thread number")
+    
+    # packref command
+    packrefparser = subparsers.add_parser('packref', help='Write a 2-bit packed, memory-mapped copy of the reference shared by all processes', formatter_class=ArgumentDefaultsHelpFormatter)
+    packrefparser.add_argument("-r", "--reference", type=str, required=True, dest="referenceFile", help="Reference fasta file")
+    
     # collapse command
     collapseparser = subparsers.add_parser('collapse', help='Collapse UTRs', formatter_class=ArgumentDefaultsHelpFormatter)
     collapseparser.add_argument("-o", "--outputDir", type=str, required=True, dest="outputDir", default=SUPPRESS, help="Output directory for mapped BAM files.")
@@ -303,6 +364,7 @@ def run():
     posratesparser.add_argument("-a", "--coverage-cutoff", type=int, dest="coverageCutoff", required=False, default=1,help="Minimum coverage required to report nucleotide-conversion rate (default: %(default)d). Anything less than 1 will be set to 1 to avoid division by zero.")
     posratesparser.add_argument("-q", "--min-base-qual", type=int, default=27, required=False, dest="minQual", help="Min base quality for T -> C conversions (default: %(default)d)")
     posratesparser.add_argument("-t", "--threads", type=int, required=False, default=1, dest="threads", help="Thread number (default: %(default)d)")
+    posratesparser.add_argument("-w", "--bigwig", action='store_true', dest="bigWig", help="Also write tracks as bigWig files (requires pyBigWig)")
     
     # TC read separator
     readseparatorparser = subparsers.add_parser('read-separator', help='Separate TC-reads from background reads genome-wide', formatter_class=ArgumentDefaultsHelpFormatter)
@@ -392,6 +454,19 @@ def run():
     utrRateParser.add_argument("-mq", "--min-basequality", type=int, required=False, default=27, dest="mq", help="Minimal base quality for SNPs (default: %(default)s)")
     utrRateParser.add_argument("-t", "--threads", type=int, required=False, dest="threads", default=1, help="Thread number (default: %(default)s)")
     
+    # qc command
+    qcparser = subparsers.add_parser('qc', help='Calculate rates, tccontext, tcperreadpos, tcperutrpos and utrrates in a single pass over SLAM-seq datasets', formatter_class=ArgumentDefaultsHelpFormatter)
+    qcparser.add_argument('bam', action='store', help='Bam file(s)' , nargs="+")
+    qcparser.add_argument("-o", "--outputDir", type=str, required=True, dest="outputDir", default=SUPPRESS, help="Output directory for mapped BAM files.")
+    qcparser.add_argument("-r", "--reference", type=str, required=True, dest="referenceFile", default=SUPPRESS, help="Reference fasta file")
+    qcparser.add_argument("-b", "--bed", type=str, required=False, dest="bed", help="BED file (required for tcperutrpos and utrrates)")
+    qcparser.add_argument("-s", "--snp-directory", type=str, required=False, dest="snpDir", help="Directory containing SNP files.")
+    qcparser.add_argument("-l", "--max-read-length", type=int, required=False, dest="maxLength", help="Max read length in BAM file")
+    qcparser.add_argument("-mq", "--min-basequality", type=int, required=False, default=27, dest="mq", help="Minimal base quality for SNPs")
+    qcparser.add_argument("-m", "--multiTCStringency", dest="strictTCs", action='store_true', required=False, help="")
+    qcparser.add_argument("--metrics", type=str, required=False, dest="metrics", nargs="+", choices=qc.qcMetrics, help="Metrics to compute (default: all, tcperutrpos and utrrates only with a BED file)")
+    qcparser.add_argument("-t", "--threads", type=int, required=False, dest="threads", default=1, help="Thread number")
+    
     # dump read info command
     dumpReadInfo = subparsers.add_parser('dump', help='Print all info available for slamdunk reads', formatter_class=ArgumentDefaultsHelpFormatter)
     dumpReadInfo.add_argument('bam', action='store', help='Bam file(s)' , nargs="+")
@@ -401,6 +476,10 @@ def run():
     dumpReadInfo.add_argument("-mq", "--min-basequality", type=int, required=False, default=0, dest="mq", help="Minimal base quality for SNPs")
     dumpReadInfo.add_argument("-t", "--threads", type=int, required=False, dest="threads", default=1, help="Thread number")
     
+    # Tools reading the reference
+    for referenceParser in [ posratesparser, readseparatorparser, statsparser, tccontextparser, statsutrrateparser, snpevalparser, conversionRateParser, utrRateParser, qcparser, dumpReadInfo ] :
+        referenceParser.add_argument("--reference-cache", type=int, required=False, default=ReferenceProvider.DefaultCacheSize, dest="referenceCache", help="Memory (MB) for caching reference chromosomes, split between all threads. Not used for references packed with packref")
+    
     args = parser.parse_args()
     
     ########################################################################
@@ -409,13 +488,27 @@ def run():
     
     command = args.command
 
+    if ("referenceCache" in args) :
+        ReferenceProvider.setCacheSize(args.referenceCache, args.threads)
+
     if (command == "dedup") :
         outputDirectory = args.outputDir
         createDir(outputDirectory)
         n = args.threads
         tcMutations = args.tcMutations
         message("Running alleyoop dedup for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runDedup)(tid, args.bam[tid], outputDirectory, tcMutations) for tid in range(0, len(args.bam)))
+        results = runSamples(runDedup, args.bam, n, outputDirectory, tcMutations, args.compressionLevel)
+        dunkFinished()
+        
+    elif (command == "index") :
+        n = args.threads
+        message("Running alleyoop index for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
+        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runIndex)(tid, args.bam[tid]) for tid in range(0, len(args.bam)))
+        dunkFinished()
+        
+    elif (command == "packref") :
+        message("Running alleyoop packref for " + args.referenceFile)
+        runPackReference(args.referenceFile)
         dunkFinished()
         
     elif (command == "collapse") :
@@ -432,7 +525,7 @@ def run():
         snpDirectory = args.snpDir
         n = args.threads
         message("Running alleyoop positional-tracks for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runPositionalRates)(tid, args.bam[tid], args.ref, args.minQual, args.conversionThreshold, args.coverageCutoff, outputDirectory, snpDirectory) for tid in range(0, len(args.bam)))
+        results = runSamples(runPositionalRates, args.bam, n, args.ref, args.minQual, args.conversionThreshold, args.coverageCutoff, outputDirectory, snpDirectory, args.bigWig)
         dunkFinished()
         
     elif (command == "read-separator") :
@@ -441,7 +534,7 @@ def run():
         snpDirectory = args.snpDir
         n = args.threads
         message("Running alleyoop read-separator for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runReadSeparator)(tid, args.bam[tid], args.ref, args.minQual, args.conversionThreshold, outputDirectory, snpDirectory) for tid in range(0, len(args.bam)))
+        results = runSamples(runReadSeparator, args.bam, n, args.ref, args.minQual, args.conversionThreshold, outputDirectory, snpDirectory)
         dunkFinished()       
         
     elif (command == "half-lifes") :
@@ -462,7 +555,7 @@ def run():
         referenceFile = args.referenceFile
         minMQ = args.mq
         message("Running alleyoop rates for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runStatsRates)(tid, args.bam[tid], referenceFile, minMQ, outputDirectory) for tid in range(0, len(args.bam)))
+        results = runSamples(runStatsRates, args.bam, n, referenceFile, minMQ, outputDirectory)
         dunkFinished()
         
     elif (command == "snpeval") :
@@ -481,7 +574,7 @@ def run():
         referenceFile = args.referenceFile
         minMQ = args.mq
         message("Running alleyoop TC context for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runStatsTCContext)(tid, args.bam[tid], referenceFile, minMQ, outputDirectory) for tid in range(0, len(args.bam)))
+        results = runSamples(runStatsTCContext, args.bam, n, referenceFile, minMQ, outputDirectory)
         dunkFinished()
     
     elif (command == "utrrates") :  
@@ -514,7 +607,7 @@ def run():
         referenceFile = args.referenceFile
         minMQ = args.mq
         message("Running alleyoop tcperreadpos for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runTcPerReadPos)(tid, args.bam[tid], referenceFile, minMQ, args.maxLength, outputDirectory, snpDirectory) for tid in range(0, len(args.bam)))
+        results = runSamples(runTcPerReadPos, args.bam, n, referenceFile, minMQ, args.maxLength, outputDirectory, snpDirectory)
         dunkFinished()
         
     elif (command == "tcperutrpos") :
@@ -529,6 +622,19 @@ def run():
         results = Parallel(n_jobs=n, verbose=verbose)(delayed(runTcPerUtr)(tid, args.bam[tid], referenceFile, args.bed, minMQ, args.maxLength, outputDirectory, snpDirectory) for tid in range(0, len(args.bam)))
         dunkFinished()
     
+    elif (command == "qc") :
+        outputDirectory = args.outputDir
+        createDir(outputDirectory)
+        n = args.threads
+        metrics = args.metrics
+        if (metrics == None) :
+            metrics = [ metric for metric in qc.qcMetrics if args.bed != None or metric not in qc.utrMetrics ]
+        elif (args.bed == None and len(set(metrics) & set(qc.utrMetrics)) > 0) :
+            parser.error("tcperutrpos and utrrates require a BED file (-b).")
+        message("Running alleyoop qc (" + ", ".join(metrics) + ") for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
+        results = runSamples(runQC, args.bam, n, args.referenceFile, args.mq, args.strictTCs, args.maxLength, metrics, outputDirectory, args.snpDir, args.bed)
+        dunkFinished()
+    
     elif (command == "dump") :
         outputDirectory = args.outputDir
         createDir(outputDirectory)
@@ -537,7 +643,7 @@ def run():
         referenceFile = args.referenceFile
         minMQ = args.mq
         message("Running alleyoop dump for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runDumpReadInfo)(tid, args.bam[tid], referenceFile, minMQ, outputDirectory, snpDirectory) for tid in range(0, len(args.bam)))
+        results = runSamples(runDumpReadInfo, args.bam, n, referenceFile, minMQ, outputDirectory, snpDirectory)
         dunkFinished()
     
     else:
@@ -18,77 +18,96 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function
-import pysam
 
-from slamdunk.utils.misc import checkStep, pysamIndex  # @UnresolvedImport
+from slamdunk.utils.misc import checkStep, finishStep, pysamIndex, openBam  # @UnresolvedImport
+from slamdunk.utils.ShardedExecutor import runSharded, getFragmentFile, concatenateBamFragments  # @UnresolvedImport
 
-def Dedup(inputBAM, outputBAM, tcMutations, log, printOnly=False, verbose = True, force=False):
+def dedupReads(reads, outfile, tcMutations):
     
-    if(printOnly or checkStep([inputBAM], [outputBAM], force)):
-        
-        samfile = pysam.AlignmentFile(inputBAM, "rb")
-        outfile = pysam.AlignmentFile(outputBAM, "wb", template=samfile)
-        
-        processedReads = 0
-        retainedReads = 0
-
-        prevChr = ""
-        prevStart = ""
+    # Reads of one chromosome (sorted by start). All but the first read with the same
+    # strand, start, CIGAR and sequence are marked as duplicates. Reads are written
+    # immediately, only hashes of the keys at the current start position are kept
+    processedReads = 0
+    retainedReads = 0
+    
+    prevStart = None
+    
+    duplicateKeys = set()
+    
+    for read in reads:
         
-        duplicateBuffer = {}
+        if (read.has_tag("TC")) :
+            tcflag = read.get_tag("TC")
+        else :
+            tcflag = 0
         
-        for read in samfile:
+        if (tcflag >= tcMutations) :
             
-            flag = read.cigarstring
-            chr = read.reference_id
             start = read.reference_start
-            seq = read.query_sequence
-            if (read.has_tag("TC")) :
-                tcflag = read.get_tag("TC")
-            else :
-                tcflag = 0
-            
-            if (tcflag >= tcMutations) :
-                
-                if (chr != prevChr or start != prevStart) :
-                                
-                    if (prevChr != "") :
-                        for curSeq in duplicateBuffer :
-                            for curFlag in duplicateBuffer[curSeq]:
-                                for readEntry in duplicateBuffer[curSeq][curFlag]:
-                                    if not readEntry.is_duplicate:
-                                       retainedReads += 1 
-                                    outfile.write(readEntry)
-                        duplicateBuffer.clear()
-                
-                if not seq in duplicateBuffer:
-                    duplicateBuffer[seq] = {}
-                if not flag in duplicateBuffer[seq]:
-                    duplicateBuffer[seq][flag] = list()
-                if len(duplicateBuffer[seq][flag]) > 0 :
-                    read.is_duplicate = True
-                duplicateBuffer[seq][flag].append(read)
-                 
-                prevChr = chr
+            if (start != prevStart) :
+                duplicateKeys.clear()
                 prevStart = start
             
-                processedReads += 1
+            key = hash((read.is_reverse, start, read.cigarstring, read.query_sequence))
+            if key in duplicateKeys :
+                read.is_duplicate = True
+            else :
+                duplicateKeys.add(key)
             
-        for seq in duplicateBuffer:
-            for flag in duplicateBuffer[seq] :
-                for readEntry in duplicateBuffer[seq][flag]:
-                    if not readEntry.is_duplicate:
-                        retainedReads += 1 
-                    outfile.write(readEntry)
-        duplicateBuffer.clear()
+            if not read.is_duplicate:
+                retainedReads += 1
+            outfile.write(read)
+        
+            processedReads += 1
+    
+    return processedReads, retainedReads
+
+def dedupShard(chromosomes, inputBAM, outputBAM, tcMutations, compressionLevel):
+    
+    # Deduplicates the reads of chromosomes ("*": unmapped reads) into a BAM
+    # fragment (see runSharded). Returns the fragment and the read counts
+    samfile = openBam(inputBAM, "rb")
+    fragmentFile = getFragmentFile(outputBAM, ".bam")
+    outfile = openBam(fragmentFile, "wb", 1, compressionLevel, template=samfile)
+    
+    processedReads = 0
+    retainedReads = 0
+    for chromosome in chromosomes:
+        processed, retained = dedupReads(samfile.fetch(contig=chromosome), outfile, tcMutations)
+        processedReads += processed
+        retainedReads += retained
+    
+    outfile.close()
+    samfile.close()
+    
+    return fragmentFile, processedReads, retainedReads
+
+def Dedup(inputBAM, outputBAM, tcMutations, log, printOnly=False, verbose = True, force=False, threads = 1, compressionLevel = None):
+    
+    if(printOnly or checkStep([inputBAM], [outputBAM], force, [tcMutations])):
+        
+        samfile = openBam(inputBAM, "rb")
+        if(not samfile.has_index()):
+            pysamIndex(inputBAM)
+        # Chromosomes in BAM order, unmapped reads at the end
+        chromosomes = list(samfile.references) + [ "*" ]
+        samfile.close()
+        
+        # Chromosome shards are deduplicated into BAM fragments in threads
+        # processes and concatenated without recompression
+        _, results = runSharded(dedupShard, inputBAM, chromosomes, threads, inputBAM, outputBAM, tcMutations, compressionLevel)
+        
+        concatenateBamFragments(outputBAM, [ fragmentFile for fragmentFile, _, _ in results ])
         
-        outfile.close()
+        processedReads = sum([ processed for _, processed, _ in results ])
+        retainedReads = sum([ retained for _, _, retained in results ])
                 
         print("Retained " + str(retainedReads) + " of " + str(processedReads) + " reads (", file=log, end = "")
         print("{0:.2f}".format(float(retainedReads) / float(processedReads)),file=log,end="")
         print(" compression rate)", file=log)
         
         pysamIndex(outputBAM)
+        finishStep([outputBAM])
         
     else:
-        print("Skipped deduplication for " + inputBAM, file=log)
\ No newline at end of file
+        print("Skipped deduplication for " + inputBAM, file=log)
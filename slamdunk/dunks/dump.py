@@ -19,30 +19,43 @@
 
 from __future__ import print_function
 
-from slamdunk.utils.misc import checkStep  # @UnresolvedImport
+from slamdunk.utils.misc import checkStep, finishStep, getInputFiles  # @UnresolvedImport
 from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile, SlamSeqWriter  # @UnresolvedImport
 from slamdunk.utils import SNPtools  # @UnresolvedImport
+from slamdunk.utils.ShardedExecutor import runSharded, getFragmentFile, appendFragments  # @UnresolvedImport
 
-def dumpReadInfo(referenceFile, bam, minQual, outputCSV, snpsFile, log, printOnly=False, verbose=True, force=False):
+def dumpReadInfoShard(chromosomes, referenceFile, bam, snpsFile, outputCSV):
+    # Writes all reads on chromosomes to a fragment of outputCSV (see runSharded)
+    snps = SNPtools.SNPDictionary(snpsFile)
+    snps.read()
     
-    if(not checkStep([bam, referenceFile], [outputCSV], force)):
+    fragmentFile = getFragmentFile(outputCSV)
+    outputFile = SlamSeqWriter(fragmentFile, header=False)
+    
+    #Go through one chr after the other
+    testFile = SlamSeqBamFile(bam, referenceFile, snps)
+    
+    for chromosome in chromosomes:
+        readIterator = testFile.readsInChromosome(chromosome)
+        for read in readIterator:
+            outputFile.write(read)
+    
+    outputFile.close()
+    return fragmentFile
+
+def dumpReadInfo(referenceFile, bam, minQual, outputCSV, snpsFile, log, printOnly=False, verbose=True, force=False, threads=1):
+    
+    if(not checkStep(getInputFiles(bam, referenceFile, snpsFile), [outputCSV], force, [minQual])):
         print("Skipped computing T->C per reads position for file " + bam, file=log)
     else:
-                
-        snps = SNPtools.SNPDictionary(snpsFile)
-        snps.read()
-    
-        outputFile = SlamSeqWriter(outputCSV)
         
-        #Go through one chr after the other
-        testFile = SlamSeqBamFile(bam, referenceFile, snps)
+        chromosomes = SlamSeqBamFile(bam, referenceFile, None).getChromosomes()
         
-        chromosomes = testFile.getChromosomes()
+        # Chromosome shards are written to fragments in threads processes
+        # and appended to the header in chromosome order
+        _, fragmentFiles = runSharded(dumpReadInfoShard, bam, chromosomes, threads, referenceFile, bam, snpsFile, outputCSV)
         
-        for chromosome in chromosomes:
-            readIterator = testFile.readsInChromosome(chromosome)
-            for read in readIterator:
-                outputFile.write(read)
-
-        
-        outputFile.close()
\ No newline at end of file
+        outputFile = SlamSeqWriter(outputCSV)
+        outputFile.close()
+        appendFragments(outputCSV, fragmentFiles)
+        finishStep([outputCSV])
@@ -23,8 +23,9 @@ import pysam, random, os
 
 from slamdunk.version import __version__, __bam_version__  # @UnresolvedImport
 
-from slamdunk.utils.BedReader import bedToIntervallTree  # @UnresolvedImport
-from slamdunk.utils.misc import checkStep, run, removeFile, getBinary, pysamIndex, SlamSeqInfo, md5  # @UnresolvedImport
+from slamdunk.utils.AnnotationIndex import getAnnotationIndex  # @UnresolvedImport
+from slamdunk.utils.misc import checkStep, finishStep, pysamIndex, SlamSeqInfo, openBam  # @UnresolvedImport
+from slamdunk.utils.BamSorter import SortingBamWriter, DefaultMaxRecords  # @UnresolvedImport
 
 # def Filter_old(inputBAM, outputBAM, log, MQ=2, printOnly=False, verbose=True, force=True):
 #     if(printOnly or checkStep([inputBAM], [outputBAM], force)):
@@ -35,24 +36,6 @@ from slamdunk.utils.misc import checkStep, run, removeFile, getBinary, pysamInde
 #     runIndexBam(outputBAM, log, verbose=verbose, dry=printOnly)
 #     runFlagstat(outputBAM, log, verbose=verbose, dry=printOnly)
     
-def bamSort(outputBAM, log, newHeader, verbose):
-    
-    tmp = outputBAM + "_tmp"
-    if(newHeader != None):
-        pyOutputBAM = pysam.AlignmentFile(outputBAM, "rb")    
-        pyTmp = pysam.AlignmentFile(tmp, "wb", header=newHeader)
-        for read in pyOutputBAM:
-            pyTmp.write(read)
-        pyOutputBAM.close()
-        pyTmp.close()
-    else:
-        os.rename(outputBAM, tmp)
-                              
-    #run(" ".join(["samtools", "sort", "-@", str(threads) , tmp, replaceExtension(outFile, "")]), log, verbose=verbose, dry=dry)
-    run(" ".join([getBinary("samtools"), "sort", "-o", outputBAM, tmp]), log, verbose=verbose, dry=False)
-    #pysam.sort(tmp, outputBAM)  # @UndefinedVariable
-    removeFile(tmp)
-        
 def dumpBufferToBam (buffer, multimapList, outbam, infile):
     # Randomly write hit from read
     #read = random.choice(buffer.values()).pop()
@@ -79,7 +62,7 @@ def multimapUTRRetainment (infile, outfile, bed, minIdentity, NM, log):
     idFiltered = 0
     nmFiltered = 0
     
-    utrIntervallTreeDict = bedToIntervallTree(bed)
+    utrIntervalIndex = getAnnotationIndex(bed).getIntervalIndex()
     
 #     debugLog = os.path.join("multimapdebug.log")
 #     
@@ -137,27 +120,27 @@ def multimapUTRRetainment (infile, outfile, bed, minIdentity, NM, log):
             start = read.reference_start
             end = read.reference_end
             
-            if (utrIntervallTreeDict.has_key(chr)) :
-                query = utrIntervallTreeDict[chr][start:end]
+            if (utrIntervalIndex.has_key(chr)) :
+                query = utrIntervalIndex[chr].overlap(start, end)
             else :
-                query = set()
+                query = []
             
             if len(query) > 0:
                 # First UTR hit is recorded without checks
                 if (len(multimapBuffer) == 0) :
                     for result in query :
-                        if (not multimapBuffer.has_key(result.data)) :
-                            multimapBuffer[result.data] = []
-                        multimapBuffer[result.data].append(read)
+                        if (not multimapBuffer.has_key(result)) :
+                            multimapBuffer[result] = []
+                        multimapBuffer[result].append(read)
                 # Second UTR hit looks at previous UTR hits -> no dump if hit on different UTR
                 else :
                     for result in query :
-                        if (not multimapBuffer.has_key(result.data)) :
-                            multimapBuffer[result.data] = []
-                            multimapBuffer[result.data].append(read)
+                        if (not multimapBuffer.has_key(result)) :
+                            multimapBuffer[result] = []
+                            multimapBuffer[result].append(read)
                             dumpBuffer = False
                         else :
-                            multimapBuffer[result.data].append(read)
+                            multimapBuffer[result].append(read)
 
 #             else :
 #                 # If no overlap -> nonUTR
@@ -210,108 +193,118 @@ def multimapUTRRetainment (infile, outfile, bed, minIdentity, NM, log):
     return mappedReads, unmappedReads, filteredReads, mqFiltered, idFiltered, nmFiltered, multimapper
         
         
-def Filter(inputBAM, outputBAM, log, bed, MQ=2, minIdentity=0.8, NM=-1, printOnly=False, verbose=True, force=False):
-    if(printOnly or checkStep([inputBAM], [outputBAM], force)):
-        
-        mappedReads = 0
-        unmappedReads = 0
-        filteredReads = 0
-        
-        mqFiltered = 0
-        idFiltered = 0
-        nmFiltered = 0
-        multimapper = 0
+def filterReads(infile, outfile, inputName, bed, MQ, minIdentity, NM, log):
+    # Filters all reads of infile (opened pysam.AlignmentFile, e.g. a mapper
+    # output stream) into outfile and returns the updated header of infile
+    
+    mappedReads = 0
+    unmappedReads = 0
+    filteredReads = 0
+    
+    mqFiltered = 0
+    idFiltered = 0
+    nmFiltered = 0
+    multimapper = 0
+    
+    # Default filtering without bed
+    if (bed == None) :
         
-        infile = pysam.AlignmentFile(inputBAM, "rb")    
-        outfile = pysam.AlignmentFile(outputBAM, "wb", template=infile)
+        print("#No bed-file supplied. Running default filtering on " + inputName + ".",file=log)
         
-        # Default filtering without bed
-        if (bed == None) :
-            
-            print("#No bed-file supplied. Running default filtering on " + inputBAM + ".",file=log)
+        for read in infile:
             
-            for read in infile:
-                
-                if(not read.is_secondary and not read.is_supplementary):
-                    if(read.is_unmapped):
-                        unmappedReads += 1
-                    else:
-                        mappedReads += 1
-                
+            if(not read.is_secondary and not read.is_supplementary):
                 if(read.is_unmapped):
-                    continue
-                if(read.mapping_quality < MQ):
-                    mqFiltered += 1
-                    continue
-                if(float(read.get_tag("XI")) < minIdentity):
-                    idFiltered += 1
-                    continue
-                if(NM > -1 and int(read.get_tag("NM")) > NM):
-                    nmFiltered += 1
-                    continue
-                
-                if(not read.is_secondary and not read.is_supplementary):
-                    filteredReads += 1
-                    
-                outfile.write(read)
-                
-            print("Criterion\tFiltered reads",file=log)
-            print("MQ < " + str(MQ) + "\t" + str(mqFiltered),file=log)
-            print("ID < " + str(minIdentity) + "\t" + str(idFiltered),file=log)
-            print("NM > " + str(NM) + "\t" + str(nmFiltered),file=log)
-            print("MM\t0",file=log)
-        else :
-            # Multimap retention strategy filtering when bed is supplied
+                    unmappedReads += 1
+                else:
+                    mappedReads += 1
             
-            random.seed(1)
+            if(read.is_unmapped):
+                continue
+            if(read.mapping_quality < MQ):
+                mqFiltered += 1
+                continue
+            if(float(read.get_tag("XI")) < minIdentity):
+                idFiltered += 1
+                continue
+            if(NM > -1 and int(read.get_tag("NM")) > NM):
+                nmFiltered += 1
+                continue
             
-            print("#Bed-file supplied. Running multimap retention filtering strategy on " + inputBAM + ".",file=log)
+            if(not read.is_secondary and not read.is_supplementary):
+                filteredReads += 1
+                
+            outfile.write(read)
             
-            mappedReads, unmappedReads, filteredReads, mqFiltered, idFiltered, nmFiltered, multimapper = multimapUTRRetainment (infile, outfile, bed, minIdentity, NM, log) 
-            #mappedReads, unmappedReads, filteredReads = multimapUTRRetainment (infile, outfile, bed, minIdentity, NM, log)
+        print("Criterion\tFiltered reads",file=log)
+        print("MQ < " + str(MQ) + "\t" + str(mqFiltered),file=log)
+        print("ID < " + str(minIdentity) + "\t" + str(idFiltered),file=log)
+        print("NM > " + str(NM) + "\t" + str(nmFiltered),file=log)
+        print("MM\t0",file=log)
+    else :
+        # Multimap retention strategy filtering when bed is supplied
         
-        # Add number of sequenced and number of mapped reads to the read group description
-        # Used for creating summary file
-        inFileBamHeader = outfile.header
-        if('RG' in inFileBamHeader and len(inFileBamHeader['RG']) > 0):
-            slamseqInfo = SlamSeqInfo()
-            slamseqInfo.SequencedReads = mappedReads + unmappedReads
-            slamseqInfo.MappedReads = mappedReads
-            slamseqInfo.FilteredReads = filteredReads
-            slamseqInfo.MQFilteredReads = mqFiltered
-            slamseqInfo.IdFilteredReads = idFiltered
-            slamseqInfo.NmFilteredReads = nmFiltered
-            slamseqInfo.MultimapperReads = multimapper
+        random.seed(1)
+        
+        print("#Bed-file supplied. Running multimap retention filtering strategy on " + inputName + ".",file=log)
+        
+        mappedReads, unmappedReads, filteredReads, mqFiltered, idFiltered, nmFiltered, multimapper = multimapUTRRetainment (infile, outfile, bed, minIdentity, NM, log) 
+        #mappedReads, unmappedReads, filteredReads = multimapUTRRetainment (infile, outfile, bed, minIdentity, NM, log)
+    
+    # Add number of sequenced and number of mapped reads to the read group description
+    # Used for creating summary file
+    inFileBamHeader = infile.header
+    if('RG' in inFileBamHeader and len(inFileBamHeader['RG']) > 0):
+        slamseqInfo = SlamSeqInfo()
+        slamseqInfo.SequencedReads = mappedReads + unmappedReads
+        slamseqInfo.MappedReads = mappedReads
+        slamseqInfo.FilteredReads = filteredReads
+        slamseqInfo.MQFilteredReads = mqFiltered
+        slamseqInfo.IdFilteredReads = idFiltered
+        slamseqInfo.NmFilteredReads = nmFiltered
+        slamseqInfo.MultimapperReads = multimapper
 
-            if (bed != None) :
-                slamseqInfo.AnnotationName = os.path.basename(bed)
-                slamseqInfo.AnnotationMD5 = md5(bed)
-            else :
-                slamseqInfo.AnnotationName = ""
-                slamseqInfo.AnnotationMD5 = ""
-            
-            if not isinstance(inFileBamHeader, dict):
-                inFileBamHeader = inFileBamHeader.to_dict()
-            inFileBamHeader['RG'][0]['DS'] = str(slamseqInfo)
-            #inFileBamHeader['RG'][0]['DS'] = "{'sequenced':" + str(mappedReads + unmappedReads) + "," + "'mapped':" + str(mappedReads) + "," + "'filtered':" + str(filteredReads) + "}"        
+        if (bed != None) :
+            slamseqInfo.AnnotationName = os.path.basename(bed)
+            slamseqInfo.AnnotationMD5 = getAnnotationIndex(bed).md5
+        else :
+            slamseqInfo.AnnotationName = ""
+            slamseqInfo.AnnotationMD5 = ""
         
-        slamDunkPG = { 'ID': 'slamdunk', 'PN': 'slamdunk filter v' + __version__, 'VN': __bam_version__ }
-        if('PG' in inFileBamHeader):
-            inFileBamHeader['PG'].append(slamDunkPG)
-        else:
-            inFileBamHeader['PG'] = [ slamDunkPG ]
+        if not isinstance(inFileBamHeader, dict):
+            inFileBamHeader = inFileBamHeader.to_dict()
+        inFileBamHeader['RG'][0]['DS'] = str(slamseqInfo)
+        #inFileBamHeader['RG'][0]['DS'] = "{'sequenced':" + str(mappedReads + unmappedReads) + "," + "'mapped':" + str(mappedReads) + "," + "'filtered':" + str(filteredReads) + "}"        
+    
+    slamDunkPG = { 'ID': 'slamdunk', 'PN': 'slamdunk filter v' + __version__, 'VN': __bam_version__ }
+    if('PG' in inFileBamHeader):
+        inFileBamHeader['PG'].append(slamDunkPG)
+    else:
+        inFileBamHeader['PG'] = [ slamDunkPG ]
+    
+    return inFileBamHeader
         
-        infile.close()
-        outfile.close()
+def Filter(inputBAM, outputBAM, log, bed, MQ=2, minIdentity=0.8, NM=-1, printOnly=False, verbose=True, force=False, threads=1, compressionLevel=None, maxRecords=DefaultMaxRecords):
+    inFiles = [inputBAM]
+    if(bed != None):
+        inFiles.append(bed)
+    if(printOnly or checkStep(inFiles, [outputBAM], force, [MQ, minIdentity, NM, __bam_version__])):
         
-        # Sort afterwards
-        bamSort(outputBAM, log, inFileBamHeader, verbose)
+        # threads: BGZF (de)compression threads for input and output
+        infile = openBam(inputBAM, "rb", threads)
+        # Reads are sorted while filtering. The header is written at the end,
+        # when the read counts are known
+        outfile = SortingBamWriter(outputBAM, infile, maxRecords, threads=threads, compressionLevel=compressionLevel)
+        
+        inFileBamHeader = filterReads(infile, outfile, inputBAM, bed, MQ, minIdentity, NM, log)
+        
+        outfile.close(inFileBamHeader)
+        infile.close()
         
         pysamIndex(outputBAM)
+        finishStep([outputBAM])
         #pysamFlagstat(outputBAM)
         #runFlagstat(outputBAM, log, verbose=verbose, dry=printOnly)
     
     else:
         print("Skipped filtering for " + inputBAM, file=log)
-
-    
\ No newline at end of file
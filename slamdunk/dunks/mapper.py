@@ -18,17 +18,24 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function
-import os, re
+import os, re, subprocess
+import pysam
 
-from slamdunk.utils.misc import files_exist, checkStep, run, pysamIndex, removeFile, getBinary, replaceExtension, shellerr  # @UnresolvedImport
-from slamdunk.version import __ngm_version__  # @UnresolvedImport
+from slamdunk.utils.misc import files_exist, checkStep, finishStep, isStepFinished, run, pysamIndex, removeFile, getBinary, replaceExtension, shellerr  # @UnresolvedImport
+from slamdunk.utils.BamSorter import SortingBamWriter, DefaultMaxRecords  # @UnresolvedImport
+from slamdunk.dunks import filter  # @UnresolvedImport
+from slamdunk.version import __ngm_version__, __bam_version__  # @UnresolvedImport
 
 projectPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 def sort(inputSAM, outputBAM, log, threads=1, keepSam=True, dry=False, verbose=True):    
  
-    if(files_exist(inputSAM) and checkStep([inputSAM], [outputBAM + ".bai"])):
+    # Second half of the mapping step started by Map with SAM output: the step
+    # is recorded under outputBAM and finished when the BAM file is written
+    if(files_exist(inputSAM) and not isStepFinished([outputBAM])):
         runSam2bam(inputSAM, outputBAM, log, False, False, not keepSam, threads=threads, dry=dry, verbose=verbose)
+        if(not dry):
+            finishStep([outputBAM])
     else:
         print("Skipped sorting for " + inputSAM, file=log)
 
@@ -74,7 +81,7 @@ def runSam2bam(inFile, outFile, log, index=True, sort=True, delinFile=False, onl
         pysamIndex(outFile)
 
 
-def Map(inputBAM, inputReference, outputSAM, log, quantseqMapping, endtoendMapping, threads=1, parameter="--no-progress --slam-seq 2" , outputSuffix="_ngm_slamdunk", trim5p=0, maxPolyA=-1, topn=1, sampleId=None, sampleName="NA", sampleType="NA", sampleTime=0, printOnly=False, verbose=True, force=False):
+def getNgmParameter(quantseqMapping, endtoendMapping, parameter="--no-progress --slam-seq 2", trim5p=0, maxPolyA=-1, topn=1, sampleId=None, sampleName="NA", sampleType="NA", sampleTime=0):
 
     if(quantseqMapping is True) :
         parameter = "--no-progress"
@@ -98,14 +105,71 @@ def Map(inputBAM, inputReference, outputSAM, log, quantseqMapping, endtoendMappi
     if(topn > 1):
         parameter = parameter + " -n " + str(topn) + " --strata "
         
-    if(checkStep([inputReference, inputBAM], [replaceExtension(outputSAM, ".bam")], force)):
+    return parameter
+
+def Map(inputBAM, inputReference, outputSAM, log, quantseqMapping, endtoendMapping, threads=1, parameter="--no-progress --slam-seq 2" , outputSuffix="_ngm_slamdunk", trim5p=0, maxPolyA=-1, topn=1, sampleId=None, sampleName="NA", sampleType="NA", sampleTime=0, printOnly=False, verbose=True, force=False):
+
+    parameter = getNgmParameter(quantseqMapping, endtoendMapping, parameter, trim5p, maxPolyA, topn, sampleId, sampleName, sampleType, sampleTime)
+        
+    # Recorded under the BAM file in both cases. SAM output is converted and
+    # the step finished by sort
+    outputBAM = replaceExtension(outputSAM, ".bam")
+    if(checkStep([inputReference, inputBAM], [outputBAM], force, [parameter, __ngm_version__])):
         if outputSAM.endswith(".sam"):
             # Output SAM
             run(getBinary("ngm") + " -r " + inputReference + " -q " + inputBAM + " -t " + str(threads) + " " + parameter + " -o " + outputSAM, log, verbose=verbose, dry=printOnly)
         else:
             # Output BAM directly
             run(getBinary("ngm") + " -b -r " + inputReference + " -q " + inputBAM + " -t " + str(threads) + " " + parameter + " -o " + outputSAM, log, verbose=verbose, dry=printOnly)        
+            if(not printOnly):
+                finishStep([outputBAM])
     else:
         print("Skipped mapping for " + inputBAM, file=log)
-        
 
+def MapFilter(inputBAM, inputReference, outputBAM, log, quantseqMapping, endtoendMapping, bed=None, MQ=2, minIdentity=0.8, NM=-1, threads=1, compressionLevel=None, maxRecords=DefaultMaxRecords, parameter="--no-progress --slam-seq 2", trim5p=0, maxPolyA=-1, topn=1, sampleId=None, sampleName="NA", sampleType="NA", sampleTime=0, printOnly=False, verbose=True, force=False):
+    # Maps and filters in one pass: the SAM output of NextGenMap is read from a
+    # pipe, filtered and sorted. Only the filtered, sorted and indexed BAM file
+    # is written to disk
+
+    parameter = getNgmParameter(quantseqMapping, endtoendMapping, parameter, trim5p, maxPolyA, topn, sampleId, sampleName, sampleType, sampleTime)
+    cmd = getBinary("ngm") + " -r " + inputReference + " -q " + inputBAM + " -t " + str(threads) + " " + parameter + " -o /dev/stdout"
+    
+    inFiles = [inputReference, inputBAM]
+    if(bed != None):
+        inFiles.append(bed)
+    if(printOnly or checkStep(inFiles, [outputBAM], force, [parameter, __ngm_version__, MQ, minIdentity, NM, __bam_version__])):
+        if(verbose or printOnly):
+            print(cmd, file=log)
+        if(printOnly):
+            return
+        
+        log.flush()
+        # NextGenMap messages go to the log file, alignments to the pipe
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log, shell=True)
+        outfile = None
+        try:
+            infile = pysam.AlignmentFile(p.stdout, "r")
+            outfile = SortingBamWriter(outputBAM, infile, maxRecords, threads=threads, compressionLevel=compressionLevel)
+            inFileBamHeader = filter.filterReads(infile, outfile, inputBAM, bed, MQ, minIdentity, NM, log)
+        except (IOError, ValueError):
+            # Broken or empty SAM output: reported below if NextGenMap failed
+            p.stdout.close()
+            p.wait()
+            if(outfile != None):
+                outfile.abort()
+            if(p.returncode != 0):
+                raise RuntimeError("Error while executing command: \"" + cmd + "\"")
+            raise
+        p.wait()
+        if(p.returncode != 0):
+            outfile.abort()
+            infile.close()
+            raise RuntimeError("Error while executing command: \"" + cmd + "\"")
+        
+        # The last sorted run is written with the header of infile
+        outfile.close(inFileBamHeader)
+        infile.close()
+        pysamIndex(outputBAM)
+        finishStep([outputBAM])
+    else:
+        print("Skipped mapping and filtering for " + inputBAM, file=log)
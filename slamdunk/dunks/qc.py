@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015 Tobias Neumann, Philipp Rescheneder.
+#
+# This file is part of Slamdunk.
+#
+# Slamdunk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Slamdunk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# One pass QC: the metrics of alleyoop rates, tccontext, tcperreadpos,
+# tcperutrpos and utrrates are computed from a single read stream. Reads
+# are decoded once per batch and fed to all enabled metrics, the CSV files
+# are the same as the ones written by the single commands
+
+from __future__ import print_function
+import pysam
+import numpy as np
+
+from slamdunk.dunks import stats  # @UnresolvedImport
+from slamdunk.utils.misc import checkStep, finishStep, getInputFiles  # @UnresolvedImport
+from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile, SlamSeqReadBatch, decodeAlignments  # @UnresolvedImport
+from slamdunk.utils import SNPtools  # @UnresolvedImport
+from slamdunk.utils.AnnotationIndex import getAnnotationIndex  # @UnresolvedImport
+from slamdunk.utils.ShardedExecutor import runSharded  # @UnresolvedImport
+
+# All metrics in the order they are computed
+qcMetrics = [ "rates", "tccontext", "tcperreadpos", "tcperutrpos", "utrrates" ]
+
+# Metrics computed per UTR of a BED file
+utrMetrics = [ "tcperutrpos", "utrrates" ]
+
+# Metrics using SNP masked conversions
+snpMetrics = [ "tcperreadpos", "tcperutrpos" ]
+
+qcBatchSize = 100000
+
+class QCBatch:
+
+    # Up to qcBatchSize reads of one chromosome. The reads are decoded once
+    # (see decodeAlignments) and finished with and without SNP masking on
+    # demand. Positions are relative to 1 as in readBatchesInChromosome
+
+    def __init__(self, chromosome, chromosomeLength, reads, minQual, snps, annotation, utrIndex):
+        self.chromosome = chromosome
+        # All reads as returned by pysam
+        self.reads = reads
+        self._chromosomeLength = chromosomeLength
+        self._minQual = minQual
+        self._snps = snps
+        self._annotation = annotation
+        # Index of all UTRs on chromosome
+        self._utrIndex = utrIndex
+        self._raw = decodeAlignments([ read for read in reads if not read.is_unmapped ])
+        self._readBatches = {}
+        self._utrReads = None
+
+    def getReadBatch(self, maskSNPs):
+        # SlamSeqReadBatch of all mapped reads
+        if self._snps == None:
+            maskSNPs = False
+        if maskSNPs not in self._readBatches:
+            self._readBatches[maskSNPs] = SlamSeqReadBatch.fromRaw(self._raw, self.chromosome, 1, self._snps if maskSNPs else None, self._minQual, 1)
+        return self._readBatches[maskSNPs]
+
+    def getUtrReads(self):
+        # (index in annotation, BED entry, read indices) of all UTRs overlapping
+        # reads of the batch. The reads of a UTR are the ones returned by
+        # SlamSeqBamFile.readInRegion: overlapping the UTR and on its strand
+        if self._utrReads == None:
+            self._utrReads = []
+
+            referenceStart = self._raw['referenceStart']
+            referenceEnd = self._raw['referenceEnd']
+            if len(referenceStart) == 0 or len(self._utrIndex) == 0:
+                return self._utrReads
+            maxSpan = int(np.max(referenceEnd - referenceStart))
+
+            starts = np.maximum(0, self._annotation.starts[self._utrIndex])
+            stops = np.minimum(self._chromosomeLength, self._annotation.stops[self._utrIndex])
+            overlapping = (starts < stops) & (starts < referenceEnd.max()) & (stops > referenceStart.min())
+            for utrIndex, start, stop in zip(self._utrIndex[overlapping], starts[overlapping], stops[overlapping]):
+                first = np.searchsorted(referenceStart, start - maxSpan, side='left')
+                last = np.searchsorted(referenceStart, stop, side='left')
+                index = first + np.flatnonzero(referenceEnd[first:last] > start)
+
+                # Strand-specific assay - skip all reads from antisense-strand
+                utr = self._annotation.getEntry(utrIndex)
+                if utr.strand == "+":
+                    index = index[~self._raw['isReverse'][index]]
+                elif utr.strand == "-":
+                    index = index[self._raw['isReverse'][index]]
+
+                if len(index) > 0:
+                    self._utrReads.append((utrIndex, utr, index))
+        return self._utrReads
+
+class OverallRatesMetric:
+
+    # alleyoop rates
+
+    def __init__(self, maxReadLength, utrCount, strictTCs):
+        self.ratesFwd = np.zeros(25, dtype=np.int64)
+        self.ratesRev = np.zeros(25, dtype=np.int64)
+
+    def add(self, batch):
+        readBatch = batch.getReadBatch(False)
+        self.ratesRev += readBatch.conversionRates[readBatch.isReverse].sum(axis=0)
+        self.ratesFwd += readBatch.conversionRates[~readBatch.isReverse].sum(axis=0)
+
+    def merge(self, other):
+        self.ratesFwd += other.ratesFwd
+        self.ratesRev += other.ratesRev
+
+    def write(self, outputCSV, annotation):
+        stats.writeOverallRates(outputCSV, self.ratesFwd, self.ratesRev)
+
+class TCContextMetric:
+
+    # alleyoop tccontext (read sequences of all reads)
+
+    def __init__(self, maxReadLength, utrCount, strictTCs):
+        self.counts = stats.getTCContextCounts()
+
+    def add(self, batch):
+        stats.addTCContextCounts(self.counts, batch.reads)
+
+    def merge(self, other):
+        stats.mergeTCContextCounts(self.counts, other.counts)
+
+    def write(self, outputCSV, annotation):
+        stats.writeTCContext(outputCSV, self.counts)
+
+class TcPerReadPosMetric:
+
+    # alleyoop tcperreadpos
+
+    def __init__(self, maxReadLength, utrCount, strictTCs):
+        self.counts = np.zeros((6, maxReadLength), dtype=np.int64)
+
+    def add(self, batch):
+        readBatch = batch.getReadBatch(True)
+        if len(readBatch) > 0:
+            stats.addTcPerReadPosCounts(self.counts, readBatch)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def write(self, outputCSV, annotation):
+        stats.writeTcPerReadPos(outputCSV, self.counts)
+
+class TcPerUtrMetric:
+
+    # alleyoop tcperutrpos
+
+    def __init__(self, maxReadLength, utrCount, strictTCs):
+        self.counts = np.zeros((6, stats.utrNormFactor), dtype=np.int64)
+
+    def add(self, batch):
+        readBatch = batch.getReadBatch(True)
+        for _, utr, index in batch.getUtrReads():
+            utrBatch = readBatch.selectReads(index)
+            # Positions relative to the UTR start (see readInRegion)
+            offset = utr.start - 1
+            utrBatch.startRefPos = utrBatch.startRefPos - offset
+            utrBatch.endRefPos = utrBatch.endRefPos - offset
+            utrBatch.mismatchRefPos = utrBatch.mismatchRefPos - offset
+            stats.addTcPerUtrCounts(self.counts, utrBatch, utr)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def write(self, outputCSV, annotation):
+        stats.writeTcPerUtr(outputCSV, self.counts)
+
+class UtrRatesMetric:
+
+    # alleyoop utrrates (conversion rates without SNP masking)
+
+    def __init__(self, maxReadLength, utrCount, strictTCs):
+        self.strictTCs = strictTCs
+        self.rates = np.zeros((utrCount, 25), dtype=np.int64)
+        self.readCounts = np.zeros(utrCount, dtype=np.int64)
+
+    def add(self, batch):
+        readBatch = batch.getReadBatch(False)
+        for utrIndex, _, index in batch.getUtrReads():
+            if self.strictTCs:
+                index = index[readBatch.isTcRead[index] | (readBatch.tcCount[index] == 0)]
+            self.rates[utrIndex] += readBatch.conversionRates[index].sum(axis=0)
+            self.readCounts[utrIndex] += len(index)
+
+    def merge(self, other):
+        self.rates += other.rates
+        self.readCounts += other.readCounts
+
+    def write(self, outputCSV, annotation):
+        stats.writeUtrRates(outputCSV, annotation.getEntries(), self.rates.tolist(), self.readCounts.tolist())
+
+metricClasses = {
+    "rates" : OverallRatesMetric,
+    "tccontext" : TCContextMetric,
+    "tcperreadpos" : TcPerReadPosMetric,
+    "tcperutrpos" : TcPerUtrMetric,
+    "utrrates" : UtrRatesMetric
+}
+
+metricPlotters = {
+    "rates" : stats.plotOverallRates,
+    "tccontext" : stats.plotTCContext,
+    "tcperreadpos" : stats.plotTcPerReadPos,
+    "tcperutrpos" : stats.plotTcPerUtr,
+    "utrrates" : stats.plotUtrRates
+}
+
+def getStep(metric, referenceFile, bam, minQual, maxReadLength, snpsFile, utrBed, strictTCs):
+    # Input files and parameters of a metric, the same as for the single
+    # commands so their outputs are reused
+    if metric == "rates" or metric == "tccontext":
+        return [bam, referenceFile], [minQual]
+    elif metric == "tcperreadpos":
+        return getInputFiles(bam, referenceFile, snpsFile), [minQual, maxReadLength]
+    elif metric == "tcperutrpos":
+        return getInputFiles(bam, referenceFile, snpsFile) + [utrBed], [minQual, maxReadLength]
+    else:
+        return [bam, referenceFile, utrBed], [minQual, strictTCs, maxReadLength]
+
+def qcShard(chromosomes, referenceFile, bam, metrics, minQual, maxReadLength, snpsFile, utrBed, strictTCs):
+    # Metrics of all reads on chromosomes (see runSharded)
+    snps = None
+    if snpsFile != None and len(set(metrics) & set(snpMetrics)) > 0:
+        snps = SNPtools.SNPDictionary(snpsFile)
+        snps.read()
+
+    annotation = None
+    utrCount = 0
+    if len(set(metrics) & set(utrMetrics)) > 0:
+        annotation = getAnnotationIndex(utrBed)
+        utrCount = len(annotation)
+
+    accumulators = [ metricClasses[metric](maxReadLength, utrCount, strictTCs) for metric in metrics ]
+
+    testFile = SlamSeqBamFile(bam, referenceFile, None)
+    bamFile = pysam.AlignmentFile(bam, "rb")
+
+    # Go through one chr after the other
+    for chromosome in chromosomes:
+        if chromosome not in bamFile.references:
+            continue
+
+        utrIndex = np.zeros(0, dtype=np.int64)
+        if annotation != None:
+            utrIndex = np.flatnonzero(annotation.chromosomes == chromosome)
+
+        reads = []
+        for read in bamFile.fetch(reference=chromosome):
+            reads.append(read)
+            if len(reads) >= qcBatchSize:
+                batch = QCBatch(chromosome, testFile.getChromosomeLength(chromosome), reads, minQual, snps, annotation, utrIndex)
+                for accumulator in accumulators:
+                    accumulator.add(batch)
+                reads = []
+        if len(reads) > 0:
+            batch = QCBatch(chromosome, testFile.getChromosomeLength(chromosome), reads, minQual, snps, annotation, utrIndex)
+            for accumulator in accumulators:
+                accumulator.add(batch)
+
+    bamFile.close()
+    return accumulators
+
+def computeQC(referenceFile, bam, outputFiles, minQual, maxReadLength, snpsFile, utrBed, strictTCs, log, printOnly=False, verbose=True, force=False, threads=1):
+    # outputFiles: metric -> (outputCSV, outputPDF) for all enabled metrics
+
+    metrics = []
+    for metric in qcMetrics:
+        if metric not in outputFiles:
+            continue
+        inFiles, parameters = getStep(metric, referenceFile, bam, minQual, maxReadLength, snpsFile, utrBed, strictTCs)
+        if(not checkStep(inFiles, [outputFiles[metric][0]], force, parameters)):
+            print("Skipped computing " + metric + " for file " + bam, file=log)
+        else:
+            metrics.append(metric)
+
+    if len(metrics) > 0:
+        chromosomes = SlamSeqBamFile(bam, referenceFile, None).getChromosomes()
+
+        # Chromosome shards are processed in threads processes
+        _, results = runSharded(qcShard, bam, chromosomes, threads, referenceFile, bam, metrics, minQual, maxReadLength, snpsFile, utrBed, strictTCs)
+
+        annotation = None
+        if len(set(metrics) & set(utrMetrics)) > 0:
+            annotation = getAnnotationIndex(utrBed)
+
+        for i, metric in enumerate(metrics):
+            accumulator = results[0][i]
+            for shardAccumulators in results[1:]:
+                accumulator.merge(shardAccumulators[i])
+            accumulator.write(outputFiles[metric][0], annotation)
+            finishStep([outputFiles[metric][0]])
+
+    for metric in qcMetrics:
+        if metric in outputFiles:
+            outputCSV, outputPDF = outputFiles[metric]
+            metricPlotters[metric](bam, outputCSV, outputPDF, log, printOnly, verbose, force)
@@ -28,7 +28,7 @@ import numpy
 import pysam
 
 from slamdunk.utils import SNPtools  # @UnresolvedImport
-from slamdunk.utils.BedReader import BedIterator, bedToIntervallTree  # @UnresolvedImport
+from slamdunk.utils.BedReader import BedIterator, bedToIntervalIndex  # @UnresolvedImport
 from slamdunk.utils.misc import shell, run, getBinary, md5, getPlotter, callR  # @UnresolvedImport
 from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile, SlamSeqInterval  # @UnresolvedImport
 from slamdunk.version import __version__, __count_version__  # @UnresolvedImport
@@ -377,7 +377,7 @@ def evaluateReads(bam, referenceFile, bed, outputFile, mainOutput):
      
     chromosomes = testFile.getChromosomes()
     
-    bedTree = bedToIntervallTree(bed)
+    bedIndex = bedToIntervalIndex(bed)
     #evalHist = [0] *  
     
     outFile = open(outputFile, "w")
@@ -399,10 +399,10 @@ def evaluateReads(bam, referenceFile, bed, outputFile, mainOutput):
             tcCountSim = int(simInfo[2])
             
             utrFound = None
-            if read.chromosome in bedTree:
-                overlaps = list(bedTree[read.chromosome][read.startRefPos:read.endRefPos])
+            if read.chromosome in bedIndex:
+                overlaps = bedIndex[read.chromosome].overlap(read.startRefPos, read.endRefPos)
                 if len(overlaps) > 0:
-                    utrFound = overlaps[0].data
+                    utrFound = overlaps[0]
             
             if utrFound == utrSim:
                 if tcCountSim == read.tcCount:
@@ -20,19 +20,250 @@
 from __future__ import print_function
 import subprocess
 import csv
-from slamdunk.utils.misc import checkStep, getBinary  # @UnresolvedImport
+import pysam
+import numpy as np
 
-def SNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, minQual, log, printOnly=False, verbose=True, force=False):
-    if(checkStep([inputBAM, referenceFile], [outputSNP], force)):
+from slamdunk.utils.misc import checkStep, finishStep, getBinary, removeFile  # @UnresolvedImport
+from slamdunk.utils.ReferenceProvider import getReferenceProvider  # @UnresolvedImport
+from slamdunk.utils.BedReader import bedToRegions  # @UnresolvedImport
+from slamdunk.utils.ShardedExecutor import runShards, getChromosomeShards, getRegionShards, getFragmentFile, appendFragments  # @UnresolvedImport
+from slamdunk.version import __version__  # @UnresolvedImport
+
+snpCallers = [ "varscan", "native" ]
+
+varscanJar = "VarScan.v2.4.1.jar"
+
+# VarScan mpileup2snp defaults: minimum number of reads supporting the
+# variant (--min-reads2) and minimum variant fraction of homozygous calls
+# (--min-freq-for-hom)
+minVariantReads = 2
+minHomozygousFraction = 0.75
+
+# Positions per count_coverage call
+snpWindowSize = 1000000
+
+# Index of A, C, G, T (order of count_coverage) per ASCII code, -1 for other bases
+baseIndex = np.full(256, -1, dtype=np.int64)
+for index, base in enumerate("ACGT"):
+    baseIndex[ord(base)] = index
+    baseIndex[ord(base.lower())] = index
+
+def printVCFHeader(f):
+    print("##fileformat=VCFv4.1", file=f)
+    print("##source=slamdunk v" + __version__, file=f)
+    print("##INFO=<ID=ADP,Number=1,Type=Integer,Description=\"Depth of bases with base quality >= minimum base quality\">", file=f)
+    print("##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">", file=f)
+    print("##FORMAT=<ID=DP,Number=1,Type=Integer,Description=\"Depth of bases with base quality >= minimum base quality\">", file=f)
+    print("##FORMAT=<ID=RD,Number=1,Type=Integer,Description=\"Depth of reference-supporting bases\">", file=f)
+    print("##FORMAT=<ID=AD,Number=1,Type=Integer,Description=\"Depth of variant-supporting bases\">", file=f)
+    print("##FORMAT=<ID=FREQ,Number=1,Type=String,Description=\"Variant allele frequency\">", file=f)
+    print("#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "Sample1", sep="\t", file=f)
+
+def callSNPsInWindow(bamFile, ref, chromosome, start, end, minVarFreq, minCov, minQual, f):
+    
+    # Base counts of all reads passing the samtools mpileup default filters
+    # (no unmapped, secondary, QC fail or duplicate reads)
+    counts = np.array(bamFile.count_coverage(chromosome, start, end, quality_threshold=minQual, read_callback="all"), dtype=np.int64)
+    depth = counts.sum(axis=0)
+    refBases = baseIndex[ref.fetchArray(chromosome, start, end)]
+    
+    positions = np.flatnonzero((depth[:len(refBases)] >= minCov) & (refBases >= 0))
+    if len(positions) == 0:
+        return
+    
+    # Most frequent non-reference base of each position
+    positionCounts = counts[:, positions]
+    columns = np.arange(len(positions))
+    refCounts = positionCounts[refBases[positions], columns]
+    positionCounts[refBases[positions], columns] = -1
+    altBases = positionCounts.argmax(axis=0)
+    altCounts = positionCounts[altBases, columns]
+    
+    freq = altCounts / depth[positions].astype(np.float64)
+    called = np.flatnonzero((altCounts >= minVariantReads) & (freq >= minVarFreq))
+    
+    for i in called:
+        genotype = "1/1" if freq[i] >= minHomozygousFraction else "0/1"
+        sample = ":".join([ genotype, str(depth[positions[i]]), str(refCounts[i]), str(altCounts[i]), "{0:.2f}%".format(freq[i] * 100) ])
+        print(chromosome, start + positions[i] + 1, ".", "ACGT"[refBases[positions[i]]], "ACGT"[altBases[i]], ".", "PASS", "ADP=" + str(depth[positions[i]]), "GT:DP:RD:AD:FREQ", sample, sep="\t", file=f)
+
+def getSNPRegions(inputBAM, bed, padding):
+    # Regions (chromosome, start, end) in BAM order: merged BED entries padded
+    # by padding (e.g. the read length), whole chromosomes without BED file
+    bamFile = pysam.AlignmentFile(inputBAM, "rb")
+    chromosomes = list(bamFile.references)
+    chromosomeLengths = dict(zip(bamFile.references, bamFile.lengths))
+    bamFile.close()
+    
+    if(bed == None):
+        return [ (chromosome, 0, chromosomeLengths[chromosome]) for chromosome in chromosomes ]
+    
+    bedRegions = bedToRegions(bed, padding)
+    regions = []
+    for chromosome in chromosomes:
+        for start, end in bedRegions.get(chromosome, []):
+            if(start < chromosomeLengths[chromosome]):
+                regions.append((chromosome, start, min(end, chromosomeLengths[chromosome])))
+    return regions
+
+def getSNPShards(inputBAM, regions, bed, shardNumber):
+    # Shards of whole chromosomes by mapped reads, shards of BED regions by length
+    if(bed == None):
+        chromosomeRegions = dict((region[0], region) for region in regions)
+        return [ [ chromosomeRegions[chromosome] for chromosome in shard ] for shard in getChromosomeShards(inputBAM, [ region[0] for region in regions ], shardNumber) ]
+    return getRegionShards(regions, shardNumber)
+
+def snpShard(regions, inputBAM, referenceFile, minVarFreq, minCov, minQual, outputSNP):
+    # Writes the SNPs of regions to a VCF fragment without header (see runShards)
+    ref = getReferenceProvider(referenceFile)
+    bamFile = pysam.AlignmentFile(inputBAM, "rb")
+    
+    fragmentFile = getFragmentFile(outputSNP)
+    with open(fragmentFile, "w") as f:
+        for chromosome, start, end in regions:
+            if not ref.isInReference(chromosome):
+                continue
+            end = min(end, ref.getLength(chromosome))
+            for windowStart in xrange(start, end, snpWindowSize):
+                callSNPsInWindow(bamFile, ref, chromosome, windowStart, min(windowStart + snpWindowSize, end), minVarFreq, minCov, minQual, f)
+    
+    bamFile.close()
+    return fragmentFile
+
+def callSNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, minQual, log, printOnly=False, verbose=True, force=False, threads=1, bed=None, padding=0):
+    # Same thresholds as samtools mpileup | VarScan mpileup2snp: positions with at least
+    # minCov bases of quality >= minQual, of which at least minVarFreq (and 2 bases)
+    # support the most frequent variant. VarScan's p-value filter is not applied, so
+    # calls at low coverage can differ. Shards of the genome or of the BED regions are
+    # called in threads processes
+    inputFiles = [ inputBAM, referenceFile ] + ([ bed ] if bed != None else [])
+    parameters = [ minVarFreq, minCov, minQual, "native" ] + ([ padding ] if bed != None else [])
+    if(checkStep(inputFiles, [outputSNP], force, parameters)):
+        if(verbose):
+            print("Calling SNPs in " + inputBAM + " (min coverage " + str(minCov) + ", min variant fraction " + str(minVarFreq) + ", min base quality " + str(minQual) + ", " + str(threads) + " threads)", file=log)
+        if(not printOnly):
+            regions = getSNPRegions(inputBAM, bed, padding)
+            shards = getSNPShards(inputBAM, regions, bed, max(1, threads))
+            fragmentFiles = runShards(snpShard, shards, threads, inputBAM, referenceFile, minVarFreq, minCov, minQual, outputSNP)
+            
+            with open(outputSNP, "w") as fileSNP:
+                printVCFHeader(fileSNP)
+            appendFragments(outputSNP, fragmentFiles)
+            finishStep([outputSNP])
+    else:
+        print("Skipping SNP calling", file=log)
+
+def SNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, minQual, log, printOnly=False, verbose=True, force=False, threads=1, snpCaller="varscan", bed=None, padding=0):
+    # bed: call SNPs only in the BED entries padded by padding
+    if(snpCaller == "varscan"):
+        varscanSNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, minQual, log, printOnly, verbose, force, threads, bed, padding)
+    else:
+        callSNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, minQual, log, printOnly, verbose, force, threads, bed, padding)
+
+def getMpileupCmd(inputBAM, referenceFile):
+    return getBinary("samtools") + " mpileup -B -A -f " + referenceFile + " " + inputBAM
+
+def getVarscanCmd(minVarFreq, minCov):
+    return "java -jar " + getBinary(varscanJar) + " mpileup2snp  --strand-filter 0 --output-vcf --min-var-freq " + str(minVarFreq) + " --min-coverage " + str(minCov) + " --variants 1"
+
+def splitByChromosome(shards):
+    # Splits shards of regions into shards of regions on one chromosome
+    chromosomeShards = []
+    for shard in shards:
+        chromosomeShard = []
+        for region in shard:
+            if len(chromosomeShard) > 0 and chromosomeShard[0][0] != region[0]:
+                chromosomeShards.append(chromosomeShard)
+                chromosomeShard = []
+            chromosomeShard.append(region)
+        if len(chromosomeShard) > 0:
+            chromosomeShards.append(chromosomeShard)
+    return chromosomeShards
+
+def varscanShard(regions, inputBAM, referenceFile, minVarFreq, minCov, outputSNP):
+    # Calls SNPs in regions of one chromosome with samtools mpileup | VarScan. mpileup
+    # reads the span of the regions (index) and skips positions outside of the regions.
+    # Returns the VCF and stderr files and the return code of VarScan (see runShards)
+    chromosome = regions[0][0]
+    bedFile = getFragmentFile(outputSNP, ".bed")
+    with open(bedFile, "w") as f:
+        for region in regions:
+            print(*region, sep="\t", file=f)
+    
+    fragmentFile = getFragmentFile(outputSNP)
+    logFile = getFragmentFile(outputSNP, ".log")
+    
+    mpileupCmd = getMpileupCmd(inputBAM, referenceFile) + " -r " + chromosome + ":" + str(regions[0][1] + 1) + "-" + str(regions[-1][2]) + " -l " + bedFile
+    with open(fragmentFile, "w") as fileSNP:
+        with open(logFile, "w") as log:
+            mpileup = subprocess.Popen(mpileupCmd, shell=True, stdout=subprocess.PIPE, stderr=log)
+            varscan = subprocess.Popen(getVarscanCmd(minVarFreq, minCov), shell=True, stdin=mpileup.stdout, stdout=fileSNP, stderr=log)
+            mpileup.stdout.close()
+            varscan.wait()
+            mpileup.wait()
+    
+    removeFile(bedFile)
+    return fragmentFile, logFile, varscan.returncode
+
+def mergeVCFs(outputSNP, fragmentFiles):
+    # VCF header of the first fragment and the SNPs of all fragments. Shards are
+    # consecutive regions in BAM order, so the merged SNPs are sorted
+    with open(outputSNP, "w") as fileSNP:
+        for i, fragmentFile in enumerate(fragmentFiles):
+            with open(fragmentFile, "r") as fragment:
+                for line in fragment:
+                    if(i == 0 or not line.startswith("#")):
+                        fileSNP.write(line)
+    removeFile(fragmentFiles)
+
+def varscanShardedSNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, log, pipes, bed, padding):
+    regions = getSNPRegions(inputBAM, bed, padding)
+    shards = splitByChromosome(getSNPShards(inputBAM, regions, bed, pipes)) if len(regions) > 0 else []
+    results = runShards(varscanShard, shards, pipes, inputBAM, referenceFile, minVarFreq, minCov, outputSNP)
+    
+    for _, logFile, _ in results:
+        with open(logFile, "r") as shardLog:
+            log.write(shardLog.read())
+    removeFile([ logFile for _, logFile, _ in results ])
+    
+    fragmentFiles = [ fragmentFile for fragmentFile, _, _ in results ]
+    if(not all([ returncode == 0 for _, _, returncode in results ])):
+        removeFile(fragmentFiles)
+        return False
+    
+    if(len(fragmentFiles) > 0):
+        mergeVCFs(outputSNP, fragmentFiles)
+    else:
+        with open(outputSNP, "w") as fileSNP:
+            printVCFHeader(fileSNP)
+    return True
+
+def varscanSNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, minQual, log, printOnly=False, verbose=True, force=False, threads=1, bed=None, padding=0):
+    # Each samtools mpileup | VarScan pipe uses two threads. With a BED file or more
+    # than one pipe, region shards on one chromosome are called in parallel pipes
+    pipes = max(1, threads // 2)
+    inputFiles = [ inputBAM, referenceFile ] + ([ bed ] if bed != None else [])
+    parameters = [ minVarFreq, minCov, varscanJar ] + ([ padding ] if bed != None else [])
+    if(not checkStep(inputFiles, [outputSNP], force, parameters)):
+        print("Skipping SNP calling", file=log)
+    elif(bed != None or pipes > 1):
+        if(verbose):
+            print(getMpileupCmd(inputBAM, referenceFile) + " -r <region> -l <regions> | " + getVarscanCmd(minVarFreq, minCov) + " (" + str(pipes) + " parallel pipes)", file=log)
+        if(not printOnly):
+            if(varscanShardedSNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, log, pipes, bed, padding)):
+                finishStep([outputSNP])
+            else:
+                print("Error while calling SNPs in " + inputBAM, file=log)
+    else:
         fileSNP = open(outputSNP, 'w')
         
-        mpileupCmd = getBinary("samtools") + " mpileup -B -A -f " + referenceFile + " " + inputBAM
+        mpileupCmd = getMpileupCmd(inputBAM, referenceFile)
         if(verbose):
             print(mpileupCmd, file=log)
         if(not printOnly):
             mpileup = subprocess.Popen(mpileupCmd, shell=True, stdout=subprocess.PIPE, stderr=log)
             
-        varscanCmd = "java -jar " + getBinary("VarScan.v2.4.1.jar") + " mpileup2snp  --strand-filter 0 --output-vcf --min-var-freq " + str(minVarFreq) + " --min-coverage " + str(minCov) + " --variants 1"
+        varscanCmd = getVarscanCmd(minVarFreq, minCov)
         if(verbose):
             print(varscanCmd, file=log)
         if(not printOnly):
@@ -40,8 +271,8 @@ def SNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, minQual, log, p
             varscan.wait()
         
         fileSNP.close()
-    else:
-        print("Skipping SNP calling", file=log)    
+        if(not printOnly and varscan.returncode == 0):
+            finishStep([outputSNP])
         
 def countSNPsInFile(inputFile):
     snpCount = 0
@@ -25,10 +25,11 @@ import os
 import glob
 import numpy as np
 
-from slamdunk.utils.misc import removeExtension, replaceExtension, checkStep, getSampleInfo, complement , getPlotter, callR, SlamSeqInfo  # @UnresolvedImport
-from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile, ReadDirection  # @UnresolvedImport
+from slamdunk.utils.misc import removeExtension, replaceExtension, checkStep, getSampleInfo, getPlotter, callR, SlamSeqInfo, finishStep, getInputFiles  # @UnresolvedImport
+from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile, ReadDirection, BaseCode  # @UnresolvedImport
 from slamdunk.utils import SNPtools  # @UnresolvedImport
-from slamdunk.utils.BedReader import BedIterator  # @UnresolvedImport
+from slamdunk.utils.AnnotationIndex import getAnnotationIndex  # @UnresolvedImport
+from slamdunk.utils.ShardedExecutor import runSharded  # @UnresolvedImport
 
 from slamdunk.version import __version__  # @UnresolvedImport
 
@@ -70,6 +71,11 @@ def sumCounts(countFile, column="ReadCount"):
     
     return sum  
 
+# Number of reads covering each read position (0 - maxReadLength)
+def readsPerReadPos(readLengths, maxReadLength):
+    lengthCounts = np.bincount(readLengths, minlength=maxReadLength + 1)
+    return lengthCounts[::-1].cumsum()[::-1][1:maxReadLength + 1]
+
 # Print rates in correct format for plotting
 def printRates(ratesFwd, ratesRev, f):
     print("\t", end='', file=f)
@@ -82,45 +88,57 @@ def printRates(ratesFwd, ratesRev, f):
             print(str(ratesFwd[i * 5 + j]) + "\t" + str(ratesRev[i * 5 + j]) + "\t", end='', file=f)
         print(file=f)
         
-def statsComputeOverallRates(referenceFile, bam, minBaseQual, outputCSV, outputPDF, log, printOnly=False, verbose=True, force=False):
+def overallRatesShard(chromosomes, referenceFile, bam, minBaseQual):
+    # Conversion rates of all reads on chromosomes (see runSharded)
+    ratesFwd = np.zeros(25, dtype=np.int64)
+    ratesRev = np.zeros(25, dtype=np.int64)
+    
+    testFile = SlamSeqBamFile(bam, referenceFile, None)
+    
+    # Go through one chr after the other
+    for chromosome in chromosomes:
+        batchIterator = testFile.readBatchesInChromosome(chromosome, minBaseQual)
+             
+        for batch in batchIterator:
+             
+            # Add rates from reads to total rates
+            ratesRev += batch.conversionRates[batch.isReverse].sum(axis=0)
+            ratesFwd += batch.conversionRates[~batch.isReverse].sum(axis=0)
+    
+    return ratesFwd, ratesRev
+
+def statsComputeOverallRates(referenceFile, bam, minBaseQual, outputCSV, outputPDF, log, printOnly=False, verbose=True, force=False, threads=1):
      
-    if(not checkStep([bam, referenceFile], [outputCSV], force)):
+    if(not checkStep([bam, referenceFile], [outputCSV], force, [minBaseQual])):
         print("Skipped computing overall rates for file " + bam, file=log)
     else:
         # Init
-        totalRatesFwd = [0] * 25
-        totalRatesRev = [0] * 25
-        tcCount = [0] * 100
+        totalRatesFwd = np.zeros(25, dtype=np.int64)
+        totalRatesRev = np.zeros(25, dtype=np.int64)
          
-        # Go through one chr after the other
-        testFile = SlamSeqBamFile(bam, referenceFile, None)
-         
-        chromosomes = testFile.getChromosomes()
-         
-        for chromosome in chromosomes:
-            readIterator = testFile.readsInChromosome(chromosome, minBaseQual)
-                 
-            for read in readIterator:
-                 
-                # Compute rates for current read
-                rates = read.conversionRates
-                # Get T -> C conversions for current read
-                tc = read.tcCount
-                tcCount[tc] += 1
-                 
-                # Add rates from read to total rates
-                if(read.direction == ReadDirection.Reverse):
-                    totalRatesRev = sumLists(totalRatesRev, rates)
-                else:
-                    totalRatesFwd = sumLists(totalRatesFwd, rates)
+        chromosomes = SlamSeqBamFile(bam, referenceFile, None).getChromosomes()
+        
+        # Chromosome shards are processed in threads processes
+        _, results = runSharded(overallRatesShard, bam, chromosomes, threads, referenceFile, bam, minBaseQual)
+        for ratesFwd, ratesRev in results:
+            totalRatesFwd += ratesFwd
+            totalRatesRev += ratesRev
               
-        # Print rates in correct format for plotting
-        fo = open(outputCSV, "w")
-        print("# slamdunk rates v" + __version__, file=fo)
-        printRates(totalRatesFwd, totalRatesRev, fo)
-        fo.close()
+        writeOverallRates(outputCSV, totalRatesFwd, totalRatesRev)
+        finishStep([outputCSV])
+     
+    plotOverallRates(bam, outputCSV, outputPDF, log, printOnly, verbose, force)
+
+def writeOverallRates(outputCSV, ratesFwd, ratesRev):
+    # Print rates in correct format for plotting
+    fo = open(outputCSV, "w")
+    print("# slamdunk rates v" + __version__, file=fo)
+    printRates(ratesFwd, ratesRev, fo)
+    fo.close()
+
+def plotOverallRates(bam, outputCSV, outputPDF, log, printOnly=False, verbose=True, force=False):
      
-    if(not checkStep([bam, referenceFile], [outputPDF], force)):
+    if(not checkStep([outputCSV], [outputPDF], force)):
         print("Skipped computing overall rate pdfs for file " + bam, file=log)
     else:
 
@@ -129,6 +147,8 @@ def statsComputeOverallRates(referenceFile, bam, minBaseQual, outputCSV, outputP
         #f.close()
              
         callR(getPlotter("compute_overall_rates") + " -f " + outputCSV + " -n " + removeExtension(os.path.basename(bam)) + " -O " + outputPDF, log, dry=printOnly, verbose=verbose)
+        if(not printOnly):
+            finishStep([outputPDF])
 
 # This is for TC conversions
     
@@ -223,102 +243,154 @@ def statsComputeOverallRates(referenceFile, bam, minBaseQual, outputCSV, outputP
  
 # This is for Ts in reads
 
-def statsComputeTCContext(referenceFile, bam, minBaseQual, outputCSV, outputPDF, log, printOnly=False, verbose=True, force=False):
+# combinations = ["AT","CT","GT","TT","NT","AA","CA","GA","TA","NA"]
+frontCombinations = ["AT", "CT", "GT", "TT", "NT"]
+backCombinations = ["TA", "TC", "TG", "TT", "TN"]
+
+def getTCContextCounts():
+    counts = {}
+    counts['5prime'] = {}
+    counts['3prime'] = {}
+    counts['5prime']['fwd'] = {}
+    counts['5prime']['rev'] = {}
+    counts['3prime']['fwd'] = {}
+    counts['3prime']['rev'] = {}
      
-    if(not checkStep([bam, referenceFile], [outputCSV], force)):
+    for combination in frontCombinations :
+        counts['5prime']['fwd'][combination] = 0
+        counts['5prime']['rev'][combination] = 0
+         
+    for combination in backCombinations:
+        counts['3prime']['fwd'][combination] = 0
+        counts['3prime']['rev'][combination] = 0
+    return counts
+
+# Base codes for context counting in the order of frontCombinations and
+# backCombinations: A = 0, C = 1, G = 2, T = 3, N = 4 (5 = no base, e.g. the
+# separator between two reads)
+contextBaseLookup = np.full(256, 5, dtype=np.uint8)
+contextBaseLookup[np.frombuffer(b"ACGTN", dtype=np.uint8)] = np.arange(5)
+# Code of the complementary base
+contextComplement = np.array([ 3, 2, 1, 0, 4 ])
+
+contextBatchSize = 100000
+
+def countNeighbours(sequences, base):
+    # Counts of the bases before and after base in sequences. Sequences are
+    # joined by a separator, so pairs of adjacent codes never span two reads
+    codes = contextBaseLookup[np.frombuffer("|".join(sequences).encode("ascii"), dtype=np.uint8)]
+    previous = codes[:-1]
+    current = codes[1:]
+    before = np.bincount(previous[(current == base) & (previous < 5)], minlength=5)
+    after = np.bincount(current[(previous == base) & (current < 5)], minlength=5)
+    return before, after
+
+def addTCContextBatch(counts, forwardSequences, reverseSequences):
+    # Forward reads: bases before (5') and after (3') every T
+    before, after = countNeighbours(forwardSequences, 3)
+    for code, combination in enumerate(frontCombinations):
+        counts['5prime']['fwd'][combination] += int(before[code])
+    for code, combination in enumerate(backCombinations):
+        counts['3prime']['fwd'][combination] += int(after[code])
+    
+    # Reverse reads: complement of the bases after (5') and before (3') every A
+    before, after = countNeighbours(reverseSequences, 0)
+    for code, combination in enumerate(frontCombinations):
+        counts['5prime']['rev'][combination] += int(after[contextComplement[code]])
+    for code, combination in enumerate(backCombinations):
+        counts['3prime']['rev'][combination] += int(before[contextComplement[code]])
+
+def addTCContextCounts(counts, reads):
+    # Adds the T contexts of reads (pysam reads) to counts, contextBatchSize
+    # reads at a time
+    forwardSequences = []
+    reverseSequences = []
+    for read in reads:
+        if read.query_sequence == None:
+            continue
+        if read.is_reverse:
+            reverseSequences.append(read.query_sequence)
+        else:
+            forwardSequences.append(read.query_sequence)
+        
+        if len(forwardSequences) + len(reverseSequences) >= contextBatchSize:
+            addTCContextBatch(counts, forwardSequences, reverseSequences)
+            forwardSequences = []
+            reverseSequences = []
+    
+    if len(forwardSequences) + len(reverseSequences) > 0:
+        addTCContextBatch(counts, forwardSequences, reverseSequences)
+
+def mergeTCContextCounts(counts, otherCounts):
+    for end in otherCounts:
+        for direction in otherCounts[end]:
+            for combination in otherCounts[end][direction]:
+                counts[end][direction][combination] += otherCounts[end][direction][combination]
+
+def tcContextShard(chromosomes, bam):
+    # T context counts of all reads on chromosomes (see runSharded)
+    counts = getTCContextCounts()
+         
+    bamFile = pysam.AlignmentFile(bam, "rb")
+     
+    # Go through one chr after the other
+    for chromosome in chromosomes:
+        addTCContextCounts(counts, bamFile.fetch(region=chromosome))
+    bamFile.close()
+    return counts
+
+def statsComputeTCContext(referenceFile, bam, minBaseQual, outputCSV, outputPDF, log, printOnly=False, verbose=True, force=False, threads=1):
+     
+    if(not checkStep([bam, referenceFile], [outputCSV], force, [minBaseQual])):
         print("Skipped computing overall rates for file " + bam, file=log)
     else:
         # Init
-        # combinations = ["AT","CT","GT","TT","NT","AA","CA","GA","TA","NA"]
-        frontCombinations = ["AT", "CT", "GT", "TT", "NT"]
-        backCombinations = ["TA", "TC", "TG", "TT", "TN"]
-         
-        counts = {}
-        counts['5prime'] = {}
-        counts['3prime'] = {}
-        counts['5prime']['fwd'] = {}
-        counts['5prime']['rev'] = {}
-        counts['3prime']['fwd'] = {}
-        counts['3prime']['rev'] = {}
-         
-        for combination in frontCombinations :
-            counts['5prime']['fwd'][combination] = 0
-            counts['5prime']['rev'][combination] = 0
-             
-        for combination in backCombinations:
-            counts['3prime']['fwd'][combination] = 0
-            counts['3prime']['rev'][combination] = 0
-             
-        bamFile = pysam.AlignmentFile(bam, "rb")
-         
-        # Go through one chr after the other
-        testFile = SlamSeqBamFile(bam, referenceFile, None)
-         
-        chromosomes = testFile.getChromosomes()
-         
-        for chromosome in chromosomes:
-                 
-            for read in bamFile.fetch(region=chromosome):
-                 
-                i = 0
-                while i < len(read.query_sequence):
-                    if(read.query_sequence[i] == "T" and not read.is_reverse) :
-                        frontContext = None
-                        backContext = None
-                        if (i > 0) :
-                            frontContext = read.query_sequence[i - 1]
-                        if (i < (len(read.query_sequence) - 1)) :
-                            backContext  = read.query_sequence[i + 1]
-                         
-                        if (frontContext != None) :
-                            counts['5prime']['fwd'][frontContext + "T"] += 1
-                        if (backContext != None) :
-                            counts['3prime']['fwd']["T" + backContext] += 1
-                             
-                    if(read.query_sequence[i] == "A" and read.is_reverse) :
-                        frontContext = None
-                        backContext = None
-                        if (i > 0) :
-                            backContext = read.query_sequence[i - 1]
-                        if (i < (len(read.query_sequence) - 1)) :
-                            frontContext  = read.query_sequence[i + 1]
-                         
-                        if (frontContext != None) :
-                            counts['5prime']['rev'][complement(frontContext + "A")] += 1
-                        if (backContext != None) :
-                            counts['3prime']['rev'][complement("A" + backContext)] += 1
-                     
-                    i += 1
-         
-        # Print rates in correct format for plotting
-        fo = open(outputCSV, "w")
+        counts = getTCContextCounts()
          
-        print("\t".join(frontCombinations), file=fo)
-         
-        frontFwdLine = ""
-        frontRevLine = ""
-        backFwdLine = ""
-        backRevLine = ""
-         
-        for combination in frontCombinations :
-            frontFwdLine += str(counts['5prime']['fwd'][combination]) + "\t"
-            frontRevLine += str(counts['5prime']['rev'][combination]) + "\t"
-         
-        print(frontFwdLine.rstrip(), file=fo)
-        print(frontRevLine.rstrip(), file=fo)
+        chromosomes = SlamSeqBamFile(bam, referenceFile, None).getChromosomes()
+        
+        # Chromosome shards are processed in threads processes
+        _, results = runSharded(tcContextShard, bam, chromosomes, threads, bam)
+        for shardCounts in results:
+            mergeTCContextCounts(counts, shardCounts)
          
-        print("\t".join(backCombinations), file=fo)
+        writeTCContext(outputCSV, counts)
+        finishStep([outputCSV])
+     
+    plotTCContext(bam, outputCSV, outputPDF, log, printOnly, verbose, force)
+
+def writeTCContext(outputCSV, counts):
+    # Print rates in correct format for plotting
+    fo = open(outputCSV, "w")
+     
+    print("\t".join(frontCombinations), file=fo)
+     
+    frontFwdLine = ""
+    frontRevLine = ""
+    backFwdLine = ""
+    backRevLine = ""
+     
+    for combination in frontCombinations :
+        frontFwdLine += str(counts['5prime']['fwd'][combination]) + "\t"
+        frontRevLine += str(counts['5prime']['rev'][combination]) + "\t"
+     
+    print(frontFwdLine.rstrip(), file=fo)
+    print(frontRevLine.rstrip(), file=fo)
+     
+    print("\t".join(backCombinations), file=fo)
  
-        for combination in backCombinations :
-            backFwdLine += str(counts['3prime']['fwd'][combination]) + "\t"
-            backRevLine += str(counts['3prime']['rev'][combination]) + "\t"
+    for combination in backCombinations :
+        backFwdLine += str(counts['3prime']['fwd'][combination]) + "\t"
+        backRevLine += str(counts['3prime']['rev'][combination]) + "\t"
  
-        print(backFwdLine.rstrip(), file=fo)
-        print(backRevLine.rstrip(), file=fo)
-         
-        fo.close()
+    print(backFwdLine.rstrip(), file=fo)
+    print(backRevLine.rstrip(), file=fo)
+     
+    fo.close()
+
+def plotTCContext(bam, outputCSV, outputPDF, log, printOnly=False, verbose=True, force=False):
      
-    if(not checkStep([bam, referenceFile], [outputPDF], force)):
+    if(not checkStep([outputCSV], [outputPDF], force)):
         print("Skipped computing overall rate pdfs for file " + bam, file=log)
     else:
         f = tempfile.NamedTemporaryFile(delete=False)
@@ -326,38 +398,29 @@ def statsComputeTCContext(referenceFile, bam, minBaseQual, outputCSV, outputPDF,
         f.close()
          
         callR(getPlotter("compute_context_TC_rates") + " -f " + f.name + " -O " + outputPDF, log, dry=printOnly, verbose=verbose)
+        if(not printOnly):
+            finishStep([outputPDF])
         
 
 def statsComputeOverallRatesPerUTR(referenceFile, bam, minBaseQual, strictTCs, outputCSV, outputPDF, utrBed, maxReadLength, log, printOnly=False, verbose=True, force=False):
     
-    sampleInfo = getSampleInfo(bam)
-    
-    slamseqInfo = SlamSeqInfo(bam)
-    
-    if(not checkStep([bam, referenceFile], [outputCSV], force)):
+    if(not checkStep([bam, referenceFile, utrBed], [outputCSV], force, [minBaseQual, strictTCs, maxReadLength])):
         print("Skipped computing overall rates for file " + bam, file=log)
     else:
     
         # Go through one chr after the other
         testFile = SlamSeqBamFile(bam, referenceFile, None)
         
-        # UTR stats for MultiQC
-        utrStats = dict()
-        
-        plotConversions = ['A>T', 'A>G', 'A>C',
-                           'C>A', 'C>G', 'C>T',
-                           'G>A', 'G>C', 'G>T',
-                           'T>A', 'T>G', 'T>C',
-        ]
-        
-        for conversion in plotConversions:
-            utrStats[conversion] = list()
-            
-        f = tempfile.NamedTemporaryFile(delete=False)
+        # Rates and read counts of all UTRs
+        utrs = []
+        utrRates = []
+        utrReadCounts = []
                         
-        for utr in BedIterator(utrBed):
+        annotation = getAnnotationIndex(utrBed, referenceFile, maxReadLength)
+        for index in xrange(0, len(annotation)):
+            utr = annotation.getEntry(index)
                                          
-            readIterator = testFile.readInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, maxReadLength, minBaseQual)
+            readIterator = testFile.readInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, maxReadLength, minBaseQual, refSeq=annotation.getSequence(index))
             
             # Init
             totalRates = [0] * 25
@@ -376,149 +439,182 @@ def statsComputeOverallRatesPerUTR(referenceFile, bam, minBaseQual, strictTCs, o
                     totalRates = sumLists(totalRates, rates)
                     readCount += 1
                     
-            print(utr.name, utr.chromosome, utr.start, utr.stop, utr.strand, readCount, "\t".join(str(x) for x in totalRates), sep="\t", file=f)
-            
-            # Process rates for MultiQC
-            # Copied directly, too lazy to do it properly now
-            
-            utrDict = {}
-            
-            conversionSum = 0
-            
-            A_A = totalRates[0]
-            conversionSum =+ A_A
-            A_C = totalRates[1]
-            conversionSum =+ A_C
-            A_G = totalRates[2]
-            conversionSum =+ A_G
-            A_T = totalRates[3]
-            conversionSum =+ A_T
-            
-            C_A = totalRates[5]
-            conversionSum =+ C_A
-            C_C = totalRates[6]
-            conversionSum =+ C_C
-            C_G = totalRates[7]
-            conversionSum =+ C_G
-            C_T = totalRates[8]
-            conversionSum =+ C_T
+            utrs.append(utr)
+            utrRates.append(totalRates)
+            utrReadCounts.append(readCount)
             
-            G_A = totalRates[10]
-            conversionSum =+ G_A
-            G_C = totalRates[11]
-            conversionSum =+ G_C
-            G_G = totalRates[12]
-            conversionSum =+ G_G
-            G_T = totalRates[13]
-            conversionSum =+ G_T
-            
-            T_A = totalRates[15]
-            conversionSum =+ T_A
-            T_C = totalRates[16]
-            conversionSum =+ T_C
-            T_G = totalRates[17]
-            conversionSum =+ T_G
-            T_T = totalRates[18]
-            conversionSum =+ T_T
-            
-            if utr.strand == "-":
-                    
-                A_A, T_T = T_T,A_A
-                G_G, C_C = C_C,G_G
-                A_C, T_G = T_G, A_C
-                A_G, T_C = T_C, A_G
-                A_T, T_A = T_A, A_T
-                C_A, G_T = G_T, C_A
-                C_G, G_C = G_C, C_G
-                C_T, G_A = G_A, C_T
-            
-            if conversionSum > 0:
-                        
-                Asum = A_A + A_C + A_G + A_T
-                Csum = C_A + C_C + C_G + C_T
-                Gsum = G_A + G_C + G_G + G_T
-                Tsum = T_A + T_C + T_G + T_T
-                 
-                if Asum > 0 :
-                    A_T = A_T / float(Asum) * 100
-                    A_G = A_G / float(Asum) * 100
-                    A_C = A_C / float(Asum) * 100
-                else :
-                    A_T = 0
-                    A_G = 0
-                    A_C = 0
-                if Csum > 0:
-                    C_A = C_A / float(Csum) * 100
-                    C_G = C_G / float(Csum) * 100
-                    C_T = C_T / float(Csum) * 100
-                else :
-                    C_A = 0
-                    C_G = 0
-                    C_T = 0
-                if Gsum > 0:
-                    G_A = G_A / float(Gsum) * 100
-                    G_C = G_C / float(Gsum) * 100
-                    G_T = G_T / float(Gsum) * 100
-                else :
-                    G_A = 0
-                    G_C = 0
-                    G_T = 0
-                if Tsum > 0:
-                    T_A = T_A / float(Tsum) * 100
-                    T_G = T_G / float(Tsum) * 100
-                    T_C = T_C / float(Tsum) * 100
-                else :
-                    T_A = 0
-                    T_G = 0
-                    T_C = 0
-                   
-                utrStats['A>T'].append(A_T)
-                utrStats['A>G'].append(A_G)
-                utrStats['A>C'].append(A_C)
-                
-                utrStats['C>A'].append(C_A)
-                utrStats['C>G'].append(C_G)
-                utrStats['C>T'].append(C_T)
-                
-                utrStats['G>A'].append(G_A)
-                utrStats['G>T'].append(G_T)
-                utrStats['G>C'].append(G_C)
-                
-                utrStats['T>A'].append(T_A)
-                utrStats['T>G'].append(T_G)
-                utrStats['T>C'].append(T_C)        
+        writeUtrRates(outputCSV, utrs, utrRates, utrReadCounts)
+        finishStep([outputCSV])
                 
-        f.close()
+    plotUtrRates(bam, outputCSV, outputPDF, log, printOnly, verbose, force)
+
+def writeUtrRates(outputCSV, utrs, allUtrRates, utrReadCounts):
+    # allUtrRates: summed conversion rates of the reads of each UTR
+    
+    # UTR stats for MultiQC
+    utrStats = dict()
+    
+    plotConversions = ['A>T', 'A>G', 'A>C',
+                       'C>A', 'C>G', 'C>T',
+                       'G>A', 'G>C', 'G>T',
+                       'T>A', 'T>G', 'T>C',
+    ]
+    
+    for conversion in plotConversions:
+        utrStats[conversion] = list()
+        
+    f = tempfile.NamedTemporaryFile(delete=False)
+    
+    for utr, utrRates, readCount in zip(utrs, allUtrRates, utrReadCounts):
         
-        fo = open(outputCSV, "w")
+        print(utr.name, utr.chromosome, utr.start, utr.stop, utr.strand, readCount, "\t".join(str(x) for x in utrRates), sep="\t", file=f)
         
-        print("# slamdunk utrrates v" + __version__, file=fo)
+        # Process rates for MultiQC
+        # Copied directly, too lazy to do it properly now
         
-        print("# Median-Conversions=",end="",file=fo)
+        utrDict = {}
         
-        first = True
-        for conversion in plotConversions:
-            if (not first) :
-                print(',',file=fo, end="")
-            else :
-                first = False
-            print(conversion + ":" + str(np.median(utrStats[conversion])),file=fo, end="")
-        print(file=fo) 
-        
-        print("Name", "Chr", "Start", "End", "Strand", "ReadCount", sep="\t", end="\t", file=fo)
-        for i in range(0, 5):
-            for j in range(0, 5):
-                print(toBase[i].upper() + "_" + toBase[j].upper(), end="", file=fo)
-                if(i != 4 or j != 4):
-                    print("\t", end="", file=fo)
-        print(file=fo)
-        
-        with open(f.name, "rb") as valueFile:
-            fo.write(valueFile.read())
-        
-        fo.close()
+        conversionSum = 0
+        
+        A_A = utrRates[0]
+        conversionSum =+ A_A
+        A_C = utrRates[1]
+        conversionSum =+ A_C
+        A_G = utrRates[2]
+        conversionSum =+ A_G
+        A_T = utrRates[3]
+        conversionSum =+ A_T
+        
+        C_A = utrRates[5]
+        conversionSum =+ C_A
+        C_C = utrRates[6]
+        conversionSum =+ C_C
+        C_G = utrRates[7]
+        conversionSum =+ C_G
+        C_T = utrRates[8]
+        conversionSum =+ C_T
+        
+        G_A = utrRates[10]
+        conversionSum =+ G_A
+        G_C = utrRates[11]
+        conversionSum =+ G_C
+        G_G = utrRates[12]
+        conversionSum =+ G_G
+        G_T = utrRates[13]
+        conversionSum =+ G_T
+        
+        T_A = utrRates[15]
+        conversionSum =+ T_A
+        T_C = utrRates[16]
+        conversionSum =+ T_C
+        T_G = utrRates[17]
+        conversionSum =+ T_G
+        T_T = utrRates[18]
+        conversionSum =+ T_T
+        
+        if utr.strand == "-":
                 
-    if(not checkStep([bam, referenceFile], [outputPDF], force)):
+            A_A, T_T = T_T,A_A
+            G_G, C_C = C_C,G_G
+            A_C, T_G = T_G, A_C
+            A_G, T_C = T_C, A_G
+            A_T, T_A = T_A, A_T
+            C_A, G_T = G_T, C_A
+            C_G, G_C = G_C, C_G
+            C_T, G_A = G_A, C_T
+        
+        if conversionSum > 0:
+                    
+            Asum = A_A + A_C + A_G + A_T
+            Csum = C_A + C_C + C_G + C_T
+            Gsum = G_A + G_C + G_G + G_T
+            Tsum = T_A + T_C + T_G + T_T
+             
+            if Asum > 0 :
+                A_T = A_T / float(Asum) * 100
+                A_G = A_G / float(Asum) * 100
+                A_C = A_C / float(Asum) * 100
+            else :
+                A_T = 0
+                A_G = 0
+                A_C = 0
+            if Csum > 0:
+                C_A = C_A / float(Csum) * 100
+                C_G = C_G / float(Csum) * 100
+                C_T = C_T / float(Csum) * 100
+            else :
+                C_A = 0
+                C_G = 0
+                C_T = 0
+            if Gsum > 0:
+                G_A = G_A / float(Gsum) * 100
+                G_C = G_C / float(Gsum) * 100
+                G_T = G_T / float(Gsum) * 100
+            else :
+                G_A = 0
+                G_C = 0
+                G_T = 0
+            if Tsum > 0:
+                T_A = T_A / float(Tsum) * 100
+                T_G = T_G / float(Tsum) * 100
+                T_C = T_C / float(Tsum) * 100
+            else :
+                T_A = 0
+                T_G = 0
+                T_C = 0
+               
+            utrStats['A>T'].append(A_T)
+            utrStats['A>G'].append(A_G)
+            utrStats['A>C'].append(A_C)
+            
+            utrStats['C>A'].append(C_A)
+            utrStats['C>G'].append(C_G)
+            utrStats['C>T'].append(C_T)
+            
+            utrStats['G>A'].append(G_A)
+            utrStats['G>T'].append(G_T)
+            utrStats['G>C'].append(G_C)
+            
+            utrStats['T>A'].append(T_A)
+            utrStats['T>G'].append(T_G)
+            utrStats['T>C'].append(T_C)        
+            
+    f.close()
+    
+    fo = open(outputCSV, "w")
+    
+    print("# slamdunk utrrates v" + __version__, file=fo)
+    
+    print("# Median-Conversions=",end="",file=fo)
+    
+    first = True
+    for conversion in plotConversions:
+        if (not first) :
+            print(',',file=fo, end="")
+        else :
+            first = False
+        print(conversion + ":" + str(np.median(utrStats[conversion])),file=fo, end="")
+    print(file=fo) 
+    
+    print("Name", "Chr", "Start", "End", "Strand", "ReadCount", sep="\t", end="\t", file=fo)
+    for i in range(0, 5):
+        for j in range(0, 5):
+            print(toBase[i].upper() + "_" + toBase[j].upper(), end="", file=fo)
+            if(i != 4 or j != 4):
+                print("\t", end="", file=fo)
+    print(file=fo)
+    
+    with open(f.name, "rb") as valueFile:
+        fo.write(valueFile.read())
+    
+    fo.close()
+    os.unlink(f.name)
+
+def plotUtrRates(bam, outputCSV, outputPDF, log, printOnly=False, verbose=True, force=False):
+    
+    sampleInfo = getSampleInfo(bam)
+    
+    if(not checkStep([outputCSV], [outputPDF], force)):
         print("Skipped computing global rate pdfs for file " + bam, file=log)
     else:
         f = tempfile.NamedTemporaryFile(delete=False)
@@ -526,6 +622,8 @@ def statsComputeOverallRatesPerUTR(referenceFile, bam, minBaseQual, strictTCs, o
         f.close()
               
         callR(getPlotter("globalRatePlotter") + " -f " + f.name + " -O " + outputPDF, log, dry=printOnly, verbose=verbose)
+        if(not printOnly):
+            finishStep([outputPDF])
            
     
 def readSummary(filteredFiles, countDirectory, outputFile, log, printOnly=False, verbose=True, force=False):
@@ -588,76 +686,83 @@ def readSummary(filteredFiles, countDirectory, outputFile, log, printOnly=False,
         
     tsvFile.close()
              
-def tcPerReadPos(referenceFile, bam, minQual, maxReadLength, outputCSV, outputPDF, snpsFile, log, printOnly=False, verbose=True, force=False):
+def addTcPerReadPosCounts(counts, batch):
+    # Adds the per read position counts of a SlamSeqReadBatch to counts (rows:
+    # allPerPosFwd, allPerPosRev, tcPerPosFwd, tcPerPosRev, totalReadCountFwd
+    # and totalReadCountRev, one column per read position)
+    maxReadLength = counts.shape[1]
+    allPerPosFwd, allPerPosRev, tcPerPosFwd, tcPerPosRev, totalReadCountFwd, totalReadCountRev = counts
+    
+    if (batch.readLength.max() > maxReadLength) :
+        raise RuntimeError("Found read longer than maximum read length (" + str(batch.readLength.max()) + " > " + str(maxReadLength) + "). Please specify --max-read-length parameter.")
+    
+    mismatchIsReverse = batch.isReverse[batch.getMismatchReadIndex()]
+    
+    tcPerPosRev += np.bincount(batch.mismatchReadPos[mismatchIsReverse & batch.mismatchIsTc], minlength=maxReadLength)
+    allPerPosRev += np.bincount(batch.mismatchReadPos[mismatchIsReverse & ~batch.mismatchIsTc], minlength=maxReadLength)
+    tcPerPosFwd += np.bincount(batch.mismatchReadPos[~mismatchIsReverse & batch.mismatchIsTc], minlength=maxReadLength)
+    allPerPosFwd += np.bincount(batch.mismatchReadPos[~mismatchIsReverse & ~batch.mismatchIsTc], minlength=maxReadLength)
+    
+    totalReadCountRev += readsPerReadPos(batch.readLength[batch.isReverse], maxReadLength)
+    totalReadCountFwd += readsPerReadPos(batch.readLength[~batch.isReverse], maxReadLength)
+
+def tcPerReadPosShard(chromosomes, referenceFile, bam, minQual, maxReadLength, snpsFile):
+    # Per read position counts of all reads on chromosomes (see runSharded
+    # and addTcPerReadPosCounts)
+    counts = np.zeros((6, maxReadLength), dtype=np.int64)
+    
+    snps = SNPtools.SNPDictionary(snpsFile)
+    snps.read()
+    
+    testFile = SlamSeqBamFile(bam, referenceFile, snps)
     
-    if(not checkStep([bam, referenceFile], [outputCSV], force)):
+    # Go through one chr after the other
+    for chromosome in chromosomes:
+        batchIterator = testFile.readBatchesInChromosome(chromosome, minQual)
+            
+        for batch in batchIterator:
+            addTcPerReadPosCounts(counts, batch)
+    
+    return counts
+
+def tcPerReadPos(referenceFile, bam, minQual, maxReadLength, outputCSV, outputPDF, snpsFile, log, printOnly=False, verbose=True, force=False, threads=1):
+    
+    if(not checkStep(getInputFiles(bam, referenceFile, snpsFile), [outputCSV], force, [minQual, maxReadLength])):
         print("Skipped computing T->C per reads position for file " + bam, file=log)
     else:
         
-        totalReadCountFwd = [0] * maxReadLength
-        totalReadCountRev = [0] * maxReadLength
+        chromosomes = SlamSeqBamFile(bam, referenceFile, None).getChromosomes()
         
-        tcPerPosRev = [0] * maxReadLength
-        tcPerPosFwd = [0] * maxReadLength
-        
-        allPerPosRev = [0] * maxReadLength
-        allPerPosFwd = [0] * maxReadLength
+        # Chromosome shards are processed in threads processes
+        _, results = runSharded(tcPerReadPosShard, bam, chromosomes, threads, referenceFile, bam, minQual, maxReadLength, snpsFile)
+        writeTcPerReadPos(outputCSV, np.sum(results, axis=0))
+        finishStep([outputCSV])
+       
+    plotTcPerReadPos(bam, outputCSV, outputPDF, log, printOnly, verbose, force)
 
-        
-        snps = SNPtools.SNPDictionary(snpsFile)
-        snps.read()
-        
-        # Go through one chr after the other
-        testFile = SlamSeqBamFile(bam, referenceFile, snps)
-        
-        chromosomes = testFile.getChromosomes()
-        
-        for chromosome in chromosomes:
-            readIterator = testFile.readsInChromosome(chromosome, minQual)
-                
-            for read in readIterator:
-                
-                tcCounts = [0] * maxReadLength
-                mutCounts = [0] * maxReadLength
-                
-                for mismatch in read.mismatches:
-                    if(mismatch.isTCMismatch(read.direction == ReadDirection.Reverse)):
-                        tcCounts[mismatch.readPosition] += 1
-                    else :
-                        mutCounts[mismatch.readPosition] += 1
-                        
-                
-                query_length = len(read.sequence)
-                if(read.direction == ReadDirection.Reverse):
-                    tcPerPosRev = sumLists(tcPerPosRev, tcCounts)
-                    allPerPosRev = sumLists(allPerPosRev, mutCounts)
-                    
-                    for i in range(0, query_length):
-                        totalReadCountRev[i] += 1
-                else:
-                    tcPerPosFwd = sumLists(tcPerPosFwd, tcCounts)
-                    allPerPosFwd = sumLists(allPerPosFwd, mutCounts)
-                    
-                    for i in range(0, query_length):
-                        totalReadCountFwd[i] += 1
-                        
+def writeTcPerReadPos(outputCSV, counts):
+    allPerPosFwd, allPerPosRev, tcPerPosFwd, tcPerPosRev, totalReadCountFwd, totalReadCountRev = counts
 
-        foTC = open(outputCSV, "w")
-        
-        print("# slamdunk tcperreadpos v" + __version__, file=foTC)
-        
-        for i in range(0, maxReadLength):
-            print(allPerPosFwd[i], allPerPosRev[i], tcPerPosFwd[i], tcPerPosRev[i], totalReadCountFwd[i], totalReadCountRev[i], sep='\t', file=foTC)
-        foTC.close()
+    foTC = open(outputCSV, "w")
+    
+    print("# slamdunk tcperreadpos v" + __version__, file=foTC)
+    
+    for i in range(0, counts.shape[1]):
+        print(allPerPosFwd[i], allPerPosRev[i], tcPerPosFwd[i], tcPerPosRev[i], totalReadCountFwd[i], totalReadCountRev[i], sep='\t', file=foTC)
+    foTC.close()
+
+def plotTcPerReadPos(bam, outputCSV, outputPDF, log, printOnly=False, verbose=True, force=False):
        
     if(not checkStep([outputCSV], [outputPDF], force)):
         print("Skipped computing T->C per reads position plot for file " + bam, file=log)
     else: 
         callR(getPlotter("conversion_per_read_position") + " -i " + outputCSV + " -o " + outputPDF, log, dry=printOnly, verbose=verbose)
+        if(not printOnly):
+            finishStep([outputPDF])
         
 def tcPerUtr(referenceFile, utrBed, bam, minQual, maxReadLength, outputCSV, outputPDF, snpsFile, log, printOnly=False, verbose=True, force=False):
         
-    if(not checkStep([bam, referenceFile], [outputCSV], force)):
+    if(not checkStep(getInputFiles(bam, referenceFile, snpsFile) + [utrBed], [outputCSV], force, [minQual, maxReadLength])):
         print("Skipped computing T->C per UTR position for file " + bam, file=log)
     else:
     
@@ -678,9 +783,11 @@ def tcPerUtr(referenceFile, utrBed, bam, minQual, maxReadLength, outputCSV, outp
         # Go through one utr after the other
         testFile = SlamSeqBamFile(bam, referenceFile, snps)
         
-        for utr in BedIterator(utrBed):
+        annotation = getAnnotationIndex(utrBed, referenceFile, maxReadLength)
+        for index in xrange(0, len(annotation)):
+            utr = annotation.getEntry(index)
                                          
-            readIterator = testFile.readInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, maxReadLength, minQual)
+            readIterator = testFile.readInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, maxReadLength, minQual, refSeq=annotation.getSequence(index))
             
             tcForwardCounts = [0] * utrNormFactor
             mutForwardCounts = [0] * utrNormFactor
@@ -752,26 +859,126 @@ def tcPerUtr(referenceFile, utrBed, bam, minQual, maxReadLength, outputCSV, outp
             if (verbose and counter % 10000 == 0) :
                 print("Handled " + str(counter) + " UTRs.", file=log)
     
-        foTC = open(outputCSV, "w")
-        
-        print("# slamdunk tcperutr v" + __version__, file=foTC)
-        
-        reverseAllPerPosRev = allPerPosRev[::-1]
-        reverseTcPerPosRev = tcPerPosRev[::-1]
-        reverseTotalUtrCountRev = totalUtrCountRev[::-1]
+        writeTcPerUtr(outputCSV, [ allPerPosFwd, allPerPosRev, tcPerPosFwd, tcPerPosRev, totalUtrCountFwd, totalUtrCountRev ])
+        finishStep([outputCSV])
+       
+    plotTcPerUtr(bam, outputCSV, outputPDF, log, printOnly, verbose, force)
 
-        for i in range(0, utrNormFactor):
-            print(allPerPosFwd[i], reverseAllPerPosRev[i], tcPerPosFwd[i], reverseTcPerPosRev[i], totalUtrCountFwd[i], reverseTotalUtrCountRev[i], sep='\t', file=foTC)
-        foTC.close()
+def addTcPerUtrCounts(counts, batch, utr):
+    # Same as the read loop of tcPerUtr for a SlamSeqReadBatch of the reads in
+    # utr (positions relative to the UTR start). counts has the rows
+    # allPerPosFwd, allPerPosRev, tcPerPosFwd, tcPerPosRev, totalUtrCountFwd
+    # and totalUtrCountRev (utrNormFactor columns)
+    allPerPosFwd, allPerPosRev, tcPerPosFwd, tcPerPosRev, totalUtrCountFwd, totalUtrCountRev = counts
+    utrLength = utr.getLength()
+    
+    mismatchPos = batch.mismatchRefPos
+    mismatchIsReverse = batch.isReverse[batch.getMismatchReadIndex()]
+    if (utr.strand == "+") :
+        inUtr = (mismatchPos >= (utrLength - utrNormFactor)) & (mismatchPos < utrLength)
+        mismatchPos = utrNormFactor - (utrLength - mismatchPos)
+    else :
+        inUtr = (mismatchPos >= 0) & (mismatchPos < min(utrLength, utrNormFactor))
+    
+    tcPerPosFwd += np.bincount(mismatchPos[inUtr & ~mismatchIsReverse & batch.mismatchIsTc], minlength=utrNormFactor)
+    allPerPosFwd += np.bincount(mismatchPos[inUtr & ~mismatchIsReverse & ~batch.mismatchIsTc], minlength=utrNormFactor)
+    tcPerPosRev += np.bincount(mismatchPos[inUtr & mismatchIsReverse & batch.mismatchIsTc], minlength=utrNormFactor)
+    allPerPosRev += np.bincount(mismatchPos[inUtr & mismatchIsReverse & ~batch.mismatchIsTc], minlength=utrNormFactor)
+    
+    # Coverage of the first (reverse reads) or last (forward reads) utrNormFactor
+    # positions of the UTR: +1 at the first and -1 after the last covered position
+    start = np.clip(batch.startRefPos[batch.isReverse], 0, min(utrLength, utrNormFactor))
+    end = np.clip(batch.endRefPos[batch.isReverse], 0, min(utrLength, utrNormFactor))
+    covered = start < end
+    totalUtrCountRev += np.cumsum(np.bincount(start[covered], minlength=utrNormFactor + 1) - np.bincount(end[covered], minlength=utrNormFactor + 1))[:utrNormFactor]
+    
+    start = np.clip(batch.startRefPos[~batch.isReverse], utrLength - utrNormFactor, utrLength) - (utrLength - utrNormFactor)
+    end = np.clip(batch.endRefPos[~batch.isReverse], utrLength - utrNormFactor, utrLength) - (utrLength - utrNormFactor)
+    covered = start < end
+    totalUtrCountFwd += np.cumsum(np.bincount(start[covered], minlength=utrNormFactor + 1) - np.bincount(end[covered], minlength=utrNormFactor + 1))[:utrNormFactor]
+
+def writeTcPerUtr(outputCSV, counts):
+    allPerPosFwd, allPerPosRev, tcPerPosFwd, tcPerPosRev, totalUtrCountFwd, totalUtrCountRev = counts
+    
+    foTC = open(outputCSV, "w")
+    
+    print("# slamdunk tcperutr v" + __version__, file=foTC)
+    
+    reverseAllPerPosRev = allPerPosRev[::-1]
+    reverseTcPerPosRev = tcPerPosRev[::-1]
+    reverseTotalUtrCountRev = totalUtrCountRev[::-1]
+
+    for i in range(0, utrNormFactor):
+        print(allPerPosFwd[i], reverseAllPerPosRev[i], tcPerPosFwd[i], reverseTcPerPosRev[i], totalUtrCountFwd[i], reverseTotalUtrCountRev[i], sep='\t', file=foTC)
+    foTC.close()
+
+def plotTcPerUtr(bam, outputCSV, outputPDF, log, printOnly=False, verbose=True, force=False):
        
     if(not checkStep([outputCSV], [outputPDF], force)):
         print("Skipped computing T->C per UTR position plot for file " + bam, file=log)
     else: 
         callR(getPlotter("conversion_per_read_position") + " -u -i " + outputCSV + " -o " + outputPDF, log, dry=printOnly, verbose=verbose)
+        if(not printOnly):
+            finishStep([outputPDF])
+
+def countUnmaskedTCReads(batch, utrLength, strictTCs):
+    # Number of reads of batch with a T>C (A>G on reverse reads) mismatch in
+    # the UTR, SNP positions are not masked
+    mismatchRead = np.repeat(np.arange(len(batch)), np.diff(batch.mismatchOffsets))
+    isReverse = batch.isReverse[mismatchRead]
+    isTC = np.where(isReverse, (batch.mismatchRefBase == BaseCode['A']) & (batch.mismatchReadBase == BaseCode['G']), (batch.mismatchRefBase == BaseCode['T']) & (batch.mismatchReadBase == BaseCode['C']))
+    isTC &= (batch.mismatchRefPos >= 0) & (batch.mismatchRefPos < utrLength)
+    hasTC = np.bincount(mismatchRead[isTC], minlength=len(batch)) > 0
+    # Conversions of non-TC reads are ignored
+    if (strictTCs) :
+        hasTC &= batch.isTcRead
+    return int(np.count_nonzero(hasTC))
+
+def countMaskedTCReads(readIterator, utrLength, strictTCs):
+    # Number of reads, reads with a T>C mismatch in the UTR and reads with a
+    # T>C mismatch at a non-SNP position in the UTR
+    unmaskedTCCount = 0
+    maskedTCCount = 0
+    readCount = 0
+    
+    for read in readIterator:
+        
+        # Overwrite any conversions for non-TC reads (reads with < 2 TC conversions)
+        if (not read.isTcRead and strictTCs) :
+            read.tcCount = 0
+            read.mismatches = []
+            read.conversionRates = 0.0
+            read.tcRate = 0.0
+            
+        isTC = False
+        isTrueTC = False
+        
+        for mismatch in read.mismatches:
+            if(mismatch.isTCMismatch(read.direction == ReadDirection.Reverse) and mismatch.referencePosition >= 0 and mismatch.referencePosition < utrLength):
+                isTrueTC = True
+            
+            unmasked = False
+            if (read.direction == ReadDirection.Reverse and mismatch.referenceBase == "A" and mismatch.readBase == "G"):
+                unmasked = True
+            elif (read.direction != ReadDirection.Reverse and mismatch.referenceBase == "T" and mismatch.readBase == "C") :
+                unmasked = True
+                
+            if (unmasked and mismatch.referencePosition >= 0 and mismatch.referencePosition < utrLength) :
+                isTC = True
+                
+        readCount += 1
+        
+        if (isTC) :
+            unmaskedTCCount += 1
+            
+        if (isTrueTC) :
+            maskedTCCount += 1
+    
+    return readCount, unmaskedTCCount, maskedTCCount
 
 def computeSNPMaskedRates (ref, bed, snpsFile, bam, maxReadLength, minQual, coverageCutoff, variantFraction, outputCSV, outputPDF, strictTCs, log, printOnly=False, verbose=True, force=False):
     
-    if(not checkStep([bam, ref], [outputCSV], force)):
+    if(not checkStep(getInputFiles(bam, ref, snpsFile) + [bed], [outputCSV], force, [maxReadLength, minQual, strictTCs])):
         print("Skipped computing T->C per UTR with SNP masking for file " + bam, file=log)
     else:    
         fileCSV = open(outputCSV,'w')
@@ -782,53 +989,38 @@ def computeSNPMaskedRates (ref, bed, snpsFile, bam, maxReadLength, minQual, cove
         #Go through one chr after the other
         testFile = SlamSeqBamFile(bam, ref, snps)
                                  
-        progress = 0
-        for utr in BedIterator(bed):
+        utrs = getAnnotationIndex(bed).getEntries()
+        for utr in utrs:
             
             if(not utr.hasStrand()):
                 raise RuntimeError("Input BED file does not contain stranded intervals.")
             
             if utr.start < 0:
-                raise RuntimeError("Negativ start coordinate found. Please check the following entry in your BED file: " + utr)
-    
-            readIterator = testFile.readInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, maxReadLength, minQual)
-            
-            unmaskedTCCount = 0
-            maskedTCCount = 0
-            readCount = 0
+                raise RuntimeError("Negativ start coordinate found. Please check the following entry in your BED file: " + str(utr))
+        
+        # Number of SNPs in each UTR. UTRs without SNPs on their strand don't
+        # need masking: masked and unmasked T->C counts are the same
+        tcSNPCounts, agSNPCounts = snps.countSNPsInIntervals([ utr.chromosome for utr in utrs ], [ utr.start for utr in utrs ], [ utr.stop for utr in utrs ])
+                                 
+        progress = 0
+        for utr, tcSNPCount, agSNPCount in zip(utrs, tcSNPCounts, agSNPCounts):
             
-            for read in readIterator:
-                
-                # Overwrite any conversions for non-TC reads (reads with < 2 TC conversions)
-                if (not read.isTcRead and strictTCs) :
-                    read.tcCount = 0
-                    read.mismatches = []
-                    read.conversionRates = 0.0
-                    read.tcRate = 0.0
-                    
-                isTC = False
-                isTrueTC = False
-                
-                for mismatch in read.mismatches:
-                    if(mismatch.isTCMismatch(read.direction == ReadDirection.Reverse) and mismatch.referencePosition >= 0 and mismatch.referencePosition < utr.getLength()):
-                        isTrueTC = True
-                    
-                    unmasked = False
-                    if (read.direction == ReadDirection.Reverse and mismatch.referenceBase == "A" and mismatch.readBase == "G"):
-                        unmasked = True
-                    elif (read.direction != ReadDirection.Reverse and mismatch.referenceBase == "T" and mismatch.readBase == "C") :
-                        unmasked = True
-                        
-                    if (unmasked and mismatch.referencePosition >= 0 and mismatch.referencePosition < utr.getLength()) :
-                        isTC = True
-                        
-                readCount += 1
-                
-                if (isTC) :
-                    unmaskedTCCount += 1
-                    
-                if (isTrueTC) :
-                    maskedTCCount += 1
+            if utr.strand == "+":
+                utrSNPCount = tcSNPCount
+            else:
+                utrSNPCount = agSNPCount
+    
+            if (utrSNPCount == 0) :
+                # No SNPs on the UTR strand: masked and unmasked T->C counts are the
+                # same, reads are counted in batches without masking
+                readCount = 0
+                unmaskedTCCount = 0
+                for batch in testFile.readBatchesInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, maxReadLength, minQual):
+                    readCount += len(batch)
+                    unmaskedTCCount += countUnmaskedTCReads(batch, utr.getLength(), strictTCs)
+                maskedTCCount = unmaskedTCCount
+            else :
+                readCount, unmaskedTCCount, maskedTCCount = countMaskedTCReads(testFile.readInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, maxReadLength, minQual), utr.getLength(), strictTCs)
             
             containsSNP = 0
             
@@ -840,11 +1032,14 @@ def computeSNPMaskedRates (ref, bed, snpsFile, bam, maxReadLength, minQual, cove
             progress += 1
             
         fileCSV.close()
+        finishStep([outputCSV])
     
-    if(not checkStep([outputCSV], [outputPDF], force)):
+    if(not checkStep([outputCSV], [outputPDF], force, [coverageCutoff, variantFraction])):
         print("Skipped computing T->C per UTR position plot for file " + bam, file=log)
     else: 
         callR(getPlotter("SNPeval") + " -i " + outputCSV + " -c " + str(coverageCutoff) + " -v " + str(variantFraction) + " -o " + outputPDF, log, dry=printOnly, verbose=verbose)            
+        if(not printOnly):
+            finishStep([outputPDF])
 
 def halflifes(bams, outputCSV, timepoints, log, printOnly=False, verbose=True, force=False):
     callR(getPlotter("compute_halflifes") + " -f " + bams + " -t " + timepoints + " -o " + outputCSV, log, dry=printOnly, verbose=verbose)
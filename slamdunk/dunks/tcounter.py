@@ -23,14 +23,21 @@ import sys
 import pysam
 import os
 import re
+import heapq
+import hashlib
+import shutil
+import numpy as np
 
 from os.path import basename
+from joblib import Parallel, delayed
 
-from slamdunk.utils.misc import replaceExtension, getSampleInfo, SlamSeqInfo, md5, callR, getPlotter  # @UnresolvedImport
-from slamdunk.utils.BedReader import BedIterator  # @UnresolvedImport
+from slamdunk.utils.misc import checkStep, finishStep, getInputFiles, replaceExtension, getSampleInfo, SlamSeqInfo, callR, getPlotter, openBam  # @UnresolvedImport
+from slamdunk.utils.ReferenceProvider import getReferenceProvider  # @UnresolvedImport
+from slamdunk.utils.AnnotationIndex import getAnnotationIndex  # @UnresolvedImport
+from slamdunk.utils.ShardedExecutor import runSharded, getFragmentFile, concatenateBamFragments  # @UnresolvedImport
 
 from slamdunk.utils import SNPtools  # @UnresolvedImport
-from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile, ReadDirection, SlamSeqInterval  # @UnresolvedImport
+from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile, SlamSeqReadBatch, SlamSeqInterval, BaseCode, decodeAlignments  # @UnresolvedImport
 
 from slamdunk.version import __version__, __bam_version__, __count_version__  # @UnresolvedImport
 
@@ -122,9 +129,194 @@ def getMean(values, skipZeros=True):
     else:
         return 0.0
 
-def computeTconversions(ref, bed, snpsFile, bam, maxReadLength, minQual, outputCSV, outputBedgraphPlus, outputBedgraphMinus, conversionThreshold, log, mle = False):
+class UtrCounter:
+
+    # Collects the reads of one UTR. Read positions are relative to the chromosome start
+
+    def __init__(self, utr, chromosomeLength):
+        self.utr = utr
+        # Region used to fetch reads for this UTR
+        self.regionStart = max(0, utr.start)
+        self.regionStop = min(chromosomeLength, utr.stop)
+
+        self.tcCountUtr = np.zeros(utr.getLength(), dtype=np.int64)
+        self.coverageUtr = np.zeros(utr.getLength(), dtype=np.int64)
+
+        self.tInReads = []
+        self.tcInRead = []
+
+        self.countFwd = 0
+        self.tcCountFwd = 0
+        self.countRev = 0
+        self.tCountRev = 0
+
+        self.multiMapFwd = 0
+        self.multiMapRev = 0
+
+    def overlapping(self, batch, start, stop):
+        # Indices of the reads in batch[start:stop] that overlap the UTR on its strand
+        if(self.regionStart >= self.regionStop):
+            # Empty regions don't return any reads
+            return np.zeros(0, dtype=np.int64)
+        mask = (batch.startRefPos[start:stop] < self.regionStop) & (batch.endRefPos[start:stop] > self.regionStart)
+        if(self.utr.strand == "+"):
+            mask &= ~batch.isReverse[start:stop]
+        else:
+            mask &= batch.isReverse[start:stop]
+        return start + np.flatnonzero(mask)
+
+    def addReads(self, batch, reads):
+
+        utrStart = self.utr.start
+        utrLength = self.utr.getLength()
+
+        isReverse = batch.isReverse[reads]
+        isTcRead = batch.isTcRead[reads]
+        isMultimapper = batch.isMultimapper[reads]
+        # Conversions of non-TC reads (reads with < conversionThreshold TC conversions) are ignored
+        hasTc = isTcRead & (batch.tcCount[reads] > 0)
+
+        reverseCount = int(np.count_nonzero(isReverse))
+        self.countRev += reverseCount
+        self.countFwd += len(reads) - reverseCount
+        self.tCountRev += int(np.count_nonzero(hasTc & isReverse))
+        self.tcCountFwd += int(np.count_nonzero(hasTc & ~isReverse))
+        self.multiMapRev += int(np.count_nonzero(isMultimapper & isReverse))
+        self.multiMapFwd += int(np.count_nonzero(isMultimapper & ~isReverse))
+
+        # Mismatches of the TC reads
+        mismatchStart = batch.mismatchOffsets[reads]
+        mismatchCount = np.where(isTcRead, batch.mismatchOffsets[reads + 1] - mismatchStart, 0)
+        mismatchRead = np.repeat(np.arange(len(reads)), mismatchCount)
+        mismatchIndex = np.arange(len(mismatchRead)) + np.repeat(mismatchStart - (np.cumsum(mismatchCount) - mismatchCount), mismatchCount)
+
+        position = batch.mismatchRefPos[mismatchIndex] - utrStart
+        inUtr = (position >= 0) & (position < utrLength)
+        isTc = batch.mismatchIsTc[mismatchIndex] & inUtr
+        refBase = batch.mismatchRefBase[mismatchIndex]
+        isT = np.where(isReverse[mismatchRead], refBase == BaseCode['A'], refBase == BaseCode['T']) & inUtr
+
+        self.tcCountUtr += np.bincount(position[isTc], minlength=utrLength)
+
+        testN = batch.tCount[reads] + np.bincount(mismatchRead[isT], minlength=len(reads))
+        testk = np.bincount(mismatchRead[isTc], minlength=len(reads))
+        self.tInReads.extend(testN.tolist())
+        self.tcInRead.extend(testk.tolist())
+
+        # Difference array: +1 at the first and -1 behind the last covered position
+        coverageStart = np.clip(batch.startRefPos[reads] - utrStart, 0, utrLength)
+        coverageEnd = np.clip(batch.endRefPos[reads] - utrStart, 0, utrLength)
+        coverageDiff = np.bincount(coverageStart, minlength=utrLength + 1) - np.bincount(coverageEnd, minlength=utrLength + 1)
+        self.coverageUtr += np.cumsum(coverageDiff[:utrLength])
+
+def clusterRegions(regions, maxReadLength):
+
+    # Groups (start, stop, item) regions that are closer than maxReadLength.
+    # Returns [start, stop, items] lists sorted by start
+    clusters = []
+    for regionStart, regionStop, item in sorted(regions, key=lambda region: region[0]):
+        if(len(clusters) > 0 and regionStart - clusters[-1][1] <= maxReadLength):
+            clusters[-1][1] = max(clusters[-1][1], regionStop)
+            clusters[-1][2].append(item)
+        else:
+            clusters.append([regionStart, regionStop, [item]])
+    return clusters
+
+def countReadsInUtrs(testFile, chromosome, counters, maxReadLength, minQual, conversionThreshold):
+
+    # Sweep over the reads of a chromosome: every read is decoded once and added to all UTRs
+    # it overlaps. UTRs closer than maxReadLength are fetched together.
+    clusters = clusterRegions([ (counter.regionStart, counter.regionStop, counter) for counter in counters ], maxReadLength)
+
+    for clusterStart, clusterStop, clusterCounters in clusters:
+        for batch in testFile.readBatchesInInterval(chromosome, clusterStart, clusterStop, minQual, conversionThreshold):
+            # Reads are sorted by start position: only reads starting less than the
+            # longest alignment before the UTR can overlap it
+            maxLength = int(np.max(batch.endRefPos - batch.startRefPos))
+            for counter in clusterCounters:
+                start = np.searchsorted(batch.startRefPos, counter.regionStart - maxLength, side='left')
+                stop = np.searchsorted(batch.startRefPos, counter.regionStop, side='left')
+                reads = counter.overlapping(batch, start, stop)
+                if(len(reads) > 0):
+                    counter.addReads(batch, reads)
+
+def countUtrShard(bam, ref, snpsFile, shard, maxReadLength, minQual, conversionThreshold):
+
+    # Counts the UTRs of one shard. A shard is a list of (chromosome, utrs) entries.
+    # Returns the UtrCounters in the same order as the UTRs of the shard
+    snps = SNPtools.SNPDictionary(snpsFile)
+    snps.read()
+
+    testFile = SlamSeqBamFile(bam, ref, snps)
+
+    shardCounters = []
+    for chromosome, utrs in shard:
+        chromosomeLength = testFile.getChromosomeLength(chromosome)
+        counters = [ UtrCounter(utr, chromosomeLength) for utr in utrs ]
+        countReadsInUtrs(testFile, chromosome, counters, maxReadLength, minQual, conversionThreshold)
+        shardCounters.extend(counters)
+
+    return shardCounters
+
+def shardUtrs(testFile, bam, utrs, maxReadLength, shardNumber):
+
+    # Splits the UTRs into shardNumber shards of similar read load. The load of a cluster of
+    # nearby UTRs is estimated from the number of mapped reads of its chromosome (BAM index)
+    # and the fraction of the annotated chromosome it covers.
+    # Returns the shards and for each shard the BED indices of its UTRs
+    mappedReads = {}
+    bamFile = pysam.AlignmentFile(bam, "rb")
+    for stats in bamFile.get_index_statistics():
+        mappedReads[stats.contig] = stats.mapped
+    bamFile.close()
+
+    chromosomeRegions = {}
+    for index, utr in enumerate(utrs):
+        if(testFile.isInReferenceFile(utr.chromosome) and utr.chromosome in mappedReads):
+            chromosomeLength = testFile.getChromosomeLength(utr.chromosome)
+            if(not utr.chromosome in chromosomeRegions):
+                chromosomeRegions[utr.chromosome] = []
+            chromosomeRegions[utr.chromosome].append((max(0, utr.start), min(chromosomeLength, utr.stop), index))
+
+    clusters = []
+    for chromosome in chromosomeRegions:
+        chromosomeClusters = clusterRegions(chromosomeRegions[chromosome], maxReadLength)
+        annotatedLength = sum(max(1, clusterStop - clusterStart) for clusterStart, clusterStop, indices in chromosomeClusters)
+        for clusterStart, clusterStop, indices in chromosomeClusters:
+            load = mappedReads[chromosome] * max(1, clusterStop - clusterStart) / float(annotatedLength)
+            clusters.append((load, chromosome, clusterStart, indices))
+
+    # Largest clusters first, each to the shard with the lowest load
+    shardLoads = [ (0.0, shardIndex) for shardIndex in xrange(0, shardNumber) ]
+    shardClusters = [ [] for shardIndex in xrange(0, shardNumber) ]
+    for load, chromosome, clusterStart, indices in sorted(clusters, key=lambda cluster: (-cluster[0], cluster[1], cluster[2])):
+        shardLoad, shardIndex = heapq.heappop(shardLoads)
+        shardClusters[shardIndex].append((chromosome, clusterStart, indices))
+        heapq.heappush(shardLoads, (shardLoad + load, shardIndex))
+
+    shards = []
+    shardIndices = []
+    for clusterList in shardClusters:
+        if(len(clusterList) > 0):
+            # Keep chromosomes and positions in order to read the BAM file sequentially
+            shard = []
+            indices = []
+            for chromosome, clusterStart, clusterIndices in sorted(clusterList, key=lambda cluster: (cluster[0], cluster[1])):
+                shard.append((chromosome, [ utrs[index] for index in clusterIndices ]))
+                indices.extend(clusterIndices)
+            shards.append(shard)
+            shardIndices.append(indices)
+
+    return shards, shardIndices
+
+def computeTconversions(ref, bed, snpsFile, bam, maxReadLength, minQual, outputCSV, outputBedgraphPlus, outputBedgraphMinus, conversionThreshold, log, mle = False, threads = 1, force = False):
+    
+    outFiles = [outputCSV, outputBedgraphPlus, outputBedgraphMinus]
+    if(not checkStep(getInputFiles(bam, ref, snpsFile) + [bed], outFiles, force, [maxReadLength, minQual, conversionThreshold, mle, __count_version__])):
+        print("Skipped computing T->C conversions for file " + bam, file=log)
+        return
     
-    referenceFile = pysam.FastaFile(ref)
+    referenceFile = getReferenceProvider(ref)
     
     sampleInfo = getSampleInfo(bam)
     
@@ -132,7 +324,9 @@ def computeTconversions(ref, bed, snpsFile, bam, maxReadLength, minQual, outputC
     #readNumber = slamseqInfo.MappedReads
     readNumber = slamseqInfo.FilteredReads
     
-    bedMD5 = md5(bed)
+    # BED entries, MD5 and T content of all UTRs. Only computed for the first sample
+    annotation = getAnnotationIndex(bed, ref, maxReadLength)
+    bedMD5 = annotation.md5
     
     if(mle):
         fileNameTest = replaceExtension(outputCSV, ".tsv", "_perread")
@@ -148,108 +342,79 @@ def computeTconversions(ref, bed, snpsFile, bam, maxReadLength, minQual, outputC
     print("#annotation:", os.path.basename(bed), bedMD5, sep="\t", file=fileCSV)
     print(SlamSeqInterval.Header, file=fileCSV)
         
-    snps = SNPtools.SNPDictionary(snpsFile)
-    snps.read()
-    
-    #Go through one chr after the other
-    testFile = SlamSeqBamFile(bam, ref, snps)
+    testFile = SlamSeqBamFile(bam, referenceFile, None)
     if not testFile.bamVersion == __bam_version__:
         raise RuntimeError("Wrong filtered BAM file version detected (" + testFile.bamVersion + "). Expected version " + __bam_version__ + ". Please rerun slamdunk filter.")
     
-    bedMD5 = md5(bed)
     if slamseqInfo.AnnotationMD5 != bedMD5:
         print("Warning: MD5 checksum of annotation (" + bedMD5 + ") does not matched MD5 in filtered BAM files (" + slamseqInfo.AnnotationMD5 + "). Most probably the annotation filed changed after the filtered BAM files were created.", file=log)
 
+    utrs = annotation.getEntries()
+    for utr in utrs:
+        if(not utr.hasStrand()):
+            raise RuntimeError("Input BED file does not contain stranded intervals.")
+        
+        if utr.start < 0:
+            raise RuntimeError("Negativ start coordinate found. Please check the following entry in your BED file: " + str(utr))
+
+    # Go through each chromosome once and add every read to all UTRs it overlaps.
+    # Shards of UTRs are counted in parallel.
+    shards, shardIndices = shardUtrs(testFile, bam, utrs, maxReadLength, max(1, threads))
+    print("Counting " + str(len(utrs)) + " UTRs in " + str(len(shards)) + " shards (" + str(threads) + " threads)", file=log)
+    results = Parallel(n_jobs=threads)(delayed(countUtrShard)(bam, ref, snpsFile, shard, maxReadLength, minQual, conversionThreshold) for shard in shards)
+
+    utrCounters = [None] * len(utrs)
+    for indices, counters in zip(shardIndices, results):
+        for index, counter in zip(indices, counters):
+            utrCounters[index] = counter
+
+    # UTRs on chromosomes without reads
+    for index in xrange(0, len(utrs)):
+        if(utrCounters[index] == None):
+            utrCounters[index] = UtrCounter(utrs[index], 0)
+
     conversionBedGraph = {}
                          
-    for utr in BedIterator(bed):
+    for index, counter in enumerate(utrCounters):
+        utr = counter.utr
         Tcontent = 0
         slamSeqUtr = SlamSeqInterval(utr.chromosome, utr.start, utr.stop, utr.strand, utr.name, Tcontent, 0, 0, 0, 0, 0, 0, 0)
         slamSeqUtrMLE = SlamSeqInterval(utr.chromosome, utr.start, utr.stop, utr.strand, utr.name, Tcontent, 0, 0, 0, 0, 0, 0, 0)
-        if(not utr.hasStrand()):
-            raise RuntimeError("Input BED file does not contain stranded intervals.")
-        
-        if utr.start < 0:
-            raise RuntimeError("Negativ start coordinate found. Please check the following entry in your BED file: " + utr)
         # Retreive reference sequence
         region = utr.chromosome + ":" + str(utr.start + 1) + "-" + str(utr.stop)
         
-        if(utr.chromosome in list(referenceFile.references)):
+        if(referenceFile.isInReference(utr.chromosome)):
             #print(refRegion,file=sys.stderr)
             # pysam-0.15.0.1
             #refSeq = referenceFile.fetch(region=region).upper()
-            refSeq = referenceFile.fetch(reference=utr.chromosome, start=utr.start, end=utr.stop).upper()
+            refBases = annotation.getBases(index)
             if (utr.strand == "-") :
                 #refSeq = complement(refSeq[::-1])
-                Tcontent = refSeq.count("A")
+                isT = refBases == ord("A")
             else :
-                Tcontent = refSeq.count("T")
+                isT = refBases == ord("T")
+            Tcontent = annotation.getTcontent(index)
                 
             
             slamSeqUtr._Tcontent = Tcontent
 
-        readIterator = testFile.readInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, maxReadLength, minQual, conversionThreshold)
-      
-        tcCountUtr = [0] * utr.getLength()
-        coverageUtr = [0] * utr.getLength()
+        tcCountUtr = counter.tcCountUtr
+        coverageUtr = counter.coverageUtr
 
-        tInReads = []
-        tcInRead = []
+        tInReads = counter.tInReads
+        tcInRead = counter.tcInRead
 
-        countFwd = 0
-        tcCountFwd = 0
-        countRev = 0
-        tCountRev = 0
-        
-        multiMapFwd = 0
-        multiMapRev = 0
+        countFwd = counter.countFwd
+        tcCountFwd = counter.tcCountFwd
+        countRev = counter.countRev
+        tCountRev = counter.tCountRev
         
-        for read in readIterator:
-            
-            # Overwrite any conversions for non-TC reads (reads with < 2 TC conversions)
-            if (not read.isTcRead) :
-                read.tcCount = 0
-                read.mismatches = []
-                read.conversionRates = 0.0
-                read.tcRate = 0.0
-            
-            if(read.direction == ReadDirection.Reverse):
-                countRev += 1
-                if read.tcCount > 0:
-                    tCountRev += 1
-                if read.isMultimapper:
-                    multiMapRev += 1
-            else:
-                countFwd += 1
-                if read.tcCount > 0:
-                    tcCountFwd += 1
-                if read.isMultimapper:
-                    multiMapFwd += 1
-            
-            for mismatch in read.mismatches:
-                if(mismatch.isTCMismatch(read.direction == ReadDirection.Reverse) and mismatch.referencePosition >= 0 and mismatch.referencePosition < utr.getLength()):
-                    tcCountUtr[mismatch.referencePosition] += 1
-
-            testN = read.getTcount()
-            testk = 0
-            for mismatch in read.mismatches:
-                if(mismatch.referencePosition >= 0 and mismatch.referencePosition < utr.getLength()):
-                    if(mismatch.isT(read.direction == ReadDirection.Reverse)):
-                        testN += 1
-                    if(mismatch.isTCMismatch(read.direction == ReadDirection.Reverse)):
-                        testk += 1
-            #print(utr.name, read.name, read.direction, testN, testk, read.sequence, sep="\t")
-            tInReads.append(testN)
-            tcInRead.append(testk)
-            #print(utr.name, testN, testk, sep="\t", file=fileTest)
-            
-            for i in xrange(read.startRefPos, read.endRefPos):
-                if(i >= 0 and i < utr.getLength()):
-                    coverageUtr[i] += 1
-            
+        multiMapFwd = counter.multiMapFwd
+        multiMapRev = counter.multiMapRev
 
         if((utr.strand == "+" and countFwd > 0) or (utr.strand == "-" and countRev > 0)):        
-            tcRateUtr = [ x * 100.0 / y if y > 0 else 0 for x, y in zip(tcCountUtr, coverageUtr)]
+            covered = coverageUtr > 0
+            tcRateUtr = np.where(covered, tcCountUtr * 100.0 / np.maximum(coverageUtr, 1), 0)
             
             readCount = countFwd
             tcReadCount = tcCountFwd
@@ -264,27 +429,21 @@ def computeTconversions(ref, bed, snpsFile, bam, maxReadLength, minQual, outputC
                 print("Warning: " + utr.name + " is located on the " + utr.strand + " strand but read counts are higher for the opposite strand (fwd: " + countFwd + ", rev: " + countRev + ")", file=sys.stderr)
                 
             
-            refSeq = readIterator.getRefSeq()
-    
+            # Covered Ts/As in the UTR. The reference can be shorter than the UTR at chromosome ends
+            onT = np.zeros(len(coverageUtr), dtype=np.bool_)
+            onT[:len(isT)] = isT[:len(coverageUtr)]
+            onT &= covered
+
             # Get number of covered Ts/As in the UTR and compute average conversion rate for all covered Ts/As
-            coveredTcount = 0
-            avgConversationRate = 0
-            coveredPositions = 0
+            coveredTcount = int(np.count_nonzero(onT))
+            avgConversationRate = float(np.sum(tcRateUtr[onT]))
+            coveredPositions = int(np.count_nonzero(covered))
             # Get number of reads on T positions and number of reads with T->C conversions on T positions
-            coverageOnTs = 0
-            conversionsOnTs = 0
+            coverageOnTs = int(np.sum(coverageUtr[onT]))
+            conversionsOnTs = int(np.sum(tcCountUtr[onT]))
             
-            for position in xrange(0, len(coverageUtr)):
-
-                if(coverageUtr[position] > 0 and ((utr.strand == "+" and refSeq[position] == "T") or (utr.strand == "-" and refSeq[position] == "A"))):
-                    coveredTcount += 1
-                    avgConversationRate += tcRateUtr[position]
-                    
-                    coverageOnTs += coverageUtr[position]
-                    conversionsOnTs += tcCountUtr[position]
-                    conversionBedGraph[utr.chromosome + ":" + str(utr.start + position) + ":" + str(utr.strand)] = tcRateUtr[position] 
-                if(coverageUtr[position] > 0):
-                    coveredPositions += 1
+            for position, tcRate in zip(np.flatnonzero(onT).tolist(), tcRateUtr[onT].tolist()):
+                conversionBedGraph[utr.chromosome + ":" + str(utr.start + position) + ":" + str(utr.strand)] = tcRate
             
             if(coveredTcount > 0):
                 avgConversationRate = avgConversationRate / coveredTcount
@@ -324,209 +483,347 @@ def computeTconversions(ref, bed, snpsFile, bam, maxReadLength, minQual, outputC
             
     fileBedgraphPlus.close()
     fileBedgraphMinus.close()
+    finishStep(outFiles)
     
     if(mle):
         fileNameMLE = replaceExtension(outputCSV, ".tsv", "_mle")
         callR(getPlotter("compute_conversion_rate_mle") +  " -f " + fileNameTest + " -r " + "0.024" + " -o " + fileNameMLE + " &> /dev/null")
 
-def genomewideConversionRates(referenceFile, snpsFile, bam, minBaseQual, outputBedGraphPrefix, conversionThreshold, coverageCutoff, log):
+def positionalCountWindows(testFile, chromosome, minBaseQual, conversionThreshold, windowSize):
+
+    # Yields (windowStart, coveragePlus, coverageMinus, tcCount, agCount) for consecutive windows of
+    # windowSize positions of a chromosome. Positions are relative to readsInChromosome (startPosition 1).
+    # Reads that span the end of a window are carried over into the next window, so memory only
+    # depends on windowSize and the longest alignment.
+    chrLength = testFile.getChromosomeLength(chromosome)
+
+    windowStart = 0
+    # Coverage as difference arrays (plus, minus) and T>C (plus) / A>G (minus) conversion counts
+    coverageDiff = np.zeros((2, windowSize + 1), dtype=np.int64)
+    conversions = np.zeros((2, windowSize), dtype=np.int64)
+
+    def nextWindow(windowStart, coverageDiff, conversions):
+        windowEnd = min(windowStart + windowSize, chrLength)
+        coverage = np.cumsum(coverageDiff[:, :windowSize], axis=1)
+        window = (windowStart, coverage[0, :windowEnd - windowStart], coverage[1, :windowEnd - windowStart], conversions[0, :windowEnd - windowStart], conversions[1, :windowEnd - windowStart])
+
+        # Move buffers by one window and carry over the coverage at the window end
+        bufferLength = max(conversions.shape[1] - windowSize, windowSize)
+        shiftedDiff = np.zeros((2, bufferLength + 1), dtype=np.int64)
+        shiftedDiff[:, :coverageDiff.shape[1] - windowSize] = coverageDiff[:, windowSize:]
+        shiftedDiff[:, 0] += coverage[:, -1]
+        shiftedConversions = np.zeros((2, bufferLength), dtype=np.int64)
+        shiftedConversions[:, :conversions.shape[1] - windowSize] = conversions[:, windowSize:]
+        return window, shiftedDiff, shiftedConversions
+
+    for batch in testFile.readBatchesInChromosome(chromosome, minBaseQual, conversionThreshold):
+
+        readStart = np.clip(batch.startRefPos, 0, chrLength)
+        readEnd = np.maximum(np.clip(batch.endRefPos, 0, chrLength), readStart)
+        readStrand = batch.isReverse.astype(np.int64)
+
+        # Conversions of non-TC reads are ignored
+        mismatchRead = batch.getMismatchReadIndex()
+        mismatchPos = batch.mismatchRefPos
+        isConversion = batch.mismatchIsTc & batch.isTcRead[mismatchRead] & (mismatchPos >= 0) & (mismatchPos < chrLength)
+
+        first = 0
+        while first < batch.size:
+            last = np.searchsorted(readStart, windowStart + windowSize, side='left')
+            if last > first:
+                # Make room for reads extending beyond the buffer
+                bufferLength = int(np.max(readEnd[first:last])) - windowStart
+                if bufferLength > conversions.shape[1]:
+                    coverageDiff = np.concatenate((coverageDiff, np.zeros((2, bufferLength - conversions.shape[1]), dtype=np.int64)), axis=1)
+                    conversions = np.concatenate((conversions, np.zeros((2, bufferLength - conversions.shape[1]), dtype=np.int64)), axis=1)
+                    bufferLength = conversions.shape[1]
+                else:
+                    bufferLength = conversions.shape[1]
+
+                flatDiff = coverageDiff.reshape(-1)
+                np.add.at(flatDiff, readStrand[first:last] * (bufferLength + 1) + readStart[first:last] - windowStart, 1)
+                np.add.at(flatDiff, readStrand[first:last] * (bufferLength + 1) + readEnd[first:last] - windowStart, -1)
+
+                mismatchFirst = batch.mismatchOffsets[first]
+                mismatchLast = batch.mismatchOffsets[last]
+                chunkConversion = isConversion[mismatchFirst:mismatchLast]
+                chunkRead = mismatchRead[mismatchFirst:mismatchLast][chunkConversion]
+                chunkPos = mismatchPos[mismatchFirst:mismatchLast][chunkConversion]
+                np.add.at(conversions.reshape(-1), readStrand[chunkRead] * bufferLength + chunkPos - windowStart, 1)
+            first = last
+
+            # Remaining reads start behind the current window
+            while first < batch.size and readStart[first] >= windowStart + windowSize:
+                window, coverageDiff, conversions = nextWindow(windowStart, coverageDiff, conversions)
+                yield window
+                windowStart += windowSize
+
+    while windowStart < chrLength:
+        window, coverageDiff, conversions = nextWindow(windowStart, coverageDiff, conversions)
+        yield window
+        windowStart += windowSize
+
+class BedGraphTrack:
+
+    # Run-length encodes per-position values into bedGraph intervals. An interval is written
+    # whenever the value changes, the last interval of a chromosome is not written.
+    # Optionally, the same intervals are written to a bigWig file
+
+    # Size of the chunks of intervals added to the bigWig file by appendFragment
+    _fragmentChunkSize = 100000
+
+    def __init__(self, fileName, header, chromosomeLengths = None):
+        # header: None for fragments that are appended to a track with header
+        self._file = open(fileName + ".bedGraph", 'w')
+        if(header != None):
+            print(header, file=self._file)
+
+        self._bigWig = None
+        if(chromosomeLengths != None):
+            self._bigWig = openBigWig(fileName + ".bw", chromosomeLengths)
+
+    def startChromosome(self, chromosome):
+        self._chromosome = chromosome
+        self._prevValue = 0
+        self._prevIsFloat = False
+        self._prevPos = 0
+
+    def addWindow(self, windowStart, values, isFloat = None):
+        # values[i] is the value of position windowStart + i. isFloat marks float values
+        # (printed as e.g. 0.0 instead of 0) if values contains floats
+        if(len(values) == 0):
+            return
+
+        previous = np.empty_like(values)
+        previous[0] = self._prevValue
+        previous[1:] = values[:-1]
+        changes = np.flatnonzero(values != previous)
+        if(len(changes) == 0):
+            return
+
+        starts = [self._prevPos] + (windowStart + changes[:-1]).tolist()
+        ends = (windowStart + changes).tolist()
+        runValues = [self._prevValue] + values[changes[:-1]].tolist()
+        if(isFloat is None):
+            runIsFloat = [False] * len(changes)
+        else:
+            runIsFloat = [self._prevIsFloat] + isFloat[changes[:-1]].tolist()
+
+        text = [ str(value) if valueIsFloat else str(int(value)) for value, valueIsFloat in zip(runValues, runIsFloat) ]
+        self._file.write("".join(self._chromosome + "\t" + str(start + 1) + "\t" + str(end + 1) + "\t" + value + "\n" for start, end, value in zip(starts, ends, text)))
+
+        if(self._bigWig != None):
+            self._bigWig.addEntries([self._chromosome] * len(starts), [ start + 1 for start in starts ], ends=[ end + 1 for end in ends ], values=[ float(value) for value in runValues ])
+
+        self._prevPos = windowStart + int(changes[-1])
+        self._prevValue = values[changes[-1]].item()
+        if(isFloat is not None):
+            self._prevIsFloat = bool(isFloat[changes[-1]])
+
+    def appendFragment(self, fragmentFile):
+        # Appends the intervals of a track fragment (e.g. written by another process)
+        with open(fragmentFile, 'r') as fragment:
+            if(self._bigWig == None):
+                shutil.copyfileobj(fragment, self._file)
+                return
+
+            intervals = []
+            for line in fragment:
+                self._file.write(line)
+                interval = line.rstrip("\n").split("\t")
+                if(len(intervals) > 0 and (interval[0] != intervals[0][0] or len(intervals) >= self._fragmentChunkSize)):
+                    self._addBigWigIntervals(intervals)
+                    intervals = []
+                intervals.append(interval)
+            if(len(intervals) > 0):
+                self._addBigWigIntervals(intervals)
+
+    def _addBigWigIntervals(self, intervals):
+        self._bigWig.addEntries([ interval[0] for interval in intervals ], [ int(interval[1]) for interval in intervals ], ends=[ int(interval[2]) for interval in intervals ], values=[ float(interval[3]) for interval in intervals ])
+
+    def close(self):
+        self._file.close()
+        if(self._bigWig != None):
+            self._bigWig.close()
+
+def openBigWig(fileName, chromosomeLengths):
+    # pyBigWig is only required for bigWig output
+    try:
+        import pyBigWig  # @UnresolvedImport
+    except ImportError:
+        raise RuntimeError("bigWig output requires the pyBigWig package. Please install pyBigWig or run without bigWig output.")
+
+    bigWig = pyBigWig.open(fileName, "w")
+    bigWig.addHeader(chromosomeLengths, maxZooms=10)
+    return bigWig
+
+# Suffix, name and description of the genome-wide tracks
+positionalTracks = [
+    ("_TC_rates_genomewide", "tc-conversions", "# T->C conversions / # reads on T per position genome-wide"),
+    ("_AG_rates_genomewide", "ag-conversions", "# A->G conversions / # reads on A per position genome-wide"),
+    ("_coverage_plus_genomewide", "plus-strand coverage", "# Reads on plus strand genome-wide"),
+    ("_coverage_minus_genomewide", "minus-strand coverage", "# Reads on minus strand genome-wide"),
+    ("_TC_conversions_genomewide", "T->C conversions", "# T->C conversions on plus strand genome-wide"),
+    ("_AG_conversions_genomewide", "A->G conversions", "# A->G conversions on minus strand genome-wide"),
+    ("_coverage_T_genomewide", "T-coverage", "# Plus-strand reads on Ts genome-wide"),
+    ("_coverage_A_genomewide", "A-coverage", "# Minus-strand reads on As genome-wide")
+]
+
+def positionalTracksShard(chromosomes, referenceFile, snpsFile, bam, minBaseQual, conversionThreshold, coverageCutoff, windowSize, outputBedGraphPrefix):
+    # Writes the tracks of chromosomes to one fragment per track (see runSharded).
+    # Returns the fragment files in the order of positionalTracks
+    ref = getReferenceProvider(referenceFile)
     
-    ref = pysam.FastaFile(referenceFile)
-     
     snps = SNPtools.SNPDictionary(snpsFile)
     snps.read()
     
+    testFile = SlamSeqBamFile(bam, ref, snps)
+    
+    fragmentFiles = [ getFragmentFile(outputBedGraphPrefix + suffix, ".bedGraph") for suffix, _, _ in positionalTracks ]
+    tracks = [ BedGraphTrack(fragmentFile[:-len(".bedGraph")], None) for fragmentFile in fragmentFiles ]
+    trackRatesPlus, trackRatesMinus, trackCoveragePlus, trackCoverageMinus, trackTCConversions, trackAGConversions, trackT, trackA = tracks
+    
     # Go through one chr after the other
-    testFile = SlamSeqBamFile(bam, referenceFile, snps)
+    for chromosome in chromosomes:
+
+        for track in tracks:
+            track.startChromosome(chromosome)
+
+        for windowStart, coveragePlus, coverageMinus, tcCount, agCount in positionalCountWindows(testFile, chromosome, minBaseQual, conversionThreshold, windowSize):
+
+            # Position i is compared to reference position i + 1 (see readsInChromosome)
+            refBases = ref.fetchArray(chromosome, windowStart + 1, windowStart + len(coveragePlus) + 1)
+            bases = np.zeros(len(coveragePlus), dtype=np.uint8)
+            bases[:len(refBases)] = refBases
+
+            tCoverage = np.where(bases == ord("T"), coveragePlus, 0)
+            aCoverage = np.where(bases == ord("A"), coverageMinus, 0)
+
+            tcRateIsFloat = (coveragePlus > 0) & (coveragePlus >= coverageCutoff)
+            agRateIsFloat = (coverageMinus > 0) & (coverageMinus >= coverageCutoff)
+            TCconversionRate = np.where(tcRateIsFloat, tcCount / np.maximum(coveragePlus, 1).astype(np.float64), 0.0)
+            AGconversionRate = np.where(agRateIsFloat, agCount / np.maximum(coverageMinus, 1).astype(np.float64), 0.0)
+
+            trackCoveragePlus.addWindow(windowStart, coveragePlus)
+            trackCoverageMinus.addWindow(windowStart, coverageMinus)
+            trackT.addWindow(windowStart, tCoverage)
+            trackA.addWindow(windowStart, aCoverage)
+            trackTCConversions.addWindow(windowStart, tcCount)
+            trackAGConversions.addWindow(windowStart, agCount)
+            trackRatesPlus.addWindow(windowStart, TCconversionRate, tcRateIsFloat)
+            trackRatesMinus.addWindow(windowStart, AGconversionRate, agRateIsFloat)
+                    
+    for track in tracks:
+        track.close()
+    return fragmentFiles
+
+def genomewideConversionRates(referenceFile, snpsFile, bam, minBaseQual, outputBedGraphPrefix, conversionThreshold, coverageCutoff, log, windowSize = 1000000, bigWig = False, threads = 1):
+    
+    testFile = SlamSeqBamFile(bam, referenceFile, None)
      
     chromosomes = testFile.getChromosomes()
     
     bedGraphInfo = re.sub("_slamdunk_mapped.*","",basename(outputBedGraphPrefix))
     print(bedGraphInfo)
-    
-    fileBedGraphRatesPlus = open(outputBedGraphPrefix + "_TC_rates_genomewide.bedGraph", 'w')
-    fileBedGraphRatesMinus = open(outputBedGraphPrefix + "_AG_rates_genomewide.bedGraph", 'w')
-    fileBedGraphCoveragePlus = open(outputBedGraphPrefix + "_coverage_plus_genomewide.bedGraph", 'w')
-    fileBedGraphCoverageMinus = open(outputBedGraphPrefix + "_coverage_minus_genomewide.bedGraph", 'w')
-    fileBedGraphTCConversions = open(outputBedGraphPrefix + "_TC_conversions_genomewide.bedGraph", 'w')
-    fileBedGraphAGConversions = open(outputBedGraphPrefix + "_AG_conversions_genomewide.bedGraph", 'w')
-    fileBedGraphT = open(outputBedGraphPrefix + "_coverage_T_genomewide.bedGraph", 'w')
-    fileBedGraphA = open(outputBedGraphPrefix + "_coverage_A_genomewide.bedGraph", 'w')
-    
-    print("track type=bedGraph name=\"" + bedGraphInfo + " tc-conversions\" description=\"# T->C conversions / # reads on T per position genome-wide\"", file=fileBedGraphRatesPlus)
-    print("track type=bedGraph name=\"" + bedGraphInfo + " ag-conversions\" description=\"# A->G conversions / # reads on A per position genome-wide\"", file=fileBedGraphRatesMinus)
-    print("track type=bedGraph name=\"" + bedGraphInfo + " plus-strand coverage\" description=\"# Reads on plus strand genome-wide\"", file=fileBedGraphCoveragePlus)
-    print("track type=bedGraph name=\"" + bedGraphInfo + " minus-strand coverage\" description=\"# Reads on minus strand genome-wide\"", file=fileBedGraphCoverageMinus)
-    print("track type=bedGraph name=\"" + bedGraphInfo + " T->C conversions\" description=\"# T->C conversions on plus strand genome-wide\"", file=fileBedGraphTCConversions)
-    print("track type=bedGraph name=\"" + bedGraphInfo + " A->G conversions\" description=\"# A->G conversions on minus strand genome-wide\"", file=fileBedGraphAGConversions)
-    print("track type=bedGraph name=\"" + bedGraphInfo + " T-coverage\" description=\"# Plus-strand reads on Ts genome-wide\"", file=fileBedGraphT)
-    print("track type=bedGraph name=\"" + bedGraphInfo + " A-coverage\" description=\"# Minus-strand reads on As genome-wide\"", file=fileBedGraphA)
-             
-    for chromosome in chromosomes:
-        
-        chrLength = testFile.getChromosomeLength(chromosome)
-        
-        tcCount = [0] * chrLength
-        agCount = [0] * chrLength
-        
-        coveragePlus = [0] * chrLength
-        coverageMinus = [0] * chrLength
-        
-        tCoverage = [0] * chrLength
-        aCoverage = [0] * chrLength
-        
-        readIterator = testFile.readsInChromosome(chromosome, minBaseQual, conversionThreshold)
-             
-        for read in readIterator:
-            if (not read.isTcRead) :
-                read.tcCount = 0
-                read.mismatches = []
-                read.conversionRates = 0.0
-                read.tcRate = 0.0
-            
-            for mismatch in read.mismatches:
-                if(mismatch.isTCMismatch(read.direction == ReadDirection.Reverse) and mismatch.referencePosition >= 0 and mismatch.referencePosition < chrLength):
-                    if read.direction == ReadDirection.Reverse:
-                        agCount[mismatch.referencePosition] += 1
-                    else :
-                        tcCount[mismatch.referencePosition] += 1
-                        
-            for i in xrange(read.startRefPos, read.endRefPos):
-                if(i >= 0 and i < chrLength):
-                    if read.direction == ReadDirection.Reverse:
-                        coverageMinus[i] += 1
-                    else :
-                        coveragePlus[i] += 1
-        
-        prevCoveragePlus = 0
-        prevCoveragePlusPos = 0
-        prevCoverageMinus = 0
-        prevCoverageMinusPos = 0
-        prevTCConversionRate = 0
-        prevTCConversionRatePos = 0
-        prevAGConversionRate = 0
-        prevAGConversionRatePos = 0
-        prevTCConversions = 0
-        prevTCConversionPos = 0
-        prevAGConversions = 0
-        prevAGConversionPos = 0
-        prevTCoverage = 0
-        prevTCoveragePos = 0
-        prevACoverage = 0
-        prevACoveragePos = 0
-                
-        for pos in xrange(0, chrLength):
-            if prevCoveragePlus != coveragePlus[pos]:
-                print(chromosome + "\t" + str(prevCoveragePlusPos + 1) + "\t" + str(pos + 1) + "\t" + str(prevCoveragePlus), file = fileBedGraphCoveragePlus)
-                prevCoveragePlus = coveragePlus[pos]
-                prevCoveragePlusPos = pos
-            if prevCoverageMinus != coverageMinus[pos]:
-                print(chromosome + "\t" + str(prevCoverageMinusPos + 1) + "\t" + str(pos + 1) + "\t" + str(prevCoverageMinus), file = fileBedGraphCoverageMinus)
-                prevCoverageMinus = coverageMinus[pos]
-                prevCoverageMinusPos = pos
-                
-            tCoverage = 0
-                
-            if coveragePlus[pos] > 0:
-                base = ref.fetch(reference=chromosome, start = pos + 1, end = pos + 2)
-                if base.upper() == "T":
-                    tCoverage = coveragePlus[pos]
-                                        
-            aCoverage = 0
-            
-            if coverageMinus[pos] > 0:
-                base = ref.fetch(reference=chromosome, start = pos + 1, end = pos + 2)
-                if base.upper() == "A":
-                    aCoverage = coverageMinus[pos]
-                    
-            if prevTCoverage != tCoverage:
-                print(chromosome + "\t" + str(prevTCoveragePos + 1) + "\t" + str(pos + 1) + "\t" + str(prevTCoverage), file = fileBedGraphT)
-                prevTCoverage = tCoverage
-                prevTCoveragePos = pos
-                
-            if prevACoverage != aCoverage:
-                print(chromosome + "\t" + str(prevACoveragePos + 1) + "\t" + str(pos + 1) + "\t" + str(prevACoverage), file = fileBedGraphA)
-                prevACoverage = aCoverage
-                prevACoveragePos = pos
-                
-            if prevTCConversions != tcCount[pos]:
-                print(chromosome + "\t" + str(prevTCConversionPos + 1) + "\t" + str(pos + 1) + "\t" + str(prevTCConversions), file = fileBedGraphTCConversions)
-                prevTCConversions = tcCount[pos]
-                prevTCConversionPos = pos
-                
-            if prevAGConversions != agCount[pos]:
-                print(chromosome + "\t" + str(prevAGConversionPos + 1) + "\t" + str(pos + 1) + "\t" + str(prevAGConversions), file = fileBedGraphAGConversions)
-                prevAGConversions = agCount[pos]
-                prevAGConversionPos = pos
-                
-            TCconversionRate = 0
-            if coveragePlus[pos] > 0 and coveragePlus[pos] >= coverageCutoff:
-                TCconversionRate = float(tcCount[pos]) / float(coveragePlus[pos])
-                
-            AGconversionRate = 0
-            if coverageMinus[pos] > 0 and coverageMinus[pos] >= coverageCutoff:
-                AGconversionRate = float(agCount[pos]) / float(coverageMinus[pos])
-                
-            if prevTCConversionRate != TCconversionRate:
-                print(chromosome + "\t" + str(prevTCConversionRatePos + 1) + "\t" + str(pos + 1) + "\t" + str(prevTCConversionRate), file = fileBedGraphRatesPlus)
-                prevTCConversionRate = TCconversionRate
-                prevTCConversionRatePos = pos
-                
-            if prevAGConversionRate != AGconversionRate:
-                print(chromosome + "\t" + str(prevAGConversionRatePos + 1) + "\t" + str(pos + 1) + "\t" + str(prevAGConversionRate), file = fileBedGraphRatesMinus)
-                prevAGConversionRate = AGconversionRate
-                prevAGConversionRatePos = pos
-                    
-    fileBedGraphRatesPlus.close()
-    fileBedGraphRatesMinus.close()
-    fileBedGraphCoveragePlus.close()
-    fileBedGraphCoverageMinus.close()
-    fileBedGraphTCConversions.close()
-    fileBedGraphAGConversions.close()
-    fileBedGraphT.close()
-    fileBedGraphA.close()
-    
-def genomewideReadSeparation(referenceFile, snpsFile, bam, minBaseQual, outputBAMPrefix, conversionThreshold, log):
-    
-    ref = pysam.FastaFile(referenceFile)
-     
+
+    chromosomeLengths = None
+    if(bigWig):
+        chromosomeLengths = [ (chromosome, testFile.getChromosomeLength(chromosome)) for chromosome in chromosomes ]
+    
+    # Chromosome shards are written to fragments in threads processes
+    _, shardFragmentFiles = runSharded(positionalTracksShard, bam, chromosomes, threads, referenceFile, snpsFile, bam, minBaseQual, conversionThreshold, coverageCutoff, windowSize, outputBedGraphPrefix)
+    
+    for i, (suffix, name, description) in enumerate(positionalTracks):
+        track = BedGraphTrack(outputBedGraphPrefix + suffix, "track type=bedGraph name=\"" + bedGraphInfo + " " + name + "\" description=\"" + description + "\"", chromosomeLengths)
+        for fragmentFiles in shardFragmentFiles:
+            track.appendFragment(fragmentFiles[i])
+            os.remove(fragmentFiles[i])
+        track.close()
+    
+def readNameHash(name):
+    # 64 bit hash of a read name
+    return int(hashlib.md5(name.encode("ascii")).hexdigest()[:16], 16)
+
+def tcReadHashShard(chromosomes, referenceFile, snpsFile, bam, minBaseQual, conversionThreshold, batchSize):
+    # Name hashes of the TC reads on chromosomes (see runSharded). Alignments
+    # are decoded in batches, nothing is written
     snps = SNPtools.SNPDictionary(snpsFile)
     snps.read()
     
-    # Go through one chr after the other
     testFile = SlamSeqBamFile(bam, referenceFile, snps)
     
-    samFile = pysam.AlignmentFile(bam, "rb")
-     
-    chromosomes = testFile.getChromosomes()
+    samFile = openBam(bam, "rb")
     
-    backgroundReadFileName = outputBAMPrefix + "_backgroundReads.bam"
-    tcReadFileName = outputBAMPrefix + "_TCReads.bam"
+    tcReadHashes = set()
+
+    def addTcReads(chromosome, reads):
+        isTcRead = SlamSeqReadBatch.fromRaw(decodeAlignments(reads), chromosome, 1, snps, minBaseQual, conversionThreshold).isTcRead
+        for index in np.flatnonzero(isTcRead).tolist():
+            tcReadHashes.add(readNameHash(reads[index].query_name))
+
+    for chromosome in chromosomes:
+        if(not testFile.isInReferenceFile(chromosome)):
+            continue
+        reads = []
+        for read in samFile.fetch(contig=chromosome):
+            if(len(reads) >= batchSize):
+                addTcReads(chromosome, reads)
+                reads = []
+            reads.append(read)
+        if(len(reads) > 0):
+            addTcReads(chromosome, reads)
+            
+    samFile.close()
+    return np.array(sorted(tcReadHashes), dtype=np.uint64)
+
+def readSeparationShard(chromosomes, bam, tcReadHashes, outputBAMPrefix):
+    # Writes the reads on chromosomes to BGZF-compressed background and TC
+    # read fragments (see runSharded). All alignments of a read go to the TC
+    # fragment if one of them is a TC read. Returns the fragment files
+    tcReadHashes = set(tcReadHashes.tolist())
+    
+    samFile = openBam(bam, "rb")
     
-    backgroundReadFile = pysam.AlignmentFile(backgroundReadFileName, "wb", template=samFile)
-    tcReadFile = pysam.AlignmentFile(tcReadFileName, "wb", template=samFile)
+    backgroundFragmentFile = getFragmentFile(outputBAMPrefix + "_backgroundReads.bam", ".bam")
+    tcFragmentFile = getFragmentFile(outputBAMPrefix + "_TCReads.bam", ".bam")
     
-    tcReadDict = dict()
+    backgroundReadFile = openBam(backgroundFragmentFile, "wb", template=samFile)
+    tcReadFile = openBam(tcFragmentFile, "wb", template=samFile)
     
     for chromosome in chromosomes:
-        
-        readIterator = testFile.readsInChromosome(chromosome, minBaseQual, conversionThreshold)
-             
-        for read in readIterator:
-            if (read.isTcRead) :
-                tcReadDict[read.name] = 0
-                
-    for read in samFile.fetch():
-        if read.query_name in tcReadDict:
-            tcReadFile.write(read)
-        else:
-            backgroundReadFile.write(read)
+        for read in samFile.fetch(contig=chromosome):
+            if(readNameHash(read.query_name) in tcReadHashes):
+                tcReadFile.write(read)
+            else:
+                backgroundReadFile.write(read)
             
     backgroundReadFile.close()
     tcReadFile.close()
+    samFile.close()
     
-    pysamIndex(backgroundReadFileName)
-    pysamIndex(tcReadFileName)
+    return backgroundFragmentFile, tcFragmentFile
+
+def genomewideReadSeparation(referenceFile, snpsFile, bam, minBaseQual, outputBAMPrefix, conversionThreshold, log, threads = 1, batchSize = 100000):
+    
+    samFile = openBam(bam, "rb")
+    chromosomes = list(samFile.references)
+    samFile.close()
+    
+    backgroundReadFileName = outputBAMPrefix + "_backgroundReads.bam"
+    tcReadFileName = outputBAMPrefix + "_TCReads.bam"
+    
+    # Chromosome shards (in BAM order) are processed in threads processes. First
+    # the names of all TC reads are collected (stored as 64 bit hashes), then every
+    # alignment is written once to a compressed fragment of its output file
+    _, results = runSharded(tcReadHashShard, bam, chromosomes, threads, referenceFile, snpsFile, bam, minBaseQual, conversionThreshold, batchSize)
+    tcReadHashes = np.unique(np.concatenate(results)) if len(results) > 0 else np.zeros(0, dtype=np.uint64)
+    print("Found " + str(len(tcReadHashes)) + " TC reads", file=log)
+    
+    _, results = runSharded(readSeparationShard, bam, chromosomes, threads, bam, tcReadHashes, outputBAMPrefix)
     
+    # Fragments are concatenated in shard order without recompression
+    concatenateBamFragments(backgroundReadFileName, [ backgroundFragmentFile for backgroundFragmentFile, _ in results ])
+    concatenateBamFragments(tcReadFileName, [ tcFragmentFile for _, tcFragmentFile in results ])
     
-    
\ No newline at end of file
+    pysamIndex(backgroundReadFileName)
+    pysamIndex(tcReadFileName)
@@ -32,7 +32,11 @@ from os.path import basename
 
 from joblib import Parallel, delayed
 from dunks import tcounter, mapper, filter, deduplicator, snps
-from utils.misc import replaceExtension, estimateMaxReadLength
+from utils.misc import replaceExtension, estimateMaxReadLength, getIOThreads
+from utils.AnnotationIndex import getAnnotationIndex
+from utils.TaskScheduler import TaskScheduler
+from utils import ReferenceProvider
+from utils.BamSorter import DefaultMaxRecords
 from version import __version__
 
 ########################################################################
@@ -129,6 +133,24 @@ def runMap(tid, inputBAM, referenceFile, threads, trim5p, maxPolyA, quantseqMapp
         outputSAM = os.path.join(outputDirectory, replaceExtension(basename(inputBAM), ".sam", "_slamdunk_mapped"))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(inputBAM), ".log", "_slamdunk_mapped"))
     
+    sampleName, sampleType, sampleTime = getSampleDescription(tid, sampleDescription)
+    
+    mapper.Map(inputBAM, referenceFile, outputSAM, getLogFile(outputLOG), quantseqMapping, endtoendMapping, threads=threads, trim5p=trim5p, maxPolyA=maxPolyA, topn=topn, sampleId=tid, sampleName=sampleName, sampleType=sampleType, sampleTime=sampleTime, printOnly=printOnly, verbose=verbose)
+    stepFinished()
+
+def runMapFilter(tid, inputBAM, referenceFile, threads, trim5p, maxPolyA, quantseqMapping, endtoendMapping, topn, sampleDescription, bed, mq, minIdentity, maxNM, outputDirectory, compressionLevel = None, sortBuffer = DefaultMaxRecords) :
+    # Same output file as running map and filter
+    outputBAM = os.path.join(outputDirectory, replaceExtension(basename(inputBAM), ".bam", "_slamdunk_mapped_filtered"))
+    outputLOG = os.path.join(outputDirectory, replaceExtension(basename(inputBAM), ".log", "_slamdunk_mapped_filtered"))
+    
+    sampleName, sampleType, sampleTime = getSampleDescription(tid, sampleDescription)
+    
+    log = getLogFile(outputLOG)
+    mapper.MapFilter(inputBAM, referenceFile, outputBAM, log, quantseqMapping, endtoendMapping, bed, mq, minIdentity, maxNM, threads=threads, compressionLevel=compressionLevel, maxRecords=sortBuffer, trim5p=trim5p, maxPolyA=maxPolyA, topn=topn, sampleId=tid, sampleName=sampleName, sampleType=sampleType, sampleTime=sampleTime, printOnly=printOnly, verbose=verbose)
+    closeLogFile(log)
+    stepFinished()
+
+def getSampleDescription(tid, sampleDescription):
     sampleName = "sample_" + str(tid)
     sampleType = "NA"
     sampleTime = "-1"
@@ -144,9 +166,7 @@ def runMap(tid, inputBAM, referenceFile, threads, trim5p, maxPolyA, quantseqMapp
                 sampleType = sampleDescriptions[1]
         if(len(sampleDescriptions) >= 3):
             sampleTime = sampleDescriptions[2]
-    
-    mapper.Map(inputBAM, referenceFile, outputSAM, getLogFile(outputLOG), quantseqMapping, endtoendMapping, threads=threads, trim5p=trim5p, maxPolyA=maxPolyA, topn=topn, sampleId=tid, sampleName=sampleName, sampleType=sampleType, sampleTime=sampleTime, printOnly=printOnly, verbose=verbose)
-    stepFinished()
+    return sampleName, sampleType, sampleTime
 
 def runSam2Bam(tid, bam, threads, outputDirectory):
     inputSAM = os.path.join(outputDirectory, replaceExtension(basename(bam), ".sam", "_slamdunk_mapped"))
@@ -163,19 +183,30 @@ def runDedup(tid, bam, outputDirectory) :
     closeLogFile(log)
     stepFinished()
         
-def runFilter(tid, bam, bed, mq, minIdentity, maxNM, outputDirectory):
+def runFilter(tid, bam, bed, mq, minIdentity, maxNM, outputDirectory, threads = 1, compressionLevel = None, sortBuffer = DefaultMaxRecords):
     outputBAM = os.path.join(outputDirectory, replaceExtension(basename(bam), ".bam", "_filtered"))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(bam), ".log", "_filtered"))
-    filter.Filter(bam, outputBAM, getLogFile(outputLOG), bed, mq, minIdentity, maxNM, printOnly, verbose)
+    filter.Filter(bam, outputBAM, getLogFile(outputLOG), bed, mq, minIdentity, maxNM, printOnly, verbose, threads=threads, compressionLevel=compressionLevel, maxRecords=sortBuffer)
     stepFinished()
 
-def runSnp(tid, referenceFile, minCov, minVarFreq, minQual, inputBAM, outputDirectory) :
+def runSnp(tid, referenceFile, minCov, minVarFreq, minQual, inputBAM, outputDirectory, snpCaller = "varscan", bed = None, maxLength = None, threads = 1) :
     outputSNP = os.path.join(outputDirectory, replaceExtension(basename(inputBAM), ".vcf", "_snp"))
     outputLOG = os.path.join(outputDirectory, replaceExtension(basename(inputBAM), ".log", "_snp"))
-    snps.SNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, minQual, getLogFile(outputLOG), printOnly, verbose, False)
+    
+    # SNPs in BED regions are called in regions padded by the read length
+    padding = 0
+    if (bed != None) :
+        if (maxLength == None) :
+            maxLength = estimateMaxReadLength(inputBAM)
+        if (maxLength < 0) :
+            print("Difference between minimum and maximum read length is > 10. Please specify --max-read-length parameter.")
+            sys.exit(0)
+        padding = maxLength
+    
+    snps.SNPs(inputBAM, outputSNP, referenceFile, minVarFreq, minCov, minQual, getLogFile(outputLOG), printOnly, verbose, False, threads, snpCaller, bed, padding)
     stepFinished()
                 
-def runCount(tid, bam, ref, bed, maxLength, minQual, conversionThreshold, outputDirectory, snpDirectory) :
+def runCount(tid, bam, ref, bed, maxLength, minQual, conversionThreshold, outputDirectory, snpDirectory, threads = 1) :
     outputCSV = os.path.join(outputDirectory, replaceExtension(basename(bam), ".tsv", "_tcount"))
     outputBedgraphPlus = os.path.join(outputDirectory, replaceExtension(basename(bam), ".bedgraph", "_tcount_plus"))
     outputBedgraphMinus = os.path.join(outputDirectory, replaceExtension(basename(bam), ".bedgraph", "_tcount_mins"))
@@ -195,10 +226,22 @@ def runCount(tid, bam, ref, bed, maxLength, minQual, conversionThreshold, output
     
     print("Using " + str(maxLength) + " as maximum read length.",file=log)
     
-    tcounter.computeTconversions(ref, bed, inputSNP, bam, maxLength, minQual, outputCSV, outputBedgraphPlus, outputBedgraphMinus, conversionThreshold, log)
+    tcounter.computeTconversions(ref, bed, inputSNP, bam, maxLength, minQual, outputCSV, outputBedgraphPlus, outputBedgraphMinus, conversionThreshold, log, threads=threads)
     stepFinished()
     return outputCSV
             
+def runCounts(bams, ref, bed, maxLength, minQual, conversionThreshold, outputDirectory, snpDirectory, threads) :
+    # Annotation index is shared by all samples
+    if (maxLength != None) :
+        getAnnotationIndex(bed, ref, maxLength)
+    # With fewer samples than threads, count one sample after the other using
+    # all threads for the UTRs of a sample. Avoids nested process pools.
+    if (len(bams) < threads) :
+        for tid in range(0, len(bams)):
+            runCount(tid, bams[tid], ref, bed, maxLength, minQual, conversionThreshold, outputDirectory, snpDirectory, threads)
+    else :
+        Parallel(n_jobs=threads, verbose=verbose)(delayed(runCount)(tid, bams[tid], ref, bed, maxLength, minQual, conversionThreshold, outputDirectory, snpDirectory) for tid in range(0, len(bams)))
+
 def runAll(args) :
     message("slamdunk all")
     
@@ -215,37 +258,8 @@ def runAll(args) :
     n = args.threads
     referenceFile = args.referenceFile
     
-    # Run mapper dunk
-    
-    dunkPath = os.path.join(outputDirectory, "map")
-    createDir(dunkPath)
-    
     samples, samplesInfos = getSamples(args.files, runOnly=args.sampleIndex)
     
-    message("Running slamDunk map for " + str(len(samples)) + " files (" + str(n) + " threads)")
-
-    for i in xrange(0, len(samples)):
-        bam = samples[i]
-        sampleInfo = samplesInfos[i]
-        tid = i
-        if args.sampleIndex > -1:
-            tid = args.sampleIndex
-        runMap(tid, bam, referenceFile, n, args.trim5, args.maxPolyA, args.quantseq, args.endtoend, args.topn, sampleInfo, dunkPath, args.skipSAM)
-        
-    dunkFinished()
-
-    if(not args.skipSAM):
-        message("Running slamDunk sam2bam for " + str(len(samples)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=1, verbose=verbose)(delayed(runSam2Bam)(tid, samples[tid], n, dunkPath) for tid in range(0, len(samples))) 
-        dunkFinished()
-           
-    dunkbufferIn = []
-    
-    for file in samples :
-        dunkbufferIn.append(os.path.join(dunkPath, replaceExtension(basename(file), ".bam", "_slamdunk_mapped")))
-            
-    # Run filter dunk
-    
     bed = args.bed
     
     if args.filterbed:
@@ -255,58 +269,66 @@ def runAll(args) :
     if (not args.multimap) :
         bed = None
         
-    dunkPath = os.path.join(outputDirectory, "filter")
-    createDir(dunkPath)
-       
-    message("Running slamDunk filter for " + str(len(samples)) + " files (" + str(n) + " threads)")
-    results = Parallel(n_jobs=n, verbose=verbose)(delayed(runFilter)(tid, dunkbufferIn[tid], bed, args.mq, args.identity, args.nm, dunkPath) for tid in range(0, len(samples)))
-    
-    dunkFinished()
-    
-    # Run filter dunk
-    
-    dunkbufferOut = []
-    
-    for file in dunkbufferIn :
-        dunkbufferOut.append(os.path.join(dunkPath, replaceExtension(basename(file), ".bam", "_filtered")))
-        
-    dunkbufferIn = dunkbufferOut
-    
-    dunkbufferOut = []
-    
-    dunkFinished()
-    
-    # Run snps dunk
-    
-    dunkPath = os.path.join(outputDirectory, "snp")
-    createDir(dunkPath)
+    mapPath = os.path.join(outputDirectory, "map")
+    filterPath = os.path.join(outputDirectory, "filter")
+    snpPath = os.path.join(outputDirectory, "snp")
+    countPath = os.path.join(outputDirectory, "count")
+    if not args.stream:
+        createDir(mapPath)
+    createDir(filterPath)
+    createDir(snpPath)
+    createDir(countPath)
+    
+    # Annotation index is shared by all samples
+    if (args.maxLength != None) :
+        getAnnotationIndex(args.bed, referenceFile, args.maxLength)
+    
+    # Each sample runs map -> sam2bam -> filter -> snp -> count. Stages of
+    # different samples overlap: NextGenMap and samtools use all but one
+    # core, so Python stages (filter, count) of other samples can run at the
+    # same time. samtools mpileup | VarScan uses two cores, the native SNP
+    # caller and count use chromosome / UTR shards
+    mapThreads = n
+    if (len(samples) > 1 and n > 1) :
+        mapThreads = n - 1
+    countThreads = max(1, n // max(1, len(samples)))
+    snpThreads = countThreads
+    if (args.snpCaller == "varscan") :
+        snpThreads = max(2, countThreads)
+    snpBed = None
+    if (args.snpInUtrs) :
+        snpBed = args.bed
     
     minCov = args.cov
     minVarFreq = args.var
     
-    snpThread = n
-    if(snpThread > 1):
-        snpThread = snpThread / 2
-        
-    #if (args.minQual == 0) :
-    #    snpqual = 13
-    #else :
-    snpqual = args.minQual
-    
-    message("Running slamDunk SNP for " + str(len(samples)) + " files (" + str(snpThread) + " threads)")
-    results = Parallel(n_jobs=snpThread, verbose=verbose)(delayed(runSnp)(tid, referenceFile, minCov, minVarFreq, snpqual, dunkbufferIn[tid], dunkPath) for tid in range(0, len(samples)))
+    # Base quality used by VarScan (--min-avg-qual) for both SNP callers
+    snpqual = 15
     
-    dunkFinished()
-    
-    # Run count dunk
-    
-    dunkPath = os.path.join(outputDirectory, "count")
-    createDir(dunkPath)
-
-    snpDirectory = os.path.join(outputDirectory, "snp")
+    scheduler = TaskScheduler(n)
+    for i in xrange(0, len(samples)):
+        bam = samples[i]
+        sampleInfo = samplesInfos[i]
+        tid = i
+        if args.sampleIndex > -1:
+            tid = args.sampleIndex
+        
+        mappedBAM = replaceExtension(basename(bam), ".bam", "_slamdunk_mapped")
+        filteredBAM = os.path.join(filterPath, replaceExtension(mappedBAM, ".bam", "_filtered"))
+        
+        if args.stream:
+            filterTask = scheduler.addTask("map and filter " + bam, runMapFilter, (tid, bam, referenceFile, mapThreads, args.trim5, args.maxPolyA, args.quantseq, args.endtoend, args.topn, sampleInfo, bed, args.mq, args.identity, args.nm, filterPath, args.compressionLevel, args.sortBuffer), mapThreads, priority=2)
+        else:
+            mapTask = scheduler.addTask("map " + bam, runMap, (tid, bam, referenceFile, mapThreads, args.trim5, args.maxPolyA, args.quantseq, args.endtoend, args.topn, sampleInfo, mapPath, args.skipSAM), mapThreads, priority=0)
+            if(not args.skipSAM):
+                mapTask = scheduler.addTask("sam2bam " + bam, runSam2Bam, (i, bam, mapThreads, mapPath), mapThreads, [ mapTask ], priority=1)
+            filterTask = scheduler.addTask("filter " + bam, runFilter, (i, os.path.join(mapPath, mappedBAM), bed, args.mq, args.identity, args.nm, filterPath, 1, args.compressionLevel, args.sortBuffer), 1, [ mapTask ], priority=2)
+        
+        snpTask = scheduler.addTask("snp " + bam, runSnp, (i, referenceFile, minCov, minVarFreq, snpqual, filteredBAM, snpPath, args.snpCaller, snpBed, args.maxLength, snpThreads), snpThreads, [ filterTask ], priority=3)
+        scheduler.addTask("count " + bam, runCount, (i, filteredBAM, referenceFile, args.bed, args.maxLength, args.minQual, args.conversionThreshold, countPath, snpPath, countThreads), countThreads, [ snpTask ], priority=4)
     
-    message("Running slamDunk tcount for " + str(len(samples)) + " files (" + str(n) + " threads)")
-    results = Parallel(n_jobs=n, verbose=verbose)(delayed(runCount)(tid, dunkbufferIn[tid], referenceFile, args.bed, args.maxLength, args.minQual, args.conversionThreshold, dunkPath, snpDirectory) for tid in range(0, len(samples)))
+    message("Running slamDunk map, filter, SNP and tcount for " + str(len(samples)) + " files (" + str(n) + " threads)")
+    scheduler.run()
     
     dunkFinished()
     
@@ -350,6 +372,8 @@ def run():
     filterparser.add_argument("-mi", "--min-identity", type=float, required=False, default=0.95, dest="identity", help="Minimum alignment identity (default: %(default)s)")
     filterparser.add_argument("-nm", "--max-nm", type=int, required=False, default=-1, dest="nm", help="Maximum NM for alignments (default: %(default)d)")
     filterparser.add_argument("-t", "--threads", type=int, required=False, dest="threads", default=1, help="Thread number (default: %(default)d)")
+    filterparser.add_argument("--compression-level", type=int, required=False, dest="compressionLevel", choices=range(0, 10), help="BGZF compression level of filtered BAM files, e.g. 1 for fast intermediate files (default: htslib default)")
+    filterparser.add_argument("--sort-buffer", type=int, required=False, dest="sortBuffer", default=DefaultMaxRecords, help="Number of reads sorted in memory before a sorted run is written to a temporary file. Lower values reduce memory usage (default: %(default)d)")
     
     # snp command
     
@@ -361,6 +385,10 @@ def run():
     #snpparser.add_argument("-q", "--min-base-qual", type=int, default=13, required=False, dest="minQual", help="Min base quality for T -> C conversions (default: %(default)d)")
     snpparser.add_argument("-f", "--var-fraction", required=False, dest="var", type=float, help="Minimimum variant fraction to call variant", default=0.8)
     snpparser.add_argument("-t", "--threads", type=int, required=False, default=1, dest="threads", help="Thread number")
+    snpparser.add_argument("--reference-cache", type=int, required=False, default=ReferenceProvider.DefaultCacheSize, dest="referenceCache", help="Memory (MB) for caching reference chromosomes, split between all threads. Not used for references packed with alleyoop packref")
+    snpparser.add_argument("--snp-caller", type=str, required=False, default="varscan", choices=snps.snpCallers, dest="snpCaller", help="SNP caller: varscan (samtools mpileup | VarScan) or native (pysam, faster, same coverage and variant fraction thresholds but without VarScan's p-value filter)")
+    snpparser.add_argument("-b", "--bed", type=str, required=False, dest="bed", help="BED file with 3'UTR coordinates. Only call SNPs in 3'UTRs padded by the maximum read length")
+    snpparser.add_argument("-rl", "--max-read-length", type=int, required=False, dest="maxLength", help="Max read length in BAM file (padding of 3'UTRs)")
     
     # count command
     
@@ -374,6 +402,7 @@ def run():
     countparser.add_argument("-l", "--max-read-length", type=int, required=False, dest="maxLength", help="Max read length in BAM file")
     countparser.add_argument("-q", "--min-base-qual", type=int, default=27, required=False, dest="minQual", help="Min base quality for T -> C conversions (default: %(default)d)")
     countparser.add_argument("-t", "--threads", type=int, required=False, default=1, dest="threads", help="Thread number (default: %(default)d)")
+    countparser.add_argument("--reference-cache", type=int, required=False, default=ReferenceProvider.DefaultCacheSize, dest="referenceCache", help="Memory (MB) for caching reference chromosomes, split between all threads. Not used for references packed with alleyoop packref (default: %(default)d)")
     
     
     # all command
@@ -388,6 +417,9 @@ def run():
     allparser.add_argument("-a", "--max-polya", type=int, required=False, dest="maxPolyA", default=4, help="Max number of As at the 3' end of a read (default: %(default)s)")
     allparser.add_argument("-n", "--topn", type=int, required=False, dest="topn", default=1, help="Max. number of alignments to report per read (default: %(default)s)")
     allparser.add_argument("-t", "--threads", type=int, required=False, default=1, dest="threads", help="Thread number (default: %(default)s)")
+    allparser.add_argument("--reference-cache", type=int, required=False, default=ReferenceProvider.DefaultCacheSize, dest="referenceCache", help="Memory (MB) for caching reference chromosomes, split between all threads. Not used for references packed with alleyoop packref (default: %(default)s)")
+    allparser.add_argument("--compression-level", type=int, required=False, dest="compressionLevel", choices=range(0, 10), help="BGZF compression level of filtered BAM files, e.g. 1 for fast intermediate files (default: htslib default)")
+    allparser.add_argument("--sort-buffer", type=int, required=False, dest="sortBuffer", default=DefaultMaxRecords, help="Number of reads sorted in memory before a sorted run is written to a temporary file. Lower values reduce memory usage (default: %(default)s)")
     allparser.add_argument("-q", "--quantseq", dest="quantseq", action='store_true', required=False, help="Run plain Quantseq alignment without SLAM-seq scoring")
     allparser.add_argument('-e', "--endtoend", action='store_true', dest="endtoend", help="Use a end to end alignment algorithm for mapping.")
     allparser.add_argument('-m', "--multimap", action='store_true', dest="multimap", help="Use reference to resolve multimappers (requires -n > 1).")
@@ -396,11 +428,14 @@ def run():
     allparser.add_argument("-nm", "--max-nm", type=int, required=False, default=-1, dest="nm", help="Maximum NM for alignments (default: %(default)s)")
     allparser.add_argument("-mc", "--min-coverage", required=False, dest="cov", type=int, help="Minimimum coverage to call variant (default: %(default)s)", default=10)
     allparser.add_argument("-mv", "--var-fraction", required=False, dest="var", type=float, help="Minimimum variant fraction to call variant (default: %(default)s)", default=0.8)
+    allparser.add_argument("--snp-caller", type=str, required=False, default="varscan", choices=snps.snpCallers, dest="snpCaller", help="SNP caller: varscan (samtools mpileup | VarScan) or native (pysam, faster, same coverage and variant fraction thresholds but without VarScan's p-value filter) (default: %(default)s)")
+    allparser.add_argument("--snp-in-utrs", action='store_true', dest="snpInUtrs", help="Only call SNPs in 3'UTRs (-b) padded by the maximum read length. SNPs outside of 3'UTRs are not used for counting")
     allparser.add_argument("-c", "--conversion-threshold", type=int, dest="conversionThreshold", required=False, default=1,help="Number of T>C conversions required to count read as T>C read (default: %(default)d)")
     allparser.add_argument("-rl", "--max-read-length", type=int, required=False, dest="maxLength", help="Max read length in BAM file")
     allparser.add_argument("-mbq", "--min-base-qual", type=int, default=27, required=False, dest="minQual", help="Min base quality for T -> C conversions (default: %(default)d)")
     allparser.add_argument("-i", "--sample-index", type=int, required=False, default=-1, dest="sampleIndex", help="Run analysis only for sample <i>. Use for distributing slamdunk analysis on a cluster (index is 1-based).")
     allparser.add_argument("-ss", "--skip-sam", action='store_true', dest="skipSAM", help="Output BAM while mapping. Slower but, uses less hard disk.")
+    allparser.add_argument("-st", "--stream", action='store_true', dest="stream", help="Filter and sort reads while mapping. Only the filtered BAM files are written to disk.")
     
     args = parser.parse_args()
     
@@ -410,6 +445,9 @@ def run():
     
     command = args.command
     
+    if ("referenceCache" in args) :
+        ReferenceProvider.setCacheSize(args.referenceCache, args.threads)
+    
     if (command == "map") :
         mapper.checkNextGenMapVersion()
         
@@ -447,7 +485,8 @@ def run():
         createDir(outputDirectory)
         n = args.threads
         message("Running slamDunk filter for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runFilter)(tid, args.bam[tid], args.bed, args.mq, args.identity, args.nm, outputDirectory) for tid in range(0, len(args.bam)))
+        ioThreads = getIOThreads(n, min(n, len(args.bam)))
+        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runFilter)(tid, args.bam[tid], args.bed, args.mq, args.identity, args.nm, outputDirectory, ioThreads, args.compressionLevel, args.sortBuffer) for tid in range(0, len(args.bam)))
         dunkFinished()
         
     elif (command == "snp") :
@@ -459,10 +498,18 @@ def run():
         #minQual = args.minQual
         minQual = 15
         n = args.threads
-        if(n > 1):
-            n = n / 2
+        # samtools mpileup | VarScan uses two cores
+        jobs = n
+        if(args.snpCaller == "varscan" and n > 1):
+            jobs = n / 2
         message("Running slamDunk SNP for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runSnp)(tid, fasta, minCov, minVarFreq, minQual, args.bam[tid], outputDirectory) for tid in range(0, len(args.bam)))
+        # With fewer samples than jobs, one sample after the other using all
+        # threads for region shards
+        if (len(args.bam) < jobs) :
+            for tid in range(0, len(args.bam)):
+                runSnp(tid, fasta, minCov, minVarFreq, minQual, args.bam[tid], outputDirectory, args.snpCaller, args.bed, args.maxLength, n)
+        else :
+            results = Parallel(n_jobs=jobs, verbose=verbose)(delayed(runSnp)(tid, fasta, minCov, minVarFreq, minQual, args.bam[tid], outputDirectory, args.snpCaller, args.bed, args.maxLength) for tid in range(0, len(args.bam)))
         dunkFinished()
             
     elif (command == "count") :
@@ -471,7 +518,7 @@ def run():
         snpDirectory = args.snpDir
         n = args.threads
         message("Running slamDunk tcount for " + str(len(args.bam)) + " files (" + str(n) + " threads)")
-        results = Parallel(n_jobs=n, verbose=verbose)(delayed(runCount)(tid, args.bam[tid], args.ref, args.bed, args.maxLength, args.minQual, args.conversionThreshold, outputDirectory, snpDirectory) for tid in range(0, len(args.bam)))
+        runCounts(args.bam, args.ref, args.bed, args.maxLength, args.minQual, args.conversionThreshold, outputDirectory, snpDirectory, n)
         dunkFinished()    
         
     elif (command == "all") :
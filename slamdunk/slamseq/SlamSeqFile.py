@@ -18,6 +18,11 @@
 from __future__ import print_function
 import pysam
 import re
+import os
+import numpy as np
+
+from slamdunk.utils.ReferenceProvider import getReferenceProvider  # @UnresolvedImport
+from slamdunk.utils.misc import openBam  # @UnresolvedImport
 
 class ReadDirection:
     Forward = 1
@@ -191,9 +196,11 @@ class SlamSeqWriter:
 
     _seperator = '\t'
 
-    def __init__(self, fileName):
+    def __init__(self, fileName, header = True):
+        # header: False for fragments that are appended to a file with header
         self._file = open(fileName, "w")
-        self._printHeader()
+        if header:
+            self._printHeader()
 
     def _printHeader(self):
         print("Name", file=self._file, end=self._seperator)
@@ -317,9 +324,18 @@ class SlamSeqBamIterator:
         mismatchList = []
         if (read.has_tag("MP")) :
 
-            ngmMismatches = read.get_tag("MP").split(",")
-            for mismatch in ngmMismatches:
-                conversion, readPos, refPos = mismatch.split(":")
+            ngmMismatches = [ mismatch.split(":") for mismatch in read.get_tag("MP").split(",") ]
+
+            # SNP lookup for all mismatches of the read at once
+            snpPositions = [ read.reference_start + int(refPos) - 1 for conversion, readPos, refPos in ngmMismatches ]
+            if self._snps == None:
+                isSnp = [ False ] * len(snpPositions)
+            elif read.is_reverse:
+                isSnp = self._snps.isAGSnpArray(self._chromosome, snpPositions).tolist()
+            else:
+                isSnp = self._snps.isTCSnpArray(self._chromosome, snpPositions).tolist()
+
+            for (conversion, readPos, refPos), isSnpPos in zip(ngmMismatches, isSnp):
                 refBase, readBase = self.MPTagToConversion(conversion)
                 readPos = int(readPos) - 1
 
@@ -328,10 +344,7 @@ class SlamSeqBamIterator:
                     refPos = int(refPos) - 1
 
                     if(read.is_reverse):
-                        isSnpPos = self._snps != None and self._snps.isAGSnp(self._chromosome, read.reference_start + int(refPos))
                         readPos = read.query_length - readPos - 1
-                    else :
-                        isSnpPos = self._snps != None and self._snps.isTCSnp(self._chromosome, read.reference_start + int(refPos))
 
                     refPos = read.reference_start - self._startPosition + refPos
 
@@ -398,10 +411,384 @@ class SlamSeqBamIterator:
 
         return slamSeqRead
 
+# Base codes used by the batch decoder. Same order as SlamSeqConversionRates:
+# A = 0, C = 1, G = 2, T = 3, N = 4 (5 = not counted)
+BaseCode = { 'A' : 0, 'C' : 1, 'G' : 2, 'T' : 3, 'N' : 4 }
+
+def _baseLookup(bases):
+    lookup = np.full(256, 5, dtype=np.uint8)
+    for base in bases:
+        lookup[ord(base)] = BaseCode[base.upper()]
+    return lookup
+
+# query_alignment_sequence.count(base) only counts upper case bases
+_alignedBaseLookup = _baseLookup("ACGTN")
+# getTcount() counts upper and lower case bases
+_sequenceBaseLookup = _baseLookup("ACGTNacgtn")
+
+# MP tag conversion id -> reference base / read base (see table in SlamSeqBamIterator)
+_mpReferenceBase = (np.arange(25) // 5).astype(np.uint8)
+_mpReadBase = (np.arange(25) % 5).astype(np.uint8)
+
+def _toBytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("ascii")
+
+def _baseCounts(sequences, lookup, readCount):
+    # Per read base counts (readCount x 5) of a list of sequences
+    lengths = np.fromiter((len(x) for x in sequences), dtype=np.int64, count=readCount)
+    codes = lookup[np.frombuffer(_toBytes("".join(sequences)), dtype=np.uint8)]
+    readIndex = np.repeat(np.arange(readCount), lengths)
+    counted = codes < 5
+    counts = np.bincount(readIndex[counted] * 5 + codes[counted], minlength=readCount * 5)
+    return counts.reshape(readCount, 5)
+
+def decodeAlignments(reads):
+    # Decodes a list of pysam reads into plain arrays. Mismatches are stored
+    # unfiltered (no base quality or SNP filter) and relative to the
+    # alignment start, so they can be finished for any region or
+    # minimum base quality by SlamSeqReadBatch.fromRaw
+    readCount = len(reads)
+
+    raw = {}
+    raw['referenceStart'] = np.fromiter((read.reference_start for read in reads), dtype=np.int64, count=readCount)
+    raw['referenceEnd'] = np.fromiter((read.reference_end for read in reads), dtype=np.int64, count=readCount)
+    raw['isReverse'] = np.fromiter((read.is_reverse for read in reads), dtype=np.bool_, count=readCount)
+    raw['isMultimapper'] = np.fromiter((read.mapping_quality == 0 for read in reads), dtype=np.bool_, count=readCount)
+    raw['readLength'] = np.fromiter((read.query_length for read in reads), dtype=np.int32, count=readCount)
+
+    # Ts (forward) or As (reverse) in the read sequence, see SlamSeqRead.getTcount
+    sequenceCounts = _baseCounts([read.query_sequence for read in reads], _sequenceBaseLookup, readCount)
+    raw['tCount'] = np.where(raw['isReverse'], sequenceCounts[:, BaseCode['A']], sequenceCounts[:, BaseCode['T']]).astype(np.int32)
+    # Base counts of the aligned part of the read, used for conversion rates
+    raw['baseCounts'] = _baseCounts([read.query_alignment_sequence for read in reads], _alignedBaseLookup, readCount).astype(np.int32)
+
+    # Parse all MP tags of the batch at once: "conversion:readPos:refPos,..."
+    mpTags = [read.get_tag("MP") if read.has_tag("MP") else "" for read in reads]
+    mismatchCounts = np.fromiter(((x.count(",") + 1) if len(x) > 0 else 0 for x in mpTags), dtype=np.int64, count=readCount)
+    mismatchOffsets = np.zeros(readCount + 1, dtype=np.int64)
+    np.cumsum(mismatchCounts, out=mismatchOffsets[1:])
+    mpString = ",".join(x for x in mpTags if len(x) > 0)
+    if len(mpString) > 0:
+        mp = np.array(mpString.replace(":", ",").split(","), dtype=np.int64).reshape(-1, 3)
+    else:
+        mp = np.zeros((0, 3), dtype=np.int64)
+
+    raw['mismatchOffsets'] = mismatchOffsets
+    raw['mismatchConversion'] = mp[:, 0].astype(np.uint8)
+    raw['mismatchReadPos'] = (mp[:, 1] - 1).astype(np.int32)
+    raw['mismatchRefOffset'] = (mp[:, 2] - 1).astype(np.int32)
+
+    # Base quality of every mismatch
+    readIndex = np.repeat(np.arange(readCount), mismatchCounts)
+    qualityOffsets = np.zeros(readCount + 1, dtype=np.int64)
+    np.cumsum(raw['readLength'], out=qualityOffsets[1:])
+    if len(mp) > 0:
+        qualities = np.concatenate([np.frombuffer(read.query_qualities, dtype=np.uint8) for read in reads])
+        raw['mismatchQuality'] = qualities[qualityOffsets[readIndex] + raw['mismatchReadPos']]
+    else:
+        raw['mismatchQuality'] = np.zeros(0, dtype=np.uint8)
+
+    return raw
+
+class SlamSeqReadBatch:
+
+    # Struct-of-arrays version of a list of SlamSeqReads. Per read values are
+    # stored in arrays of length size, mismatches are stored in flat arrays
+    # and the mismatches of read i are found at
+    # mismatchOffsets[i]:mismatchOffsets[i + 1] (CSR layout)
+
+    def __len__(self):
+        return self.size
+
+    def __init__(self, chromosome, size):
+        self.chromosome = chromosome
+        # Number of reads
+        self.size = size
+        # Start/end position relative to the region start
+        self.startRefPos = None
+        self.endRefPos = None
+        # Read direction
+        self.isReverse = None
+        # MQ 0 reads
+        self.isMultimapper = None
+        # Read length
+        self.readLength = None
+        # Number of Ts (As on reverse reads) in the read, see SlamSeqRead.getTcount
+        self.tCount = None
+        # Number of T>C (A>G on reverse reads) conversions
+        self.tcCount = None
+        # Number of T>C conversions >= conversionThreshold
+        self.isTcRead = None
+        # Conversion rates of all reads (size x 25, see SlamSeqConversionRates)
+        self.conversionRates = None
+        # Mismatches
+        self.mismatchOffsets = None
+        self.mismatchReadPos = None
+        self.mismatchRefPos = None
+        self.mismatchReadBase = None
+        self.mismatchRefBase = None
+        self.mismatchQuality = None
+        self.mismatchIsSnp = None
+        self.mismatchIsTc = None
+
+    def getMismatchReadIndex(self):
+        # Index of the read each mismatch belongs to
+        return np.repeat(np.arange(self.size), np.diff(self.mismatchOffsets))
+
+    def select(self, mask):
+        # Returns a new batch containing only the reads in mask (boolean array)
+        return self.selectReads(np.flatnonzero(mask))
+
+    def selectReads(self, index):
+        # Returns a new batch containing only the reads in index (sorted read
+        # indices). Only touches the selected reads and their mismatches
+        batch = SlamSeqReadBatch(self.chromosome, len(index))
+        for name in [ "startRefPos", "endRefPos", "isReverse", "isMultimapper", "readLength", "tCount", "tcCount", "isTcRead", "conversionRates" ]:
+            setattr(batch, name, getattr(self, name)[index])
+
+        mismatchStart = self.mismatchOffsets[index]
+        mismatchCounts = self.mismatchOffsets[index + 1] - mismatchStart
+        batch.mismatchOffsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(mismatchCounts, out=batch.mismatchOffsets[1:])
+        mismatchIndex = np.arange(batch.mismatchOffsets[-1]) + np.repeat(mismatchStart - batch.mismatchOffsets[:-1], mismatchCounts)
+        for name in [ "mismatchReadPos", "mismatchRefPos", "mismatchReadBase", "mismatchRefBase", "mismatchQuality", "mismatchIsSnp", "mismatchIsTc" ]:
+            setattr(batch, name, getattr(self, name)[mismatchIndex])
+
+        return batch
+
+    @classmethod
+    def fromRaw(cls, raw, chromosome, startPosition, snps, minQual, conversionThreshold):
+        # Applies base quality and SNP filter to decoded alignments (see
+        # decodeAlignments) and computes the same values as SlamSeqBamIterator
+        readCount = len(raw['referenceStart'])
+        batch = cls(chromosome, readCount)
+
+        batch.startRefPos = raw['referenceStart'] - int(startPosition)
+        batch.endRefPos = raw['referenceEnd'] - int(startPosition)
+        batch.isReverse = raw['isReverse']
+        batch.isMultimapper = raw['isMultimapper']
+        batch.readLength = raw['readLength']
+        batch.tCount = raw['tCount']
+
+        # Mismatches below minQual are skipped (see fillMismatchesNGM)
+        readIndex = np.repeat(np.arange(readCount), np.diff(raw['mismatchOffsets']))
+        keep = raw['mismatchQuality'] >= minQual
+        readIndex = readIndex[keep]
+        batch.mismatchOffsets = np.zeros(readCount + 1, dtype=np.int64)
+        np.cumsum(np.bincount(readIndex, minlength=readCount), out=batch.mismatchOffsets[1:])
+
+        isReverse = batch.isReverse[readIndex]
+        readPos = raw['mismatchReadPos'][keep]
+        refOffset = raw['mismatchRefOffset'][keep]
+        conversion = raw['mismatchConversion'][keep]
+        referenceStart = raw['referenceStart'][readIndex]
+
+        batch.mismatchReadPos = np.where(isReverse, batch.readLength[readIndex] - readPos - 1, readPos)
+        batch.mismatchRefPos = referenceStart - int(startPosition) + refOffset
+        batch.mismatchRefBase = _mpReferenceBase[conversion]
+        batch.mismatchReadBase = _mpReadBase[conversion]
+        batch.mismatchQuality = raw['mismatchQuality'][keep]
+
+        if snps != None:
+            genomePos = referenceStart + refOffset
+            batch.mismatchIsSnp = np.where(isReverse, snps.isAGSnpArray(chromosome, genomePos), snps.isTCSnpArray(chromosome, genomePos))
+        else:
+            batch.mismatchIsSnp = np.zeros(len(readIndex), dtype=np.bool_)
+
+        isTc = np.where(isReverse, (batch.mismatchRefBase == BaseCode['A']) & (batch.mismatchReadBase == BaseCode['G']), (batch.mismatchRefBase == BaseCode['T']) & (batch.mismatchReadBase == BaseCode['C']))
+        batch.mismatchIsTc = isTc & ~batch.mismatchIsSnp
+
+        batch.tcCount = np.bincount(readIndex[batch.mismatchIsTc], minlength=readCount).astype(np.int32)
+        batch.isTcRead = batch.tcCount >= conversionThreshold
+
+        # Conversion rates, see SlamSeqBamIterator.computeRatesForRead
+        rates = np.zeros((readCount, 25), dtype=np.int32)
+        baseNumber = SlamSeqConversionRates._baseNumber
+        rates[:, [ baseNumber * i + i for i in range(baseNumber) ]] = raw['baseCounts']
+        flatRates = rates.reshape(-1)
+        readBase = batch.mismatchReadBase.astype(np.int64)
+        refBase = batch.mismatchRefBase.astype(np.int64)
+        np.add.at(flatRates, readIndex * 25 + np.where(batch.mismatchIsSnp, refBase * baseNumber + refBase, refBase * baseNumber + readBase), 1)
+        np.add.at(flatRates, readIndex * 25 + readBase * baseNumber + readBase, -1)
+        batch.conversionRates = rates
+
+        return batch
+
+class SlamSeqBatchIterator:
+
+    # Same as SlamSeqBamIterator, but returns SlamSeqReadBatches of up to
+    # batchSize reads instead of one SlamSeqRead per read
+
+    def __init__(self, readIterator, chromosome, startPosition, strand, snps, minQual, conversionThreshold = 1, batchSize = 100000):
+        self._readIterator = readIterator
+        self._chromosome = chromosome
+        self._startPosition = startPosition
+        self._strand = strand
+        self._snps = snps
+        self._minQual = minQual
+        self._conversionThreshold = conversionThreshold
+        self._batchSize = batchSize
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        reads = []
+        for read in self._readIterator:
+            # Strand-specific assay - skip all reads from antisense-strand
+            if((self._strand == "+" and read.is_reverse) or (self._strand == "-" and not read.is_reverse)) :
+                continue
+            reads.append(read)
+            if(len(reads) >= self._batchSize):
+                break
+
+        if(len(reads) == 0):
+            raise StopIteration
+
+        return SlamSeqReadBatch.fromRaw(decodeAlignments(reads), self._chromosome, self._startPosition, self._snps, self._minQual, self._conversionThreshold)
+
+    __next__ = next
+
+# Columnar sidecar with the decoded alignments (see decodeAlignments) of a BAM file.
+# Stored in <bam>.slamseq/: one <tid>.npz file per chromosome and a manifest with
+# size and modification time of the BAM file. A sidecar is only used while the
+# BAM file is unchanged
+SidecarVersion = "1"
+
+_rawReadColumns = [ 'referenceStart', 'referenceEnd', 'isReverse', 'isMultimapper', 'readLength', 'tCount', 'baseCounts' ]
+_rawMismatchColumns = [ 'mismatchConversion', 'mismatchReadPos', 'mismatchRefOffset', 'mismatchQuality' ]
+
+def getSidecarDirectory(bamFile):
+    return bamFile + ".slamseq"
+
+def _sidecarManifest(bamFile, references):
+    stat = os.stat(bamFile)
+    return "\n".join([ "version\t" + SidecarVersion, "size\t" + str(stat.st_size), "mtime\t" + repr(stat.st_mtime), "references\t" + ",".join(references) ]) + "\n"
+
+def _concatenateRaw(raws):
+    raw = {}
+    for name in _rawReadColumns + _rawMismatchColumns:
+        raw[name] = np.concatenate([ x[name] for x in raws ])
+    mismatchCounts = np.concatenate([ np.diff(x['mismatchOffsets']) for x in raws ])
+    raw['mismatchOffsets'] = np.zeros(len(mismatchCounts) + 1, dtype=np.int64)
+    np.cumsum(mismatchCounts, out=raw['mismatchOffsets'][1:])
+    return raw
+
+def _selectRaw(raw, index):
+    # Decoded alignments of the reads in index (sorted read indices)
+    selected = {}
+    for name in _rawReadColumns:
+        selected[name] = raw[name][index]
+    mismatchStart = raw['mismatchOffsets'][index]
+    mismatchCounts = raw['mismatchOffsets'][index + 1] - mismatchStart
+    selected['mismatchOffsets'] = np.zeros(len(index) + 1, dtype=np.int64)
+    np.cumsum(mismatchCounts, out=selected['mismatchOffsets'][1:])
+    mismatchIndex = np.arange(selected['mismatchOffsets'][-1]) + np.repeat(mismatchStart - selected['mismatchOffsets'][:-1], mismatchCounts)
+    for name in _rawMismatchColumns:
+        selected[name] = raw[name][mismatchIndex]
+    return selected
+
+def writeSidecar(bamFile, batchSize = 100000):
+
+    sidecarDirectory = getSidecarDirectory(bamFile)
+    if not os.path.exists(sidecarDirectory):
+        os.makedirs(sidecarDirectory)
+    manifestFile = os.path.join(sidecarDirectory, "manifest.txt")
+    if os.path.exists(manifestFile):
+        os.remove(manifestFile)
+
+    bam = pysam.AlignmentFile(bamFile, "rb")
+    for tid, chromosome in enumerate(bam.references):
+        chromosomeFile = os.path.join(sidecarDirectory, str(tid) + ".npz")
+        if os.path.exists(chromosomeFile):
+            os.remove(chromosomeFile)
+
+        raws = []
+        reads = []
+        for read in bam.fetch(reference=chromosome):
+            if read.is_unmapped:
+                continue
+            reads.append(read)
+            if len(reads) >= batchSize:
+                raws.append(decodeAlignments(reads))
+                reads = []
+        if len(reads) > 0:
+            raws.append(decodeAlignments(reads))
+
+        if len(raws) > 0:
+            np.savez(chromosomeFile, **_concatenateRaw(raws))
+
+    references = list(bam.references)
+    bam.close()
+
+    # Written last: sidecars without manifest are never used
+    with open(manifestFile, "w") as f:
+        f.write(_sidecarManifest(bamFile, references))
+
+class SlamSeqSidecar:
+
+    @classmethod
+    def open(cls, bamFile, references):
+        # Returns the sidecar of bamFile or None if there is no up-to-date sidecar
+        manifestFile = os.path.join(getSidecarDirectory(bamFile), "manifest.txt")
+        if not os.path.exists(manifestFile):
+            return None
+        with open(manifestFile, "r") as f:
+            if f.read() != _sidecarManifest(bamFile, references):
+                return None
+        return cls(bamFile, references)
+
+    def __init__(self, bamFile, references):
+        self._sidecarDirectory = getSidecarDirectory(bamFile)
+        self._references = references
+        # Decoded alignments of the last chromosome
+        self._chromosome = None
+        self._raw = None
+
+    def _load(self, chromosome):
+        if chromosome != self._chromosome:
+            self._raw = None
+            chromosomeFile = os.path.join(self._sidecarDirectory, str(self._references.index(chromosome)) + ".npz")
+            if os.path.exists(chromosomeFile):
+                data = np.load(chromosomeFile)
+                self._raw = dict((name, data[name]) for name in data.files)
+                data.close()
+                self._maxSpan = int(np.max(self._raw['referenceEnd'] - self._raw['referenceStart']))
+            self._chromosome = chromosome
+        return self._raw
+
+    def readBatches(self, chromosome, start, stop, strand, startPosition, snps, minQual, conversionThreshold = 1, batchSize = 100000):
+        # Same reads as SlamSeqBatchIterator on bam.fetch(chromosome, start, stop).
+        # start/stop None returns all reads of the chromosome
+        raw = self._load(chromosome)
+        if raw is None:
+            return
+
+        if start is None:
+            index = np.arange(len(raw['referenceStart']))
+        elif start >= stop:
+            return
+        else:
+            first = np.searchsorted(raw['referenceStart'], start - self._maxSpan, side='left')
+            last = np.searchsorted(raw['referenceStart'], stop, side='left')
+            index = first + np.flatnonzero(raw['referenceEnd'][first:last] > start)
+
+        # Strand-specific assay - skip all reads from antisense-strand
+        if strand == "+":
+            index = index[~raw['isReverse'][index]]
+        elif strand == "-":
+            index = index[raw['isReverse'][index]]
+
+        for batchStart in xrange(0, len(index), batchSize):
+            yield SlamSeqReadBatch.fromRaw(_selectRaw(raw, index[batchStart:batchStart + batchSize]), chromosome, startPosition, snps, minQual, conversionThreshold)
+
 class SlamSeqBamFile:
 
-    def __init__(self, bamFile, referenceFile, snps):
-        self._bamFile = pysam.AlignmentFile(bamFile, "rb")
+    def __init__(self, bamFile, referenceFile, snps, threads = 1):
+        # threads: BGZF decompression threads
+        self._bamFile = openBam(bamFile, "rb", threads)
 
         # Get version from BAM file
         self.bamVersion = "None"
@@ -410,13 +797,20 @@ class SlamSeqBamFile:
                 if pg['ID'] == "slamdunk":
                     self.bamVersion = pg['VN']
 
-        self._referenceFile = pysam.FastaFile(referenceFile)
+        # referenceFile can be a FASTA file or a ReferenceProvider. Providers
+        # are shared by all SlamSeqBamFiles of a process
+        self._referenceFile = getReferenceProvider(referenceFile)
         self._snps = snps
 
-    def readInRegion(self, chromosome, start, stop, strand, maxReadLength, minQual = 0, conversionThreshold = 1):
+        # Decoded alignments written by alleyoop index
+        self._sidecar = SlamSeqSidecar.open(bamFile, list(self._bamFile.references))
+
+    def readInRegion(self, chromosome, start, stop, strand, maxReadLength, minQual = 0, conversionThreshold = 1, refSeq = None):
 
+        # refSeq: reference sequence of the region padded by maxReadLength (see
+        # AnnotationIndex.getSequence). Fetched from the reference if not given
         if(self.isInReferenceFile(chromosome)):
-            chromosomeLength = self._referenceFile.get_reference_length(chromosome)
+            chromosomeLength = self._referenceFile.getLength(chromosome)
 
             fillupLeft = 0
             leftBorder = int(start) - maxReadLength
@@ -430,9 +824,10 @@ class SlamSeqBamFile:
                 fillupRight =  rightBorder - chromosomeLength
                 rightBorder = chromosomeLength
 
-            refSeq = self._referenceFile.fetch(reference=chromosome, start=leftBorder, end=rightBorder).upper()
-            # If start or top is less than maxReadLength bp away from chromosome start or end, fill up with Ns
-            refSeq = 'N' * fillupLeft + refSeq + 'N' * fillupRight
+            if(refSeq == None):
+                refSeq = self._referenceFile.fetch(chromosome, leftBorder, rightBorder)
+                # If start or top is less than maxReadLength bp away from chromosome start or end, fill up with Ns
+                refSeq = 'N' * fillupLeft + refSeq + 'N' * fillupRight
 
             if (chromosome in self._bamFile.references) :
                 return SlamSeqBamIterator(self._bamFile.fetch(reference=chromosome, start=max(0, start), end=min(chromosomeLength, stop)), refSeq, chromosome, start, strand, maxReadLength, self._snps, minQual, conversionThreshold)
@@ -441,10 +836,41 @@ class SlamSeqBamFile:
         else:
             return iter([])
 
+    def readBatchesInInterval(self, chromosome, start, stop, minQual = 0, conversionThreshold = 1, batchSize = 100000):
+
+        # Reads of both strands overlapping start - stop. Positions are relative to the chromosome start
+        if(self.isInReferenceFile(chromosome) and chromosome in self._bamFile.references):
+            chromosomeLength = self._referenceFile.getLength(chromosome)
+            if(self._sidecar != None):
+                return self._sidecar.readBatches(chromosome, max(0, start), min(chromosomeLength, stop), ".", 0, self._snps, minQual, conversionThreshold, batchSize)
+            return SlamSeqBatchIterator(self._bamFile.fetch(reference=chromosome, start=max(0, start), end=min(chromosomeLength, stop)), chromosome, 0, ".", self._snps, minQual, conversionThreshold, batchSize)
+        else:
+            return iter([])
+
+    def readBatchesInRegion(self, chromosome, start, stop, strand, maxReadLength, minQual = 0, conversionThreshold = 1, batchSize = 100000):
+
+        if(self.isInReferenceFile(chromosome) and chromosome in self._bamFile.references):
+            chromosomeLength = self._referenceFile.getLength(chromosome)
+            if(self._sidecar != None):
+                return self._sidecar.readBatches(chromosome, max(0, start), min(chromosomeLength, stop), strand, start, self._snps, minQual, conversionThreshold, batchSize)
+            return SlamSeqBatchIterator(self._bamFile.fetch(reference=chromosome, start=max(0, start), end=min(chromosomeLength, stop)), chromosome, start, strand, self._snps, minQual, conversionThreshold, batchSize)
+        else:
+            return iter([])
+
+    def readBatchesInChromosome(self, chromosome, minQual = 0, conversionThreshold = 1, batchSize = 100000):
+
+        # Positions are relative to 1 as in readsInChromosome
+        if (chromosome in self._bamFile.references) :
+            if(self._sidecar != None):
+                return self._sidecar.readBatches(chromosome, None, None, ".", 1, self._snps, minQual, conversionThreshold, batchSize)
+            return SlamSeqBatchIterator(self._bamFile.fetch(reference=chromosome), chromosome, 1, ".", self._snps, minQual, conversionThreshold, batchSize)
+        else :
+            return iter([])
+
     def readsInChromosome(self, chromosome, minQual = 0, conversionThreshold = 1):
 
         if (chromosome in self._bamFile.references) :
-            refSeq = self._referenceFile.fetch(reference=chromosome).upper()
+            refSeq = self._referenceFile.getSequence(chromosome)
             return SlamSeqBamIterator(self._bamFile.fetch(reference=chromosome), refSeq, chromosome, 1, ".", 0, self._snps, minQual, conversionThreshold)
         else :
             return iter([])
@@ -461,7 +887,7 @@ class SlamSeqBamFile:
         return [ self.atoi(c) for c in re.split('(\d+)', text) ]
 
     def isInReferenceFile(self, chromosome):
-        return chromosome in list(self._referenceFile.references)
+        return self._referenceFile.isInReference(chromosome)
 
     def getChromosomes(self):
         refs = list(self._referenceFile.references)
@@ -469,5 +895,5 @@ class SlamSeqBamFile:
         return refs
 
     def getChromosomeLength(self, chromosome):
-        return self._referenceFile.get_reference_length(chromosome)
+        return self._referenceFile.getLength(chromosome)
 
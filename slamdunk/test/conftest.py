@@ -0,0 +1,187 @@
+# Shared test data: a simulated filtered SLAM-seq BAM file on the bundled
+# reference (data/ref.fa) and 3'UTR annotation (data/actb.bed)
+
+import os
+import copy
+import random
+
+import pytest
+
+from slamdunk.version import __bam_version__
+
+dataDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+maxReadLength = 60
+
+# Conversion codes of the MP tag (see SlamSeqBamIterator.MPTagToConversion)
+baseCode = { "A" : 0, "C" : 1, "G" : 2, "T" : 3, "N" : 4 }
+
+class SlamSeqTestData:
+
+    # Files of the simulated data set. All files are written to a temporary
+    # directory, so indices written next to them don't touch data/
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.reference = os.path.join(directory, "ref.fa")
+        self.bed = os.path.join(directory, "utrs.bed")
+        self.vcf = os.path.join(directory, "snps.vcf")
+        self.bam = os.path.join(directory, "sample_slamdunk_mapped_filtered.bam")
+        self.maxReadLength = maxReadLength
+        # (chromosome, 0-based position) of all SNPs in snps.vcf
+        self.snps = []
+        self.chromosomes = []
+
+def writeReference(pysam, data):
+    # chr5 of the bundled reference plus two chromosomes cut from it
+    with open(os.path.join(dataDirectory, "ref.fa")) as f:
+        chr5 = "".join([ line.strip() for line in f if not line.startswith(">") ])
+    chromosomes = [ ("chr5", chr5), ("chr5_random", chr5[150000:200000]), ("chrUn", chr5[10000:12000]) ]
+    with open(data.reference, "w") as f:
+        for chromosome, sequence in chromosomes:
+            f.write(">" + chromosome + "\n")
+            for i in range(0, len(sequence), 60):
+                f.write(sequence[i:i + 60] + "\n")
+    pysam.faidx(data.reference)
+    data.chromosomes = [ (chromosome, sequence.upper()) for chromosome, sequence in chromosomes ]
+
+def writeAnnotation(rand, data):
+    # Actb, overlapping UTRs around it, UTRs at chromosome borders and on a
+    # chromosome missing from the reference
+    with open(os.path.join(dataDirectory, "actb.bed")) as f:
+        utrs = [ line.rstrip("\n").split("\t") for line in f if len(line.strip()) > 0 ]
+    utrs = [ (utr[0], int(utr[1]), int(utr[2]), utr[3], utr[4], utr[5]) for utr in utrs ]
+    for i in range(0, 10):
+        start = rand.randrange(118000, 124000)
+        utrs.append(("chr5", start, start + rand.randrange(100, 800), "chr5_utr" + str(i), "0", rand.choice("+-")))
+    for i in range(0, 8):
+        start = rand.randrange(0, 49000)
+        utrs.append(("chr5_random", start, start + rand.randrange(100, 800), "random_utr" + str(i), "0", rand.choice("+-")))
+    chr5Length = len(data.chromosomes[0][1])
+    utrs.append(("chr5", 0, 150, "left_border", "0", "+"))
+    utrs.append(("chr5", chr5Length - 120, chr5Length, "right_border", "0", "-"))
+    utrs.append(("chrUn", 500, 900, "unplaced", "0", "+"))
+    utrs.append(("chrX", 100, 500, "missing_chromosome", "0", "+"))
+    with open(data.bed, "w") as f:
+        for utr in utrs:
+            f.write("\t".join([ str(value) for value in utr ]) + "\n")
+    return utrs
+
+def plantSNPs(rand, data, utrs):
+    # One T>C (+ strand UTRs) or A>G (- strand UTRs) SNP in most UTRs
+    sequences = dict(data.chromosomes)
+    snps = {}
+    for chromosome, start, stop, name, score, strand in utrs:
+        if chromosome not in sequences or rand.random() < 0.2:
+            continue
+        base = "T" if strand == "+" else "A"
+        positions = [ i for i in range(start, min(stop, len(sequences[chromosome]))) if sequences[chromosome][i] == base ]
+        if len(positions) > 0:
+            snps[(chromosome, rand.choice(positions))] = base
+    with open(data.vcf, "w") as f:
+        f.write("##fileformat=VCFv4.1\n")
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for (chromosome, position), base in sorted(snps.items()):
+            f.write("\t".join([ chromosome, str(position + 1), ".", base, "C" if base == "T" else "G", ".", "PASS", "." ]) + "\n")
+    data.snps = sorted(snps.keys())
+    return snps
+
+def simulateRead(rand, pysam, tid, chromosome, sequence, snps, start, length, isReverse, name):
+    clip = rand.randrange(1, 6) if rand.random() < 0.1 else 0
+    start = max(0, min(start, len(sequence) - length))
+    reference = sequence[start:start + length - clip]
+    labelled = rand.random() < 0.5
+
+    bases = [ rand.choice("ACGT") for _ in range(0, clip) ]
+    mismatches = []
+    tcCount = 0
+    for i, refBase in enumerate(reference):
+        readBase = refBase
+        p = rand.random()
+        if (chromosome, start + i) in snps and p < 0.95:
+            readBase = "C" if refBase == "T" else "G"
+        elif labelled and not isReverse and refBase == "T" and p < 0.1:
+            readBase = "C"
+            tcCount += 1
+        elif labelled and isReverse and refBase == "A" and p < 0.1:
+            readBase = "G"
+            tcCount += 1
+        elif p < 0.01:
+            readBase = rand.choice("ACGTN")
+        if refBase == "N":
+            readBase = "N"
+        if readBase != refBase:
+            mismatches.append("%d:%d:%d" % (5 * baseCode[refBase] + baseCode[readBase], clip + i + 1, i + 1))
+        bases.append(readBase)
+
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.query_sequence = "".join(bases)
+    read.flag = 16 if isReverse else 0
+    read.reference_id = tid
+    read.reference_start = start
+    read.mapping_quality = 0 if rand.random() < 0.1 else 60
+    read.cigartuples = ([ (4, clip) ] if clip > 0 else []) + [ (0, len(reference)) ]
+    read.query_qualities = pysam.qualitystring_to_array("".join([ chr(rand.choice([ 10, 20, 30, 35, 38 ]) + 33) for _ in range(0, len(bases)) ]))
+    tags = [ ("RG", "1"), ("XI", 0.95), ("NM", len(mismatches)), ("XA", 0), ("TC", tcCount) ]
+    if len(mismatches) > 0:
+        tags.append(("MP", ",".join(mismatches)))
+    read.set_tags(tags)
+    return read
+
+def writeBam(rand, pysam, data, utrs, snps):
+    header = { "HD" : { "VN" : "1.0", "SO" : "coordinate" },
+               "SQ" : [ { "SN" : chromosome, "LN" : len(sequence) } for chromosome, sequence in data.chromosomes ],
+               "RG" : [ { "ID" : "1", "SM" : "sample:pulse:0", "DS" : "{'sequenced':10000,'mapped':9000,'filtered':8000,'mqfiltered':0,'idfiltered':0,'nmfiltered':0,'multimapper':0,'dedup':0,'snps':0,'annotation':'utrs.bed','annotationmd5':''}" } ],
+               "PG" : [ { "ID" : "slamdunk", "PN" : "slamdunk filter", "VN" : __bam_version__ } ] }
+    readCounts = { "chr5" : 6000, "chr5_random" : 2500, "chrUn" : 40 }
+
+    reads = []
+    for tid, (chromosome, sequence) in enumerate(data.chromosomes):
+        chromosomeUtrs = [ utr for utr in utrs if utr[0] == chromosome ]
+        for _ in range(0, readCounts[chromosome]):
+            length = rand.randrange(30, maxReadLength + 1)
+            name = "read" + str(len(reads))
+            if len(reads) > 0 and rand.random() < 0.05 and reads[-1].reference_id == tid:
+                # PCR duplicate of the previous read
+                duplicate = copy.copy(reads[-1])
+                duplicate.query_name = name
+                reads.append(duplicate)
+                continue
+            if len(chromosomeUtrs) > 0 and rand.random() < 0.6:
+                utr = rand.choice(chromosomeUtrs)
+                start = rand.randrange(utr[1] - length, utr[2])
+                isReverse = (utr[5] == "-") != (rand.random() < 0.15)
+            else:
+                start = rand.randrange(0, len(sequence))
+                isReverse = rand.random() < 0.5
+            reads.append(simulateRead(rand, pysam, tid, chromosome, sequence, snps, start, length, isReverse, name))
+
+    unmapped = []
+    for i in range(0, 5):
+        read = pysam.AlignedSegment()
+        read.query_name = "unmapped" + str(i)
+        read.query_sequence = "".join([ rand.choice("ACGT") for _ in range(0, 40) ])
+        read.flag = 4
+        read.reference_id = -1
+        read.reference_start = -1
+        read.query_qualities = pysam.qualitystring_to_array("I" * 40)
+        unmapped.append(read)
+
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    bamFile = pysam.AlignmentFile(data.bam, "wb", header=header)
+    for read in reads + unmapped:
+        bamFile.write(read)
+    bamFile.close()
+    pysam.index(data.bam)
+
+@pytest.fixture(scope="session")
+def slamseqData(tmp_path_factory):
+    pysam = pytest.importorskip("pysam")
+    rand = random.Random(12)
+    data = SlamSeqTestData(str(tmp_path_factory.mktemp("slamseq")))
+    writeReference(pysam, data)
+    utrs = writeAnnotation(rand, data)
+    snps = plantSNPs(rand, data, utrs)
+    writeBam(rand, pysam, data, utrs, snps)
+    return data
@@ -0,0 +1,93 @@
+# SortingBamWriter with several sorted runs against samtools sort on the
+# simulated data set (see conftest.py)
+
+import os
+import sys
+import random
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+import pysam
+
+from slamdunk.utils.BamSorter import SortingBamWriter
+
+def writeShuffled(data, bam):
+    # Unsorted reads of the test data set. Every read is written twice with a
+    # different name, so there are many reads with the same position and
+    # strand
+    rand = random.Random(3)
+    samFile = pysam.AlignmentFile(data.bam, "rb")
+    reads = []
+    for read in samFile.fetch(until_eof=True):
+        reads.append(read)
+        copy = pysam.AlignedSegment.fromstring(read.to_string(), samFile.header)
+        copy.query_name = read.query_name + "_copy"
+        reads.append(copy)
+    rand.shuffle(reads)
+    header = samFile.header.to_dict()
+    header["HD"]["SO"] = "unsorted"
+    outFile = pysam.AlignmentFile(bam, "wb", header=header)
+    for read in reads:
+        outFile.write(read)
+    outFile.close()
+    samFile.close()
+    return [ read.to_string() for read in reads ]
+
+def readRecords(bam):
+    samFile = pysam.AlignmentFile(bam, "rb")
+    reads = [ read.to_string() for read in samFile.fetch(until_eof=True) ]
+    samFile.close()
+    return reads
+
+@pytest.mark.parametrize("maxRecords", [ 97, 1000000 ])
+def test_sorting_bam_writer(slamseqData, tmp_path, maxRecords):
+    inputBAM = str(tmp_path / "shuffled.bam")
+    inputReads = writeShuffled(slamseqData, inputBAM)
+
+    expectedBAM = str(tmp_path / "expected.bam")
+    pysam.sort("-o", expectedBAM, inputBAM)
+    pysam.index(expectedBAM)
+
+    outputBAM = str(tmp_path / "sorted.bam")
+    samFile = pysam.AlignmentFile(inputBAM, "rb")
+    writer = SortingBamWriter(outputBAM, samFile, maxRecords)
+    for read in samFile.fetch(until_eof=True):
+        writer.write(read)
+    if maxRecords < len(inputReads):
+        assert len(writer._runs) > 5
+    writer.close()
+    samFile.close()
+    pysam.index(outputBAM)
+    # Temporary runs are removed
+    assert sorted(os.listdir(str(tmp_path))) == [ "expected.bam", "expected.bam.bai", "shuffled.bam", "sorted.bam", "sorted.bam.bai" ]
+
+    reads = readRecords(outputBAM)
+    assert reads == readRecords(expectedBAM)
+
+    # Order: reference (unmapped reads last), position and strand. Reads with
+    # the same key keep their input order
+    samFile = pysam.AlignmentFile(outputBAM, "rb")
+    keys = [ ((1 << 32) if read.reference_id < 0 else read.reference_id, read.reference_start, read.is_reverse) for read in samFile.fetch(until_eof=True) ]
+    samFile.close()
+    assert keys == sorted(keys)
+    assert len(set(keys)) < len(keys)
+    assert len([ key for key in keys if key[0] == 1 << 32 ]) > 0
+    inputOrder = dict([ (read, i) for i, read in enumerate(inputReads) ])
+    for i in range(1, len(keys)):
+        if keys[i] == keys[i - 1]:
+            assert inputOrder[reads[i - 1]] < inputOrder[reads[i]]
+
+    # Header and index
+    sortedFile = pysam.AlignmentFile(outputBAM, "rb")
+    expectedFile = pysam.AlignmentFile(expectedBAM, "rb")
+    header = sortedFile.header.to_dict()
+    assert header["HD"]["SO"] == "coordinate"
+    assert header == expectedFile.header.to_dict()
+    assert sortedFile.get_index_statistics() == expectedFile.get_index_statistics()
+    for chromosome in sortedFile.references:
+        assert [ read.to_string() for read in sortedFile.fetch(chromosome) ] == [ read.to_string() for read in expectedFile.fetch(chromosome) ]
+    sortedFile.close()
+    expectedFile.close()
@@ -0,0 +1,77 @@
+# IntervalIndex against the IntervalTree[start:end] queries it replaced in
+# filter and simulator
+
+import sys
+import random
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+from slamdunk.utils.BedReader import BedIterator, IntervalIndex, bedToIntervalIndex
+
+def writeBed(fileName, rand):
+    # Nested, containing, identical and adjacent intervals on two chromosomes
+    entries = [ ("chr1", 100, 200, "outer"), ("chr1", 120, 130, "nested"), ("chr1", 120, 130, "nested"), ("chr1", 120, 130, "nestedOther"),
+                ("chr1", 200, 210, "adjacent"), ("chr1", 0, 1, "first"), ("chr1", 50, 50, "empty"), ("chr2", 10, 1000, "long") ]
+    for i in range(0, 200):
+        start = rand.randrange(0, 2000)
+        entries.append((rand.choice([ "chr1", "chr2" ]), start, start + rand.randrange(0, 300), "utr" + str(i)))
+    with open(fileName, "w") as f:
+        for entry in entries:
+            f.write("\t".join([ str(value) for value in entry ]) + "\t0\t+\n")
+
+def bedToIntervalTree(bed):
+    from intervaltree import IntervalTree
+    utrs = {}
+    for utr in BedIterator(bed):
+        if (not utrs.has_key(utr.chromosome)) :
+            utrs[utr.chromosome] = IntervalTree()
+        utrs[utr.chromosome][utr.start:(utr.stop + 1)] = utr.name
+    return utrs
+
+def getQueries(rand):
+    # Zero-length and reversed queries don't overlap anything
+    queries = [ (0, 1), (50, 50), (120, 120), (130, 131), (199, 200), (201, 201), (210, 211), (-10, 0), (2500, 3000), (150, 140) ]
+    for _ in range(0, 500):
+        start = rand.randrange(-50, 2500)
+        queries.append((start, start + rand.randrange(0, 100)))
+    return queries
+
+def test_overlap(tmp_path):
+    pytest.importorskip("intervaltree")
+    rand = random.Random(7)
+    bed = str(tmp_path / "utrs.bed")
+    writeBed(bed, rand)
+    trees = bedToIntervalTree(bed)
+    index = bedToIntervalIndex(bed)
+
+    # Chromosomes missing from the BED file are missing from both
+    assert sorted(index.keys()) == sorted(trees.keys())
+    assert "chr3" not in index
+
+    for chromosome in trees:
+        tree = trees[chromosome]
+        intervals = index[chromosome]
+        assert len(intervals) == len(tree)
+        queries = getQueries(rand)
+        expected = [ sorted([ (interval.begin, interval.end, interval.data) for interval in tree[start:end] ]) for start, end in queries ]
+
+        for (start, end), overlaps in zip(queries, expected):
+            indices = intervals.overlapIndices(start, end)
+            assert sorted([ (intervals.starts[i], intervals.ends[i], intervals.data[i]) for i in indices ]) == overlaps
+            assert sorted(intervals.overlap(start, end)) == sorted([ name for _, _, name in overlaps ])
+
+        offsets, indices = intervals.overlapBatch([ start for start, _ in queries ], [ end for _, end in queries ])
+        assert len(offsets) == len(queries) + 1
+        for k, overlaps in enumerate(expected):
+            assert sorted([ (intervals.starts[i], intervals.ends[i], intervals.data[i]) for i in indices[offsets[k]:offsets[k + 1]] ]) == overlaps
+
+def test_empty_index():
+    intervals = IntervalIndex([], [], [])
+    assert len(intervals) == 0
+    assert intervals.overlap(0, 100) == []
+    offsets, indices = intervals.overlapBatch([ 0, 10 ], [ 5, 20 ])
+    assert offsets.tolist() == [ 0, 0, 0 ]
+    assert len(indices) == 0
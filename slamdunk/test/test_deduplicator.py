@@ -0,0 +1,56 @@
+# Sharded dedup against the buffering loop it replaced on the simulated data
+# set (see conftest.py)
+
+import sys
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+import pysam
+
+from slamdunk.dunks import deduplicator
+
+def dedupReads(bam, tcMutations):
+    # All reads with >= tcMutations T>C conversions in input order. Reads with
+    # the same chromosome, start, strand, CIGAR and sequence as an earlier read
+    # are flagged as duplicates
+    samfile = pysam.AlignmentFile(bam, "rb")
+    reads = []
+    duplicateBuffer = {}
+    for read in samfile.fetch(until_eof=True):
+        tcflag = read.get_tag("TC") if read.has_tag("TC") else 0
+        if tcflag >= tcMutations:
+            key = (read.reference_id, read.reference_start, read.is_reverse, read.cigarstring, read.query_sequence)
+            if key in duplicateBuffer:
+                read.is_duplicate = True
+            duplicateBuffer[key] = True
+            reads.append(read.to_string())
+    samfile.close()
+    return reads
+
+def readRecords(bam):
+    samfile = pysam.AlignmentFile(bam, "rb")
+    reads = [ read.to_string() for read in samfile.fetch(until_eof=True) ]
+    samfile.close()
+    return reads
+
+@pytest.mark.parametrize("tcMutations", [ 0, 1 ])
+def test_dedup(slamseqData, tmp_path, tcMutations):
+    expected = dedupReads(slamseqData.bam, tcMutations)
+    assert len([ read for read in expected if int(read.split("\t")[1]) & 1024 ]) > 20
+
+    for threads in [ 1, 3 ]:
+        outputBAM = str(tmp_path / ("dedup_" + str(threads) + ".bam"))
+        with open(str(tmp_path / "dedup.log"), "w") as log:
+            deduplicator.Dedup(slamseqData.bam, outputBAM, tcMutations, log, force=True, threads=threads)
+        assert readRecords(outputBAM) == expected
+
+        # Header of the input and a valid index
+        inputFile = pysam.AlignmentFile(slamseqData.bam, "rb")
+        samfile = pysam.AlignmentFile(outputBAM, "rb")
+        assert samfile.header.to_dict() == inputFile.header.to_dict()
+        assert sum([ stats.mapped for stats in samfile.get_index_statistics() ]) == len([ read for read in expected if not read.split("\t")[2] == "*" ])
+        samfile.close()
+        inputFile.close()
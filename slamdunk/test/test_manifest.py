@@ -0,0 +1,131 @@
+# checkStep/finishStep: outputs are reused only if the run manifest has a
+# finished record with the same input contents and parameters and the outputs
+# weren't changed since
+
+import os
+import shutil
+
+from slamdunk.dunks import mapper
+from slamdunk.utils import misc
+from slamdunk.utils.RunManifest import RunManifest, ManifestFileName, StatusDone, StatusStarted
+
+def writeFile(fileName, content):
+    with open(fileName, "w") as f:
+        f.write(content)
+
+def runStep(inFiles, outFiles, parameters, content="output"):
+    # Writes outFiles if the step has to run. Returns True if it ran
+    if not misc.checkStep(inFiles, outFiles, False, parameters):
+        return False
+    for outFile in outFiles:
+        writeFile(outFile, content)
+    misc.finishStep(outFiles)
+    return True
+
+def test_check_step(tmp_path):
+    inputFile = str(tmp_path / "input.txt")
+    writeFile(inputFile, "input")
+    outFiles = [ str(tmp_path / "output.txt"), str(tmp_path / "output.txt.idx") ]
+
+    assert runStep([ inputFile ], outFiles, [ 1, "a" ])
+    # Valid rerun
+    assert not runStep([ inputFile ], outFiles, [ 1, "a" ])
+    assert misc.isStepFinished(outFiles)
+
+    # Changed parameter
+    assert runStep([ inputFile ], outFiles, [ 2, "a" ])
+    assert not runStep([ inputFile ], outFiles, [ 2, "a" ])
+
+    # Copied input with the same content and a newer modification time
+    copiedFile = str(tmp_path / "copy" / "input.txt")
+    os.mkdir(str(tmp_path / "copy"))
+    shutil.copy(inputFile, copiedFile)
+    os.utime(copiedFile, (os.path.getmtime(inputFile) + 100, os.path.getmtime(inputFile) + 100))
+    assert not runStep([ copiedFile ], outFiles, [ 2, "a" ])
+
+    # Changed input
+    writeFile(copiedFile, "changed input")
+    assert runStep([ copiedFile ], outFiles, [ 2, "a" ])
+
+    # Output modified after the step finished
+    writeFile(outFiles[1], "modified")
+    assert runStep([ copiedFile ], outFiles, [ 2, "a" ])
+    assert not runStep([ copiedFile ], outFiles, [ 2, "a" ])
+
+    # Missing output
+    os.remove(outFiles[0])
+    assert runStep([ copiedFile ], outFiles, [ 2, "a" ])
+
+    # Forced
+    assert misc.checkStep([ copiedFile ], outFiles, True, [ 2, "a" ])
+
+def test_interrupted_step(tmp_path):
+    inputFile = str(tmp_path / "input.txt")
+    writeFile(inputFile, "input")
+    outFiles = [ str(tmp_path / "output.txt") ]
+    assert runStep([ inputFile ], outFiles, [])
+
+    # Rerun with other parameters started but not finished: outputs of the
+    # previous run are complete, but never reused
+    assert misc.checkStep([ inputFile ], outFiles, False, [ 1 ])
+    assert misc.getRunManifest(outFiles).getRecord(outFiles)["status"] == StatusStarted
+    assert not misc.isStepFinished(outFiles)
+    assert misc.checkStep([ inputFile ], outFiles, False, [])
+    assert misc.checkStep([ inputFile ], outFiles, False, [ 1 ])
+    assert runStep([ inputFile ], outFiles, [])
+
+    # Incomplete last line of an interrupted manifest write
+    with open(str(tmp_path / ManifestFileName), "a") as f:
+        f.write("{\"step\": \"output.txt\", \"sta")
+    assert not runStep([ inputFile ], outFiles, [])
+    assert RunManifest(str(tmp_path)).getRecord(outFiles)["status"] == StatusDone
+
+def test_map_sort_step(tmp_path, monkeypatch):
+    # Map with SAM output and sort record one step under the BAM file
+    calls = []
+    def run(cmd, log, verbose=False, dry=False):
+        calls.append("ngm")
+        writeFile(cmd.split(" -o ")[-1], "sam")
+    def runSam2bam(inFile, outFile, log, index=True, sort=True, delinFile=False, **kwargs):
+        calls.append("sam2bam")
+        writeFile(outFile, "bam")
+        if delinFile:
+            os.remove(inFile)
+    monkeypatch.setattr(mapper, "run", run)
+    monkeypatch.setattr(mapper, "runSam2bam", runSam2bam)
+
+    inputBAM = str(tmp_path / "reads.bam")
+    reference = str(tmp_path / "reference.fa")
+    writeFile(inputBAM, "reads")
+    writeFile(reference, "reference")
+    outputSAM = str(tmp_path / "reads_slamdunk_mapped.sam")
+    outputBAM = str(tmp_path / "reads_slamdunk_mapped.bam")
+    with open(str(tmp_path / "map.log"), "w") as log:
+        def mapAndSort(**kwargs):
+            mapper.Map(inputBAM, reference, outputSAM, log, False, False, **kwargs)
+            mapper.sort(outputSAM, outputBAM, log, keepSam=False)
+
+        mapAndSort()
+        assert calls == [ "ngm", "sam2bam" ]
+        assert misc.isStepFinished([ outputBAM ])
+        assert not os.path.exists(outputSAM)
+
+        mapAndSort()
+        assert calls == [ "ngm", "sam2bam" ]
+
+        # Changed mapping parameters
+        mapAndSort(trim5p=12)
+        assert calls == [ "ngm", "sam2bam" ] * 2
+
+        # Interrupted before sorting
+        mapper.Map(inputBAM, reference, outputSAM, log, False, False, trim5p=5)
+        assert not misc.isStepFinished([ outputBAM ])
+        mapAndSort(trim5p=5)
+        assert calls == [ "ngm", "sam2bam" ] * 2 + [ "ngm" ] + [ "ngm", "sam2bam" ]
+        assert misc.isStepFinished([ outputBAM ])
+
+        # BAM output is finished by Map
+        mapper.Map(inputBAM, reference, outputBAM, log, False, False)
+        assert misc.isStepFinished([ outputBAM ])
+        mapper.Map(inputBAM, reference, outputBAM, log, False, False)
+        assert calls.count("ngm") == 5
@@ -0,0 +1,258 @@
+# slamdunk map --skip-sam: filterReads on the SAM output of NextGenMap sorted
+# by SortingBamWriter against the Filter on a BAM file it replaced, and
+# partial outputs of failed runs. NextGenMap is replaced by a script printing
+# a SAM file written from the simulated data set (see conftest.py)
+
+import os
+import sys
+import random
+import stat
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+import pysam
+
+from slamdunk.dunks import mapper, filter
+from slamdunk.utils.BamSorter import SortingBamWriter
+from slamdunk.utils.BedReader import BedIterator
+from slamdunk.utils.misc import SlamSeqInfo, md5, isStepFinished
+from slamdunk.version import __version__, __bam_version__
+
+def writeMapperOutput(data, sam):
+    # Alignments of a read are consecutive. Some reads are multimappers
+    # (MQ 0) with alignments on several chromosomes, some are below the
+    # identity threshold
+    rand = random.Random(9)
+    samFile = pysam.AlignmentFile(data.bam, "rb")
+    header = samFile.header.to_dict()
+    header["HD"] = { "VN" : "1.0" }
+    reads = list(samFile.fetch(until_eof=True))
+    samFile.close()
+    rand.shuffle(reads)
+
+    outFile = pysam.AlignmentFile(sam, "wh", header=header)
+    i = 0
+    while i < len(reads):
+        alignments = [ reads[i] ]
+        if not reads[i].is_unmapped and rand.random() < 0.2:
+            alignments += [ read for read in reads[i + 1:i + rand.randrange(2, 4)] if not read.is_unmapped ]
+        i += len(alignments)
+        for k, read in enumerate(alignments):
+            if len(alignments) > 1:
+                read.query_name = alignments[0].query_name
+                read.mapping_quality = 0
+                read.is_secondary = k > 0
+            if not read.is_unmapped:
+                read.set_tag("XI", rand.choice([ 0.95, 0.95, 0.95, 0.7 ]), "f")
+            outFile.write(read)
+    outFile.close()
+
+def bedToIntervalTree(bed):
+    from intervaltree import IntervalTree
+    utrs = {}
+    for utr in BedIterator(bed):
+        if (not utrs.has_key(utr.chromosome)) :
+            utrs[utr.chromosome] = IntervalTree()
+        utrs[utr.chromosome][utr.start:(utr.stop + 1)] = utr.name
+    return utrs
+
+def dumpBuffer(buffer, multimapList, outfile):
+    read = buffer.values().pop().pop()
+    read.set_tag("RD", multimapList.rstrip(" "), "Z")
+    read.is_secondary = False
+    read.is_supplementary = False
+    outfile.write(read)
+
+def retainMultimappers(infile, outfile, bed, minIdentity, NM):
+    # Multimappers are kept if all alignments overlap the UTRs of the first
+    # alignment
+    mappedReads = unmappedReads = filteredReads = idFiltered = nmFiltered = 0
+    trees = bedToIntervalTree(bed)
+    multimapBuffer = {}
+    prevRead = ""
+    dump = True
+    multimapList = ""
+    for read in infile:
+        if(not read.is_secondary and not read.is_supplementary):
+            if(read.is_unmapped):
+                unmappedReads += 1
+            else:
+                mappedReads += 1
+        if(read.is_unmapped):
+            continue
+        if(float(read.get_tag("XI")) < minIdentity):
+            idFiltered += 1
+            continue
+        if(NM > -1 and int(read.get_tag("NM")) > NM):
+            nmFiltered += 1
+            continue
+        if(read.mapping_quality == 0):
+            if(read.query_name != prevRead and prevRead != ""):
+                if(dump and len(multimapBuffer) > 0):
+                    dumpBuffer(multimapBuffer, multimapList, outfile)
+                    filteredReads += 1
+                dump = True
+                multimapList = ""
+                multimapBuffer = {}
+            chromosome = infile.getrname(read.reference_id)
+            query = trees[chromosome][read.reference_start:read.reference_end] if chromosome in trees else []
+            for result in query:
+                if(len(multimapBuffer) > 0 and not multimapBuffer.has_key(result)):
+                    dump = False
+            for result in query:
+                multimapBuffer.setdefault(result, []).append(read)
+            multimapList = multimapList + chromosome + ":" + str(read.reference_start) + "-" + str(read.reference_end) + " "
+            prevRead = read.query_name
+        else:
+            if(len(multimapBuffer) > 0):
+                if(dump):
+                    dumpBuffer(multimapBuffer, multimapList, outfile)
+                    filteredReads += 1
+                multimapBuffer = {}
+                dump = True
+                multimapList = ""
+            prevRead = read.query_name
+            outfile.write(read)
+            filteredReads += 1
+    if(dump and len(multimapBuffer) > 0):
+        dumpBuffer(multimapBuffer, multimapList, outfile)
+        filteredReads += 1
+    return mappedReads, unmappedReads, filteredReads, 0, idFiltered, nmFiltered, mappedReads - filteredReads - idFiltered - nmFiltered
+
+def filterReads(inputBAM, outputBAM, bed, MQ, minIdentity, NM):
+    # Filter writing the reads in input order, then samtools sort with the
+    # read counts in the header
+    infile = pysam.AlignmentFile(inputBAM, "rb")
+    unsortedBAM = outputBAM + "_unsorted"
+    outfile = pysam.AlignmentFile(unsortedBAM, "wb", template=infile)
+    if bed == None:
+        mappedReads = unmappedReads = filteredReads = mqFiltered = idFiltered = nmFiltered = multimapper = 0
+        for read in infile:
+            if(not read.is_secondary and not read.is_supplementary):
+                if(read.is_unmapped):
+                    unmappedReads += 1
+                else:
+                    mappedReads += 1
+            if(read.is_unmapped):
+                continue
+            if(read.mapping_quality < MQ):
+                mqFiltered += 1
+                continue
+            if(float(read.get_tag("XI")) < minIdentity):
+                idFiltered += 1
+                continue
+            if(NM > -1 and int(read.get_tag("NM")) > NM):
+                nmFiltered += 1
+                continue
+            if(not read.is_secondary and not read.is_supplementary):
+                filteredReads += 1
+            outfile.write(read)
+    else:
+        mappedReads, unmappedReads, filteredReads, mqFiltered, idFiltered, nmFiltered, multimapper = retainMultimappers(infile, outfile, bed, minIdentity, NM)
+    outfile.close()
+    header = infile.header.to_dict()
+    infile.close()
+
+    slamseqInfo = SlamSeqInfo()
+    slamseqInfo.SequencedReads = mappedReads + unmappedReads
+    slamseqInfo.MappedReads = mappedReads
+    slamseqInfo.FilteredReads = filteredReads
+    slamseqInfo.MQFilteredReads = mqFiltered
+    slamseqInfo.IdFilteredReads = idFiltered
+    slamseqInfo.NmFilteredReads = nmFiltered
+    slamseqInfo.MultimapperReads = multimapper
+    slamseqInfo.AnnotationName = os.path.basename(bed) if bed != None else ""
+    slamseqInfo.AnnotationMD5 = md5(bed) if bed != None else ""
+    header['RG'][0]['DS'] = str(slamseqInfo)
+    header['PG'].append({ 'ID': 'slamdunk', 'PN': 'slamdunk filter v' + __version__, 'VN': __bam_version__ })
+
+    samFile = pysam.AlignmentFile(unsortedBAM, "rb")
+    headerFile = pysam.AlignmentFile(unsortedBAM + "_header", "wb", header=header)
+    for read in samFile.fetch(until_eof=True):
+        headerFile.write(read)
+    headerFile.close()
+    samFile.close()
+    pysam.sort("-o", outputBAM, unsortedBAM + "_header")
+
+def splitRetained(reads):
+    # Name and RD tag of retained multimappers and all other reads. Which
+    # alignment of a multimapper overlapping several UTRs is kept depends on
+    # the order of the UTR buffer (a dict) and isn't compared
+    retained = []
+    for read in reads:
+        fields = read.split("\t")
+        rd = [ field for field in fields if field.startswith("RD:Z:") ]
+        if len(rd) > 0:
+            # One of the alignments of the read
+            assert (fields[2] + ":" + str(int(fields[3]) - 1) + "-") in rd[0]
+            retained.append((fields[0], rd[0]))
+    return sorted(retained), [ read for read in reads if not "\tRD:Z:" in read ]
+
+def readRecords(bam):
+    samFile = pysam.AlignmentFile(bam, "rb")
+    reads = [ read.to_string() for read in samFile.fetch(until_eof=True) ]
+    header = samFile.header.to_dict()
+    samFile.close()
+    return header, reads
+
+def writeMapper(directory, command):
+    # Script replacing NextGenMap
+    fileName = os.path.join(directory, "ngm")
+    with open(fileName, "w") as f:
+        f.write("#!/bin/sh\n" + command + "\n")
+    os.chmod(fileName, os.stat(fileName).st_mode | stat.S_IEXEC)
+    return fileName
+
+@pytest.fixture
+def mapperOutput(slamseqData, tmp_path):
+    sam = str(tmp_path / "ngm.sam")
+    writeMapperOutput(slamseqData, sam)
+    pysam.view("-b", "-o", sam + ".bam", sam, catch_stdout=False)
+    return sam
+
+@pytest.mark.parametrize("useBed, NM", [ (False, -1), (True, -1), (False, 2), (True, 2) ])
+def test_filter_reads(slamseqData, tmp_path, mapperOutput, monkeypatch, useBed, NM):
+    bed = slamseqData.bed if useBed else None
+    expectedBAM = str(tmp_path / "expected.bam")
+    filterReads(mapperOutput + ".bam", expectedBAM, bed, 2, 0.8, NM)
+    expectedHeader, expectedReads = readRecords(expectedBAM)
+    assert len([ read for read in expectedReads if "\tRD:Z:" in read ]) > (10 if useBed else -1)
+
+    # Several sorted runs
+    outputBAM = str(tmp_path / "filtered.bam")
+    infile = pysam.AlignmentFile(mapperOutput, "r")
+    outfile = SortingBamWriter(outputBAM, infile, 500)
+    with open(str(tmp_path / "filter.log"), "w") as log:
+        header = filter.filterReads(infile, outfile, mapperOutput, bed, 2, 0.8, NM, log)
+    outfile.close(header)
+    infile.close()
+    header, reads = readRecords(outputBAM)
+    assert header == expectedHeader
+    assert splitRetained(reads) == splitRetained(expectedReads)
+
+    # The same through MapFilter
+    ngm = writeMapper(str(tmp_path), "cat " + mapperOutput)
+    monkeypatch.setattr(mapper, "getBinary", lambda name: ngm)
+    mappedBAM = str(tmp_path / "mapped_filtered.bam")
+    with open(str(tmp_path / "map.log"), "w") as log:
+        mapper.MapFilter(mapperOutput + ".bam", slamseqData.reference, mappedBAM, log, False, False, bed, NM=NM, maxRecords=500)
+    assert readRecords(mappedBAM) == (header, reads)
+    assert os.path.exists(mappedBAM + ".bai")
+    assert isStepFinished([ mappedBAM ])
+
+@pytest.mark.parametrize("command", [ "head -n 3000 {sam}; exit 1", "head -c 300000 {sam}; exit 1", "exit 1" ])
+def test_failed_mapper(slamseqData, tmp_path, mapperOutput, monkeypatch, command):
+    # Complete or broken SAM output of a failing NextGenMap: no output file,
+    # temporary runs or finished step are left
+    ngm = writeMapper(str(tmp_path), command.format(sam=mapperOutput))
+    monkeypatch.setattr(mapper, "getBinary", lambda name: ngm)
+    files = sorted(os.listdir(str(tmp_path)))
+    mappedBAM = str(tmp_path / "mapped_filtered.bam")
+    with open(str(tmp_path / "map.log"), "w") as log:
+        with pytest.raises(RuntimeError):
+            mapper.MapFilter(mapperOutput + ".bam", slamseqData.reference, mappedBAM, log, False, False, slamseqData.bed, maxRecords=100)
+    assert [ fileName for fileName in sorted(os.listdir(str(tmp_path))) if fileName not in files ] == [ "map.log", "slamdunk_manifest.jsonl" ]
+    assert not isStepFinished([ mappedBAM ])
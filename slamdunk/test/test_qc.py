@@ -0,0 +1,59 @@
+# alleyoop qc against the single commands it combines (rates, tccontext,
+# tcperreadpos, tcperutrpos and utrrates) on the simulated data set (see
+# conftest.py)
+
+import os
+import sys
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+from slamdunk.dunks import qc, stats
+
+def runSingleCommands(data, directory, snpsFile, strictTCs, log):
+    outputFiles = {}
+    for metric in qc.qcMetrics:
+        outputFiles[metric] = (os.path.join(directory, metric + ".csv"), os.path.join(directory, metric + ".pdf"))
+
+    stats.statsComputeOverallRates(data.reference, data.bam, 27, outputFiles["rates"][0], outputFiles["rates"][1], log, printOnly=True, force=True)
+    stats.statsComputeTCContext(data.reference, data.bam, 27, outputFiles["tccontext"][0], outputFiles["tccontext"][1], log, printOnly=True, force=True)
+    stats.tcPerReadPos(data.reference, data.bam, 27, data.maxReadLength, outputFiles["tcperreadpos"][0], outputFiles["tcperreadpos"][1], snpsFile, log, printOnly=True, force=True)
+    stats.tcPerUtr(data.reference, data.bed, data.bam, 27, data.maxReadLength, outputFiles["tcperutrpos"][0], outputFiles["tcperutrpos"][1], snpsFile, log, printOnly=True, force=True)
+    stats.statsComputeOverallRatesPerUTR(data.reference, data.bam, 27, strictTCs, outputFiles["utrrates"][0], outputFiles["utrrates"][1], data.bed, data.maxReadLength, log, printOnly=True, force=True)
+    return outputFiles
+
+def readLines(fileName):
+    with open(fileName) as f:
+        return f.read().splitlines()
+
+@pytest.mark.parametrize("threads, batchSize, strictTCs, withSNPs", [ (1, 300, False, True), (2, qc.qcBatchSize, True, False) ])
+def test_qc(slamseqData, tmp_path, monkeypatch, threads, batchSize, strictTCs, withSNPs):
+    # Batches are only split in this process (threads 1)
+    monkeypatch.setattr(qc, "qcBatchSize", batchSize)
+    snpsFile = slamseqData.vcf if withSNPs else None
+
+    singleDirectory = tmp_path / "single"
+    qcDirectory = tmp_path / "qc"
+    singleDirectory.mkdir()
+    qcDirectory.mkdir()
+    with open(str(tmp_path / "qc.log"), "w") as log:
+        expectedFiles = runSingleCommands(slamseqData, str(singleDirectory), snpsFile, strictTCs, log)
+
+        outputFiles = {}
+        for metric in qc.qcMetrics:
+            outputFiles[metric] = (str(qcDirectory / (metric + ".csv")), str(qcDirectory / (metric + ".pdf")))
+        qc.computeQC(slamseqData.reference, slamseqData.bam, outputFiles, 27, slamseqData.maxReadLength, snpsFile, slamseqData.bed, strictTCs, log, printOnly=True, force=True, threads=threads)
+
+    for metric in qc.qcMetrics:
+        expected = readLines(expectedFiles[metric][0])
+        assert len(expected) > 2
+        assert readLines(outputFiles[metric][0]) == expected, metric
+
+def test_qc_metric_subset(slamseqData, tmp_path):
+    # Only the requested metrics are written
+    outputFiles = { "tccontext" : (str(tmp_path / "tccontext.csv"), str(tmp_path / "tccontext.pdf")) }
+    with open(str(tmp_path / "qc.log"), "w") as log:
+        qc.computeQC(slamseqData.reference, slamseqData.bam, outputFiles, 27, slamseqData.maxReadLength, None, None, False, log, printOnly=True, force=True)
+    assert [ fileName for fileName in os.listdir(str(tmp_path)) if fileName.endswith(".csv") ] == [ "tccontext.csv" ]
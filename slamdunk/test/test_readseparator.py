@@ -0,0 +1,89 @@
+# alleyoop read-separator against the two pass separation it replaced on the
+# simulated data set (see conftest.py) with multimappers on several chromosomes
+
+import os
+import sys
+import random
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+import pysam
+
+from slamdunk.dunks import tcounter
+from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile
+from slamdunk.utils import SNPtools
+
+def writeMultimappers(data, bam):
+    # Renames multimappers (MQ 0) on chr5_random and chrUn to reads on chr5,
+    # so all alignments of a read name are spread over several chromosomes
+    rand = random.Random(5)
+    samFile = pysam.AlignmentFile(data.bam, "rb")
+    names = [ read.query_name for read in samFile.fetch(contig="chr5") ]
+    samFile.close()
+    samFile = pysam.AlignmentFile(data.bam, "rb")
+    outFile = pysam.AlignmentFile(bam, "wb", template=samFile)
+    renamed = 0
+    for read in samFile.fetch(until_eof=True):
+        if not read.is_unmapped and read.reference_name != "chr5" and read.mapping_quality == 0:
+            read.query_name = rand.choice(names)
+            renamed += 1
+        outFile.write(read)
+    outFile.close()
+    samFile.close()
+    pysam.index(bam)
+    return renamed
+
+def separateReads(data, bam, minBaseQual, conversionThreshold):
+    # TC reads: all alignments of reads with at least one TC alignment
+    snps = SNPtools.SNPDictionary(data.vcf)
+    snps.read()
+    testFile = SlamSeqBamFile(bam, data.reference, snps)
+    tcReads = set()
+    for chromosome in testFile.getChromosomes():
+        for read in testFile.readsInChromosome(chromosome, minBaseQual, conversionThreshold):
+            if read.isTcRead:
+                tcReads.add(read.name)
+
+    backgroundReads = []
+    tcReadList = []
+    samFile = pysam.AlignmentFile(bam, "rb")
+    for read in samFile.fetch():
+        if read.query_name in tcReads:
+            tcReadList.append(read.to_string())
+        else:
+            backgroundReads.append(read.to_string())
+    samFile.close()
+    return backgroundReads, tcReadList
+
+def readRecords(bam):
+    samFile = pysam.AlignmentFile(bam, "rb")
+    reads = [ read.to_string() for read in samFile.fetch(until_eof=True) ]
+    # Indexed
+    assert sum([ stats.total for stats in samFile.get_index_statistics() ]) == len(reads)
+    samFile.close()
+    return reads
+
+@pytest.mark.parametrize("threads, batchSize", [ (1, 97), (3, 100000) ])
+def test_read_separation(slamseqData, tmp_path, threads, batchSize):
+    bam = str(tmp_path / "multimappers.bam")
+    assert writeMultimappers(slamseqData, bam) > 100
+    backgroundReads, tcReads = separateReads(slamseqData, bam, 27, 1)
+
+    # Reads of chr5 that have to move to the TC file because of an alignment
+    # on another chromosome
+    tcNames = set([ read.split("\t")[0] for read in tcReads ])
+    samFile = pysam.AlignmentFile(bam, "rb")
+    chr5TcNames = set([ read.query_name for read in samFile.fetch(contig="chr5") if read.query_name in tcNames ])
+    otherTcNames = set([ read.query_name for read in samFile.fetch() if read.reference_name != "chr5" and read.query_name in tcNames ])
+    samFile.close()
+    assert len(chr5TcNames & otherTcNames) > 10
+
+    outputPrefix = str(tmp_path / "sample")
+    with open(os.path.join(str(tmp_path), "separator.log"), "w") as log:
+        tcounter.genomewideReadSeparation(slamseqData.reference, slamseqData.vcf, bam, 27, outputPrefix, 1, log, threads, batchSize)
+    assert readRecords(outputPrefix + "_backgroundReads.bam") == backgroundReads
+    assert readRecords(outputPrefix + "_TCReads.bam") == tcReads
+    assert [ fileName for fileName in os.listdir(str(tmp_path)) if "_shard" in fileName ] == []
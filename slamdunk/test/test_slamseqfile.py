@@ -0,0 +1,60 @@
+# Batch decoder (SlamSeqBatchIterator) against the per read iterator
+# (SlamSeqBamIterator) on the simulated data set (see conftest.py)
+
+import sys
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile, ReadDirection
+from slamdunk.utils import SNPtools
+from slamdunk.utils.BedReader import BedIterator
+
+bases = "ACGTN"
+
+def readValues(read):
+    mismatches = [ (mismatch.readPosition, mismatch.referencePosition, mismatch.readBase, mismatch.referenceBase, mismatch.readBaseQlty, mismatch.isSnpPosition) for mismatch in read.mismatches ]
+    return (read.startRefPos, read.endRefPos, read.direction == ReadDirection.Reverse, read.isMultimapper, read.getTcount(), read.tcCount, read.isTcRead, list(read.conversionRates), mismatches)
+
+def batchValues(batches):
+    values = []
+    for batch in batches:
+        for i in range(0, len(batch)):
+            start, end = batch.mismatchOffsets[i], batch.mismatchOffsets[i + 1]
+            mismatches = [ (int(batch.mismatchReadPos[j]), int(batch.mismatchRefPos[j]), bases[batch.mismatchReadBase[j]], bases[batch.mismatchRefBase[j]], int(batch.mismatchQuality[j]), bool(batch.mismatchIsSnp[j])) for j in range(start, end) ]
+            values.append((int(batch.startRefPos[i]), int(batch.endRefPos[i]), bool(batch.isReverse[i]), bool(batch.isMultimapper[i]), int(batch.tCount[i]), int(batch.tcCount[i]), bool(batch.isTcRead[i]), batch.conversionRates[i].tolist(), mismatches))
+    return values
+
+def openBamFile(slamseqData):
+    snps = SNPtools.SNPDictionary(slamseqData.vcf)
+    snps.read()
+    return SlamSeqBamFile(slamseqData.bam, slamseqData.reference, snps)
+
+@pytest.mark.parametrize("minQual, conversionThreshold", [ (0, 1), (27, 2) ])
+def test_chromosome_batches(slamseqData, minQual, conversionThreshold):
+    bamFile = openBamFile(slamseqData)
+    readCount = 0
+    for chromosome in bamFile.getChromosomes():
+        expected = [ readValues(read) for read in bamFile.readsInChromosome(chromosome, minQual, conversionThreshold) ]
+        # Small batches: reads of a chromosome are split into several batches
+        assert batchValues(bamFile.readBatchesInChromosome(chromosome, minQual, conversionThreshold, batchSize=97)) == expected
+        readCount += len(expected)
+    assert readCount > 8000
+
+def test_region_batches(slamseqData):
+    bamFile = openBamFile(slamseqData)
+    mismatchCount = 0
+    for utr in BedIterator(slamseqData.bed):
+        expected = [ readValues(read) for read in bamFile.readInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, slamseqData.maxReadLength, 27) ]
+        assert batchValues(bamFile.readBatchesInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, slamseqData.maxReadLength, 27, batchSize=50)) == expected
+        mismatchCount += sum([ len(values[-1]) for values in expected ])
+    assert mismatchCount > 0
+
+def test_batch_selection(slamseqData):
+    bamFile = openBamFile(slamseqData)
+    batch = next(bamFile.readBatchesInChromosome("chr5_random", 27))
+    expected = batchValues([ batch ])
+    mask = batch.isReverse | batch.isMultimapper
+    assert batchValues([ batch.select(mask) ]) == [ values for values, selected in zip(expected, mask) if selected ]
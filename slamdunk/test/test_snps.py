@@ -0,0 +1,67 @@
+# Native SNP calling (slamdunk snp --snp-caller native): sharded against
+# unsharded and region restricted against genome wide calls on the simulated
+# data set (see conftest.py). VarScan needs samtools and java and is not
+# tested here
+
+import sys
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+import pysam
+
+from slamdunk.dunks import snps
+from slamdunk.utils.BedReader import BedIterator
+
+minVarFreq = 0.8
+minCov = 10
+minQual = 27
+
+def callSNPs(data, directory, name, threads, bed=None, padding=0, minVarFreq=minVarFreq, minCov=minCov):
+    outputSNP = str(directory / (name + ".vcf"))
+    with open(str(directory / "snp.log"), "w") as log:
+        snps.callSNPs(data.bam, outputSNP, data.reference, minVarFreq, minCov, minQual, log, force=True, threads=threads, bed=bed, padding=padding)
+    with open(outputSNP) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "##fileformat=VCFv4.1"
+    return [ line for line in lines if not line.startswith("#") ]
+
+def getPosition(line):
+    fields = line.split("\t")
+    return (fields[0], int(fields[1]) - 1)
+
+def test_sharded_calls(slamseqData, tmp_path, monkeypatch):
+    expected = callSNPs(slamseqData, tmp_path, "unsharded", 1)
+    assert len(expected) > 0
+    assert callSNPs(slamseqData, tmp_path, "sharded", 3) == expected
+
+    # Windows of count_coverage don't change the calls
+    monkeypatch.setattr(snps, "snpWindowSize", 7001)
+    assert callSNPs(slamseqData, tmp_path, "windows", 1) == expected
+
+@pytest.mark.parametrize("threads", [ 1, 3 ])
+def test_region_calls(slamseqData, tmp_path, threads):
+    # Low thresholds: conversions and sequencing errors are called in the
+    # padding of the UTRs as well
+    padding = slamseqData.maxReadLength
+    genomeWide = callSNPs(slamseqData, tmp_path, "genome", 1, minVarFreq=0.1, minCov=4)
+    regionCalls = callSNPs(slamseqData, tmp_path, "regions", threads, slamseqData.bed, padding, 0.1, 4)
+
+    utrs = list(BedIterator(slamseqData.bed))
+    def inRegions(position, padding):
+        chromosome, start = position
+        return any([ utr.chromosome == chromosome and utr.start - padding <= start < utr.stop + padding for utr in utrs ])
+
+    assert len([ line for line in regionCalls if not inRegions(getPosition(line), 0) ]) > 0
+    assert regionCalls == [ line for line in genomeWide if inRegions(getPosition(line), padding) ]
+
+def test_planted_snps(slamseqData, tmp_path):
+    # All planted SNPs with enough high quality coverage are called
+    called = set([ getPosition(line) for line in callSNPs(slamseqData, tmp_path, "planted", 2) ])
+    bamFile = pysam.AlignmentFile(slamseqData.bam, "rb")
+    covered = [ (chromosome, position) for chromosome, position in slamseqData.snps if chromosome in bamFile.references and sum([ count[0] for count in bamFile.count_coverage(chromosome, position, position + 1, quality_threshold=minQual) ]) >= 2 * minCov ]
+    bamFile.close()
+    assert len(covered) > 5
+    assert set(covered) <= called
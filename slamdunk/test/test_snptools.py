@@ -0,0 +1,114 @@
+# SNP counts of SNPDictionary against a per base count, and alleyoop snpeval
+# against the per read loop on the simulated data set (see conftest.py)
+
+import os
+import sys
+import random
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+from slamdunk.dunks import stats
+from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile, ReadDirection
+from slamdunk.utils import SNPtools
+from slamdunk.utils.BedReader import BedIterator
+
+chromosomeLength = 5000
+
+def writeVCF(fileName, rand):
+    # T>C, A>G and other SNPs on chr1 and chr2, some at the chromosome borders
+    snps = set([ ("chr1", 0, "T", "C"), ("chr1", chromosomeLength - 1, "A", "G"), ("chr2", 0, "A", "G") ])
+    for _ in range(0, 300):
+        snps.add((rand.choice([ "chr1", "chr2" ]), rand.randrange(0, chromosomeLength), rand.choice("TA"), rand.choice("CGT")))
+    # One entry per position
+    positions = {}
+    for chromosome, position, ref, alt in sorted(snps):
+        positions[(chromosome, position)] = (ref, alt)
+    with open(fileName, "w") as f:
+        f.write("##fileformat=VCFv4.1\n")
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for (chromosome, position), (ref, alt) in sorted(positions.items()):
+            f.write("\t".join([ chromosome, str(position + 1), ".", ref, alt, ".", "PASS", "." ]) + "\n")
+    return positions
+
+def writeBed(fileName, rand):
+    # UTRs at both chromosome borders and on a chromosome without SNPs
+    utrs = [ ("chr1", 0, 100), ("chr1", chromosomeLength - 100, chromosomeLength + 50), ("chr2", 0, 1), ("chr2", 10, 10), ("chrX", 0, 1000) ]
+    for _ in range(0, 100):
+        start = rand.randrange(0, chromosomeLength)
+        utrs.append((rand.choice([ "chr1", "chr2", "chrX" ]), start, start + rand.randrange(1, 500)))
+    with open(fileName, "w") as f:
+        for i, (chromosome, start, stop) in enumerate(utrs):
+            f.write("\t".join([ chromosome, str(start), str(stop), "utr" + str(i), "0", "+" ]) + "\n")
+    return utrs
+
+def countSNPs(positions, chromosome, start, stop, ref, alt):
+    return len([ position for position in range(start, stop) if positions.get((chromosome, position)) == (ref, alt) ])
+
+def test_count_snps(tmp_path):
+    rand = random.Random(11)
+    vcf = str(tmp_path / "snps.vcf")
+    bed = str(tmp_path / "utrs.bed")
+    positions = writeVCF(vcf, rand)
+    utrs = writeBed(bed, rand)
+
+    snps = SNPtools.SNPDictionary(vcf)
+    snps.read()
+
+    tcExpected = [ countSNPs(positions, chromosome, start, stop, "T", "C") for chromosome, start, stop in utrs ]
+    agExpected = [ countSNPs(positions, chromosome, start, stop, "A", "G") for chromosome, start, stop in utrs ]
+    assert sum(tcExpected) > 0 and sum(agExpected) > 0
+
+    assert [ snps.countTCSNPs(chromosome, start, stop) for chromosome, start, stop in utrs ] == tcExpected
+    assert [ snps.countAGSNPs(chromosome, start, stop) for chromosome, start, stop in utrs ] == agExpected
+    assert [ snps.getTCSNPsInUTR(chromosome, start, stop, "TC") for chromosome, start, stop in utrs ] == tcExpected
+    assert [ snps.getAGSNPsInUTR(chromosome, start, stop, "AG") for chromosome, start, stop in utrs ] == agExpected
+
+    for tcCounts, agCounts in [ snps.countSNPsInIntervals([ utr[0] for utr in utrs ], [ utr[1] for utr in utrs ], [ utr[2] for utr in utrs ]), snps.countSNPsInBed(bed) ]:
+        assert tcCounts.tolist() == tcExpected
+        assert agCounts.tolist() == agExpected
+
+    # Same counts from the SNP index written by the first read
+    assert os.path.exists(vcf + ".snpidx")
+    indexed = SNPtools.SNPDictionary(vcf)
+    indexed.read()
+    assert [ indexed.countTCSNPs(chromosome, start, stop) for chromosome, start, stop in utrs ] == tcExpected
+
+def countMaskedRates(data, strictTCs):
+    # Reads, reads with T>C mismatches and reads with T>C mismatches at non-SNP
+    # positions of every UTR
+    snps = SNPtools.SNPDictionary(data.vcf)
+    snps.read()
+    testFile = SlamSeqBamFile(data.bam, data.reference, snps)
+    lines = []
+    for utr in BedIterator(data.bed):
+        unmaskedTCCount = 0
+        maskedTCCount = 0
+        readCount = 0
+        for read in testFile.readInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, data.maxReadLength, 27):
+            if not read.isTcRead and strictTCs:
+                read.mismatches = []
+            isReverse = read.direction == ReadDirection.Reverse
+            inUtr = [ mismatch for mismatch in read.mismatches if mismatch.referencePosition >= 0 and mismatch.referencePosition < utr.getLength() ]
+            isTC = any([ (mismatch.referenceBase, mismatch.readBase) == (("A", "G") if isReverse else ("T", "C")) for mismatch in inUtr ])
+            isTrueTC = any([ mismatch.isTCMismatch(isReverse) for mismatch in inUtr ])
+            readCount += 1
+            unmaskedTCCount += int(isTC)
+            maskedTCCount += int(isTrueTC)
+        lines.append("\t".join([ utr.name, str(readCount), str(unmaskedTCCount), str(maskedTCCount), str(int(unmaskedTCCount != maskedTCCount)) ]))
+    return lines
+
+@pytest.mark.parametrize("strictTCs", [ False, True ])
+def test_snp_masked_rates(slamseqData, tmp_path, strictTCs):
+    expected = countMaskedRates(slamseqData, strictTCs)
+    # UTRs with and without masked SNPs
+    assert len([ line for line in expected if line.endswith("\t1") ]) > 0
+    assert len([ line for line in expected if line.endswith("\t0") and int(line.split("\t")[2]) > 0 ]) > 0
+
+    outputCSV = str(tmp_path / "snpeval.csv")
+    with open(str(tmp_path / "snpeval.log"), "w") as log:
+        stats.computeSNPMaskedRates(slamseqData.reference, slamseqData.bed, slamseqData.vcf, slamseqData.bam, slamseqData.maxReadLength, 27, 10, 0.8, outputCSV, str(tmp_path / "snpeval.pdf"), strictTCs, log, printOnly=True, force=True)
+    with open(outputCSV) as f:
+        assert f.read().splitlines() == expected
@@ -0,0 +1,81 @@
+# T context counts of alleyoop tccontext against the per base loop they
+# replaced, on the simulated data set (see conftest.py) and random reads
+
+import os
+import sys
+import random
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+import pysam
+
+from slamdunk.dunks import stats
+from slamdunk.utils.misc import complement
+
+class Read:
+
+    def __init__(self, sequence, isReverse):
+        self.query_sequence = sequence
+        self.is_reverse = isReverse
+
+def countContexts(reads):
+    # Bases before and after every T of forward reads and every A of
+    # reverse reads (complemented)
+    counts = stats.getTCContextCounts()
+    for read in reads:
+        sequence = read.query_sequence
+        if sequence == None:
+            continue
+        for i in xrange(0, len(sequence)):
+            if sequence[i] == "T" and not read.is_reverse:
+                if i > 0:
+                    counts['5prime']['fwd'][sequence[i - 1] + "T"] += 1
+                if i < len(sequence) - 1:
+                    counts['3prime']['fwd']["T" + sequence[i + 1]] += 1
+            if sequence[i] == "A" and read.is_reverse:
+                if i < len(sequence) - 1:
+                    counts['5prime']['rev'][complement(sequence[i + 1] + "A")] += 1
+                if i > 0:
+                    counts['3prime']['rev'][complement("A" + sequence[i - 1])] += 1
+    return counts
+
+def randomReads(rand, count):
+    reads = []
+    for _ in xrange(0, count):
+        if rand.random() < 0.05:
+            reads.append(Read(None, False))
+        else:
+            sequence = "".join([ rand.choice("ACGTTN") for _ in xrange(0, rand.randrange(1, 12)) ])
+            reads.append(Read(sequence, rand.random() < 0.5))
+    return reads
+
+@pytest.mark.parametrize("batchSize", [ 1, 7, stats.contextBatchSize ])
+def test_context_counts(monkeypatch, batchSize):
+    reads = randomReads(random.Random(3), 500)
+    # Runs of Ts and As, reads starting and ending with the counted base
+    reads += [ Read("TTTT", False), Read("AAAA", True), Read("T", False), Read("A", True), Read("", False), Read("TNA", True) ]
+    monkeypatch.setattr(stats, "contextBatchSize", batchSize)
+    counts = stats.getTCContextCounts()
+    stats.addTCContextCounts(counts, reads)
+    assert counts == countContexts(reads)
+
+def readLines(fileName):
+    with open(fileName) as f:
+        return f.read().splitlines()
+
+@pytest.mark.parametrize("threads", [ 1, 2 ])
+def test_tccontext(slamseqData, tmp_path, threads):
+    bamFile = pysam.AlignmentFile(slamseqData.bam, "rb")
+    expectedCSV = str(tmp_path / "expected.csv")
+    # Mapped reads only, like tccontext
+    reads = [ read for chromosome in bamFile.references for read in bamFile.fetch(region=chromosome) ]
+    stats.writeTCContext(expectedCSV, countContexts(reads))
+    bamFile.close()
+
+    outputCSV = str(tmp_path / "tccontext.csv")
+    with open(os.path.join(str(tmp_path), "tccontext.log"), "w") as log:
+        stats.statsComputeTCContext(slamseqData.reference, slamseqData.bam, 27, outputCSV, str(tmp_path / "tccontext.pdf"), log, printOnly=True, force=True, threads=threads)
+    assert readLines(outputCSV) == readLines(expectedCSV)
@@ -0,0 +1,67 @@
+# Task graph scheduler used by slamdunk all
+
+import os
+import time
+
+import pytest
+
+from slamdunk.utils.TaskScheduler import TaskScheduler
+
+def appendLine(fileName, line):
+    with open(fileName, "a") as f:
+        f.write(line + "\n")
+
+def sleepAndAppend(fileName, line):
+    time.sleep(0.2)
+    appendLine(fileName, line)
+
+def raiseError():
+    raise ValueError("task failed")
+
+def exitWithoutResult():
+    os._exit(1)
+
+def readLines(fileName):
+    if not os.path.exists(fileName):
+        return []
+    with open(fileName) as f:
+        return f.read().split()
+
+def test_dependencies(tmp_path):
+    log = str(tmp_path / "log.txt")
+    scheduler = TaskScheduler(4)
+    first = scheduler.addTask("first", sleepAndAppend, (log, "first"))
+    second = scheduler.addTask("second", appendLine, (log, "second"), dependencies=[ first ])
+    scheduler.addTask("third", appendLine, (log, "third"), dependencies=[ second ])
+    scheduler.run()
+    assert readLines(log) == [ "first", "second", "third" ]
+
+def test_unknown_dependency():
+    scheduler = TaskScheduler(1)
+    with pytest.raises(RuntimeError):
+        scheduler.addTask("task", appendLine, ("x", "x"), dependencies=[ 0 ])
+
+def test_failed_task(tmp_path):
+    log = str(tmp_path / "log.txt")
+    scheduler = TaskScheduler(2)
+    failed = scheduler.addTask("failing", raiseError, ())
+    scheduler.addTask("dependent", appendLine, (log, "dependent"), dependencies=[ failed ])
+    with pytest.raises(RuntimeError, match="failing"):
+        scheduler.run()
+    # Tasks depending on failed tasks are never started
+    assert readLines(log) == []
+
+def test_process_exit_without_result(tmp_path):
+    # A worker that dies without reporting (OOM kill, segfault, os._exit)
+    # fails the run instead of blocking it forever
+    log = str(tmp_path / "log.txt")
+    scheduler = TaskScheduler(2)
+    scheduler.addTask("running", sleepAndAppend, (log, "running"))
+    died = scheduler.addTask("dying", exitWithoutResult, ())
+    scheduler.addTask("dependent", appendLine, (log, "dependent"), dependencies=[ died ])
+    start = time.time()
+    with pytest.raises(RuntimeError, match="dying"):
+        scheduler.run()
+    assert time.time() - start < 30
+    # Running tasks are finished before reporting errors
+    assert readLines(log) == [ "running" ]
@@ -0,0 +1,140 @@
+# Per UTR counts of slamdunk count (computeTconversions) against the per read
+# UTR loop it replaced, on the simulated data set (see conftest.py)
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("slamdunk runs on Python 2", allow_module_level=True)
+
+from slamdunk.dunks import tcounter
+from slamdunk.slamseq.SlamSeqFile import SlamSeqBamFile, SlamSeqInterval, ReadDirection, writeSidecar
+from slamdunk.utils import SNPtools
+from slamdunk.utils.BedReader import BedIterator
+from slamdunk.utils.misc import SlamSeqInfo
+
+def countUtrs(data, bam, minQual, conversionThreshold):
+
+    # Returns the CSV lines, the per read T/TC counts (mle) and the bedgraph
+    # rates computed by reading every UTR separately
+    snps = SNPtools.SNPDictionary(data.vcf)
+    snps.read()
+    testFile = SlamSeqBamFile(bam, data.reference, snps)
+    readNumber = SlamSeqInfo(bam).FilteredReads
+    sequences = dict(data.chromosomes)
+
+    rows = []
+    perRead = []
+    bedGraph = {}
+    for utr in BedIterator(data.bed):
+        Tcontent = 0
+        if utr.chromosome in sequences:
+            Tcontent = sequences[utr.chromosome][utr.start:utr.stop].count("A" if utr.strand == "-" else "T")
+        slamSeqUtr = SlamSeqInterval(utr.chromosome, utr.start, utr.stop, utr.strand, utr.name, Tcontent, 0, 0, 0, 0, 0, 0, 0)
+        slamSeqUtrMLE = SlamSeqInterval(utr.chromosome, utr.start, utr.stop, utr.strand, utr.name, Tcontent, 0, 0, 0, 0, 0, 0, 0)
+
+        readIterator = testFile.readInRegion(utr.chromosome, utr.start, utr.stop, utr.strand, data.maxReadLength, minQual, conversionThreshold)
+        tcCountUtr = [0] * utr.getLength()
+        coverageUtr = [0] * utr.getLength()
+        tInReads = []
+        tcInRead = []
+        readCount = 0
+        tcReadCount = 0
+        multiMapCount = 0
+        for read in readIterator:
+            # Conversions of non-TC reads are ignored
+            if not read.isTcRead:
+                read.tcCount = 0
+                read.mismatches = []
+            isReverse = read.direction == ReadDirection.Reverse
+            readCount += 1
+            if read.tcCount > 0:
+                tcReadCount += 1
+            if read.isMultimapper:
+                multiMapCount += 1
+
+            testN = read.getTcount()
+            testk = 0
+            for mismatch in read.mismatches:
+                if mismatch.referencePosition >= 0 and mismatch.referencePosition < utr.getLength():
+                    if mismatch.isT(isReverse):
+                        testN += 1
+                    if mismatch.isTCMismatch(isReverse):
+                        testk += 1
+                        tcCountUtr[mismatch.referencePosition] += 1
+            tInReads.append(testN)
+            tcInRead.append(testk)
+
+            for i in xrange(read.startRefPos, read.endRefPos):
+                if i >= 0 and i < utr.getLength():
+                    coverageUtr[i] += 1
+
+        if readCount > 0:
+            refSeq = readIterator.getRefSeq()
+            coverageOnTs = 0
+            conversionsOnTs = 0
+            for position in xrange(0, len(coverageUtr)):
+                if coverageUtr[position] > 0 and refSeq[position] == ("A" if utr.strand == "-" else "T"):
+                    coverageOnTs += coverageUtr[position]
+                    conversionsOnTs += tcCountUtr[position]
+                    bedGraph[(utr.chromosome, utr.start + position, utr.strand)] = tcCountUtr[position] * 100.0 / coverageUtr[position]
+            readsCPM = readCount * 1000000.0 / readNumber
+            conversionRate = 0
+            if coverageOnTs > 0:
+                conversionRate = float(conversionsOnTs) / float(coverageOnTs)
+            slamSeqUtr = SlamSeqInterval(utr.chromosome, utr.start, utr.stop, utr.strand, utr.name, Tcontent, readsCPM, coverageOnTs, conversionsOnTs, conversionRate, readCount, tcReadCount, multiMapCount)
+            slamSeqUtrMLE = SlamSeqInterval(utr.chromosome, utr.start, utr.stop, utr.strand, utr.name, Tcontent, readsCPM, coverageOnTs, conversionsOnTs, conversionRate, ",".join(str(x) for x in tInReads), ",".join(str(x) for x in tcInRead), multiMapCount)
+
+        rows.append(str(slamSeqUtr))
+        perRead.append(str(slamSeqUtrMLE))
+
+    return rows, perRead, bedGraph
+
+def runCount(data, bam, directory, minQual, conversionThreshold, threads):
+    outputCSV = os.path.join(directory, "tcount_" + str(threads) + ".tsv")
+    outputPlus = os.path.join(directory, "plus_" + str(threads) + ".bedgraph")
+    outputMinus = os.path.join(directory, "minus_" + str(threads) + ".bedgraph")
+    with open(os.path.join(directory, "count.log"), "w") as log:
+        tcounter.computeTconversions(data.reference, data.bed, data.vcf, bam, data.maxReadLength, minQual, outputCSV, outputPlus, outputMinus, conversionThreshold, log, mle=True, threads=threads, force=True)
+    return outputCSV, outputPlus, outputMinus
+
+def readRows(fileName):
+    with open(fileName) as f:
+        return [ line.rstrip("\n") for line in f if not line.startswith("#") and not line.startswith("Chromosome") ]
+
+def readBedGraphs(outputPlus, outputMinus):
+    bedGraph = {}
+    for strand, fileName in [ ("+", outputPlus), ("-", outputMinus) ]:
+        with open(fileName) as f:
+            for line in f:
+                chromosome, start, end, tcRate = line.split()
+                bedGraph[(chromosome, int(start), strand)] = float(tcRate)
+    return bedGraph
+
+@pytest.mark.parametrize("minQual, conversionThreshold", [ (0, 1), (27, 2) ])
+def test_count_utrs(slamseqData, tmp_path, minQual, conversionThreshold):
+    rows, perRead, bedGraph = countUtrs(slamseqData, slamseqData.bam, minQual, conversionThreshold)
+    assert sum([ int(row.split("\t")[11]) for row in rows ]) > 4000
+
+    for threads in [ 1, 3 ]:
+        outputCSV, outputPlus, outputMinus = runCount(slamseqData, slamseqData.bam, str(tmp_path), minQual, conversionThreshold, threads)
+        assert readRows(outputCSV) == rows
+        assert readRows(tcounter.replaceExtension(outputCSV, ".tsv", "_perread")) == perRead
+        assert readBedGraphs(outputPlus, outputMinus) == pytest.approx(bedGraph)
+
+def test_count_utrs_sidecar(slamseqData, tmp_path):
+    # Same counts from the decoded alignments written by alleyoop index
+    bam = str(tmp_path / "sample.bam")
+    shutil.copy(slamseqData.bam, bam)
+    shutil.copy(slamseqData.bam + ".bai", bam + ".bai")
+    expected = [ readRows(fileName) for fileName in runCount(slamseqData, bam, str(tmp_path), 27, 1, 1) ]
+
+    writeSidecar(bam, batchSize=500)
+    sidecarDirectory = tmp_path / "sidecar"
+    sidecarDirectory.mkdir()
+    assert [ readRows(fileName) for fileName in runCount(slamseqData, bam, str(sidecarDirectory), 27, 1, 2) ] == expected
@@ -0,0 +1,240 @@
+# Copyright (c) 2015 Tobias Neumann, Philipp Rescheneder.
+#
+# This file is part of Slamdunk.
+#
+# Slamdunk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Slamdunk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+
+import os
+import sys
+import hashlib
+import numpy as np
+
+from slamdunk.utils.BedReader import BedIterator, BedEntry, buildIntervalIndex  # @UnresolvedImport
+from slamdunk.utils.misc import md5  # @UnresolvedImport
+from slamdunk.utils.ReferenceProvider import getReferenceProvider  # @UnresolvedImport
+
+# Version of the annotation index written next to the BED file
+AnnotationIndexVersion = "1"
+
+_entryColumns = [ "chromosomes", "starts", "stops", "names", "scores", "strands" ]
+_referenceColumns = [ "tContent", "aContent", "sequenceOffsets" ]
+
+def getAnnotationIndexDirectory(bed):
+    return bed + ".annotation"
+
+def _fileFingerprint(fileName):
+    stat = os.stat(fileName)
+    return str(stat.st_size) + "\t" + repr(stat.st_mtime)
+
+def _referenceKey(referenceFile, maxReadLength):
+    # Subdirectory of the reference dependent part of the index
+    key = "\t".join([ os.path.abspath(referenceFile), _fileFingerprint(referenceFile), str(maxReadLength) ])
+    return hashlib.md5(key.encode("ascii")).hexdigest()
+
+def _save(directory, name, values, suffix):
+    fileName = os.path.join(directory, name + ".npy")
+    with open(fileName + suffix, "wb") as f:
+        np.save(f, values)
+    os.rename(fileName + suffix, fileName)
+
+def _load(directory, name, count):
+    # Empty files can't be memory-mapped
+    if count == 0:
+        return np.load(os.path.join(directory, name + ".npy"))
+    return np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+
+def _readManifest(manifestFile):
+    if not os.path.exists(manifestFile):
+        return None
+    manifest = {}
+    with open(manifestFile, "r") as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t", 1)
+            if len(cols) == 2:
+                manifest[cols[0]] = cols[1]
+    return manifest
+
+def _writeManifest(manifestFile, manifest, suffix):
+    with open(manifestFile + suffix, "w") as f:
+        for key, value in manifest:
+            print(key, value, sep="\t", file=f)
+    os.rename(manifestFile + suffix, manifestFile)
+
+# One index per BED file, reference and maximum read length per process
+_indices = {}
+
+def getAnnotationIndex(bed, referenceFile = None, maxReadLength = None):
+    # Returns the index of bed. T/A content and reference sequences are only
+    # available if referenceFile and maxReadLength are given. Indices are read
+    # from disk if they are up to date and written otherwise
+    key = (os.path.abspath(bed), None, maxReadLength)
+    if referenceFile != None:
+        key = (os.path.abspath(bed), os.path.abspath(referenceFile), maxReadLength)
+    if key not in _indices:
+        index = AnnotationIndex(bed)
+        if referenceFile != None and maxReadLength != None:
+            index.addReference(referenceFile, maxReadLength)
+        _indices[key] = index
+    return _indices[key]
+
+class AnnotationIndex:
+
+    # BED entries stored as arrays (same order as in the BED file) and
+    # optionally the T/A content and the reference sequence (padded by
+    # maxReadLength, see SlamSeqBamFile.readInRegion) of all entries. Written to
+    # <bed>.annotation and memory-mapped on later runs. The index is keyed on
+    # the MD5 of the BED file, so copied or touched BED files reuse it and
+    # edited ones don't
+
+    def __init__(self, bed):
+        self._bed = bed
+        self._directory = getAnnotationIndexDirectory(bed)
+        self.md5 = md5(bed)
+        self.maxReadLength = None
+        self._sequence = None
+
+        if not self._loadEntries():
+            self._compileEntries()
+            try:
+                self._writeEntries()
+            except (IOError, OSError):
+                print("Warning: could not write annotation index for " + bed + ".", file=sys.stderr)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _entriesManifest(self):
+        return [ ("version", AnnotationIndexVersion), ("md5", self.md5) ]
+
+    def _loadEntries(self):
+        manifest = _readManifest(os.path.join(self._directory, "manifest.txt"))
+        if manifest == None or [ (key, manifest.get(key)) for key, _ in self._entriesManifest() ] != self._entriesManifest():
+            return False
+        count = int(manifest["entries"])
+        for name in _entryColumns:
+            setattr(self, name, _load(self._directory, name, count))
+        return True
+
+    def _compileEntries(self):
+        utrs = list(BedIterator(self._bed))
+        self.chromosomes = np.array([ utr.chromosome for utr in utrs ], dtype=np.str_)
+        self.starts = np.array([ utr.start for utr in utrs ], dtype=np.int64)
+        self.stops = np.array([ utr.stop for utr in utrs ], dtype=np.int64)
+        self.names = np.array([ utr.name for utr in utrs ], dtype=np.str_)
+        self.scores = np.array([ utr.score for utr in utrs ], dtype=np.str_)
+        self.strands = np.array([ utr.strand for utr in utrs ], dtype=np.str_)
+
+    def _writeEntries(self):
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory)
+        # Written to temporary files first: other processes might read the index at the same time
+        suffix = ".tmp" + str(os.getpid())
+        for name in _entryColumns:
+            _save(self._directory, name, getattr(self, name), suffix)
+        _writeManifest(os.path.join(self._directory, "manifest.txt"), self._entriesManifest() + [ ("entries", str(len(self))) ], suffix)
+
+    def addReference(self, referenceFile, maxReadLength):
+        self.maxReadLength = maxReadLength
+        referenceDirectory = os.path.join(self._directory, _referenceKey(referenceFile, maxReadLength))
+        manifest = _readManifest(os.path.join(referenceDirectory, "manifest.txt"))
+        if manifest != None and manifest.get("version") == AnnotationIndexVersion and manifest.get("md5") == self.md5:
+            for name in _referenceColumns:
+                setattr(self, name, _load(referenceDirectory, name, len(self)))
+            if os.path.getsize(os.path.join(referenceDirectory, "sequence.bin")) > 0:
+                self._sequence = np.memmap(os.path.join(referenceDirectory, "sequence.bin"), dtype=np.uint8, mode="r")
+            return
+
+        sequence = self._compileReference(referenceFile, maxReadLength)
+        try:
+            self._writeReference(referenceDirectory, sequence, [ ("version", AnnotationIndexVersion), ("md5", self.md5), ("reference", os.path.abspath(referenceFile)), ("maxReadLength", str(maxReadLength)) ])
+        except (IOError, OSError):
+            print("Warning: could not write annotation index for " + self._bed + ".", file=sys.stderr)
+
+    def _compileReference(self, referenceFile, maxReadLength):
+        reference = getReferenceProvider(referenceFile)
+        self.tContent = np.zeros(len(self), dtype=np.int64)
+        self.aContent = np.zeros(len(self), dtype=np.int64)
+        self.sequenceOffsets = np.zeros(len(self) + 1, dtype=np.int64)
+        sequences = []
+        for i in xrange(0, len(self)):
+            chromosome = str(self.chromosomes[i])
+            start = int(self.starts[i])
+            stop = int(self.stops[i])
+            refSeq = ""
+            if reference.isInReference(chromosome):
+                self.tContent[i] = np.count_nonzero(reference.isBase(chromosome, start, stop, "T"))
+                self.aContent[i] = np.count_nonzero(reference.isBase(chromosome, start, stop, "A"))
+
+                # Same as SlamSeqBamFile.readInRegion: fill up with Ns at chromosome borders
+                chromosomeLength = reference.getLength(chromosome)
+                leftBorder = start - maxReadLength
+                rightBorder = stop + maxReadLength
+                refSeq = 'N' * max(0, -leftBorder) + reference.fetch(chromosome, max(0, leftBorder), min(chromosomeLength, rightBorder)) + 'N' * max(0, rightBorder - chromosomeLength)
+            sequences.append(refSeq)
+            self.sequenceOffsets[i + 1] = self.sequenceOffsets[i] + len(refSeq)
+
+        sequence = "".join(sequences)
+        if len(sequence) > 0:
+            self._sequence = np.frombuffer(sequence, dtype=np.uint8)
+        return sequence
+
+    def _writeReference(self, referenceDirectory, sequence, manifest):
+        if not os.path.exists(referenceDirectory):
+            os.makedirs(referenceDirectory)
+        suffix = ".tmp" + str(os.getpid())
+        for name in _referenceColumns:
+            _save(referenceDirectory, name, getattr(self, name), suffix)
+        with open(os.path.join(referenceDirectory, "sequence.bin") + suffix, "wb") as f:
+            f.write(sequence)
+        os.rename(os.path.join(referenceDirectory, "sequence.bin") + suffix, os.path.join(referenceDirectory, "sequence.bin"))
+        _writeManifest(os.path.join(referenceDirectory, "manifest.txt"), manifest, suffix)
+
+    def getEntry(self, i):
+        utr = BedEntry()
+        utr.chromosome = str(self.chromosomes[i])
+        utr.start = int(self.starts[i])
+        utr.stop = int(self.stops[i])
+        utr.name = str(self.names[i])
+        utr.score = str(self.scores[i])
+        utr.strand = str(self.strands[i])
+        return utr
+
+    def getEntries(self):
+        return [ self.getEntry(i) for i in xrange(0, len(self)) ]
+
+    def getTcontent(self, i):
+        # Number of Ts (As for entries on the minus strand)
+        if self.strands[i] == "-":
+            return int(self.aContent[i])
+        return int(self.tContent[i])
+
+    def getSequence(self, i):
+        # Reference sequence of entry i padded by maxReadLength
+        if self._sequence is None:
+            return ""
+        return self._sequence[self.sequenceOffsets[i]:self.sequenceOffsets[i + 1]].tostring()
+
+    def getBases(self, i):
+        # Reference bases (uint8) of entry i without padding. Positions outside
+        # of the chromosome are N
+        if self._sequence is None or self.sequenceOffsets[i] == self.sequenceOffsets[i + 1]:
+            return np.zeros(0, dtype=np.uint8)
+        start = self.sequenceOffsets[i] + self.maxReadLength
+        return self._sequence[start:start + int(self.stops[i] - self.starts[i])]
+
+    def getIntervalIndex(self):
+        # Same as BedReader.bedToIntervalIndex
+        return buildIntervalIndex([ str(chromosome) for chromosome in self.chromosomes ], self.starts, self.stops, [ str(name) for name in self.names ])
@@ -0,0 +1,109 @@
+# Copyright (c) 2015 Tobias Neumann, Philipp Rescheneder.
+#
+# This file is part of Slamdunk.
+#
+# Slamdunk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Slamdunk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import heapq
+import tempfile
+
+from slamdunk.utils.misc import removeFile, openBam  # @UnresolvedImport
+
+def _sortKey(read):
+    # Same order as samtools sort: reference (unmapped reads last), position, strand
+    tid = read.reference_id
+    if tid < 0:
+        tid = 1 << 32
+    return (tid, read.reference_start + 1, read.is_reverse)
+
+def _sortedRun(fileName, runIndex):
+    bam = openBam(fileName, "rb", check_sq=False)
+    for order, read in enumerate(bam.fetch(until_eof=True)):
+        yield _sortKey(read), runIndex, order, read
+    bam.close()
+
+# Number of reads kept in memory before a sorted run is written (--sort-buffer)
+DefaultMaxRecords = 1000000
+
+class SortingBamWriter:
+
+    # Writes reads to a coordinate sorted BAM file. Reads are kept in memory
+    # until maxRecords is reached, then the sorted run is written to a
+    # temporary, uncompressed BAM file. close() merges all runs into the
+    # output file. The header of the output file is only needed in close(),
+    # so it can contain information computed from the reads (e.g. read counts)
+
+    def __init__(self, outputBAM, template, maxRecords = DefaultMaxRecords, tmpDirectory = None, threads = 1, compressionLevel = None):
+        self._outputBAM = outputBAM
+        self._threads = threads
+        self._compressionLevel = compressionLevel
+        self._template = template
+        self._maxRecords = maxRecords
+        if tmpDirectory == None:
+            tmpDirectory = os.path.dirname(os.path.abspath(outputBAM))
+        self._tmpDirectory = tmpDirectory
+        self._reads = []
+        self._runs = []
+
+    def write(self, read):
+        self._reads.append(read)
+        if len(self._reads) >= self._maxRecords:
+            self._spill()
+
+    def _sortReads(self):
+        # Stable: reads at the same position keep their input order
+        reads = self._reads
+        self._reads = []
+        keys = [ _sortKey(read) for read in reads ]
+        return [ reads[i] for i in sorted(xrange(0, len(reads)), key=keys.__getitem__) ]
+
+    def _spill(self):
+        handle, fileName = tempfile.mkstemp(suffix=".bam", prefix=os.path.basename(self._outputBAM) + "_run", dir=self._tmpDirectory)
+        os.close(handle)
+        self._runs.append(fileName)
+        run = openBam(fileName, "wbu", template=self._template)
+        for read in self._sortReads():
+            run.write(read)
+        run.close()
+
+    def close(self, header = None):
+        if header == None:
+            header = self._template.header
+        if not isinstance(header, dict):
+            header = header.to_dict()
+        header = dict(header)
+        hd = dict(header.get('HD', { 'VN': '1.0' }))
+        hd['SO'] = 'coordinate'
+        header['HD'] = hd
+
+        outfile = openBam(self._outputBAM, "wb", self._threads, self._compressionLevel, header=header)
+        if len(self._runs) == 0:
+            # All reads fit into memory: single write pass
+            for read in self._sortReads():
+                outfile.write(read)
+        else:
+            if len(self._reads) > 0:
+                self._spill()
+            for _, _, _, read in heapq.merge(*[ _sortedRun(fileName, runIndex) for runIndex, fileName in enumerate(self._runs) ]):
+                outfile.write(read)
+            removeFile(self._runs)
+            self._runs = []
+        outfile.close()
+
+    def abort(self):
+        # Removes all temporary files without writing the output file
+        removeFile(self._runs)
+        self._runs = []
+        self._reads = []
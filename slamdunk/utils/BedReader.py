@@ -15,19 +15,90 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from intervaltree import IntervalTree
+import numpy as np
+
+class IntervalIndex:
+
+    # Overlap queries on the intervals of one chromosome. Intervals are sorted
+    # by start and augmented with the maximum end of all preceding intervals,
+    # so all candidates for an overlap are found with two binary searches
+
+    def __init__(self, starts, ends, data):
+        order = np.argsort(np.asarray(starts, dtype=np.int64), kind="mergesort")
+        self.starts = np.asarray(starts, dtype=np.int64)[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.data = [ data[i] for i in order ]
+        self._maxEnds = np.maximum.accumulate(self.ends) if len(self.ends) > 0 else self.ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _candidates(self, start, end):
+        # Intervals [i, j) might overlap start - end
+        return np.searchsorted(self._maxEnds, start, "right"), np.searchsorted(self.starts, end, "left")
+
+    def overlapIndices(self, start, end):
+        # Indices of all intervals overlapping [start, end)
+        if start >= end:
+            return np.zeros(0, dtype=np.int64)
+        first, last = self._candidates(start, end)
+        candidates = np.arange(first, last)
+        return candidates[self.ends[candidates] > start]
+
+    def overlap(self, start, end):
+        # Data of all intervals overlapping [start, end)
+        return [ self.data[i] for i in self.overlapIndices(start, end) ]
+
+    def overlapBatch(self, starts, ends):
+        # Vectorized overlapIndices for many queries. Returns offsets and indices:
+        # the intervals overlapping query k are indices[offsets[k]:offsets[k + 1]]
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        first, last = self._candidates(starts, ends)
+        candidateCounts = np.where(starts < ends, np.maximum(last - first, 0), 0)
+        query = np.repeat(np.arange(len(starts)), candidateCounts)
+        candidateOffsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(candidateCounts, out=candidateOffsets[1:])
+        candidates = np.arange(candidateOffsets[-1]) - candidateOffsets[query] + first[query]
+        isOverlap = self.ends[candidates] > starts[query]
+
+        offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(query[isOverlap], minlength=len(starts)), out=offsets[1:])
+        return offsets, candidates[isOverlap]
+
+def buildIntervalIndex(chromosomes, starts, stops, names):
+    # Index of [start, stop + 1) -> name for each chromosome. Identical entries are only stored once
+    intervals = {}
+    for chromosome, start, stop, name in zip(chromosomes, starts, stops, names):
+        intervals.setdefault(chromosome, set()).add((int(start), int(stop) + 1, name))
 
-def bedToIntervallTree(bed):
     utrs = {}
-        
+    for chromosome in intervals.keys():
+        entries = sorted(intervals[chromosome])
+        utrs[chromosome] = IntervalIndex([ entry[0] for entry in entries ], [ entry[1] for entry in entries ], [ entry[2] for entry in entries ])
+    return utrs
+
+def bedToIntervalIndex(bed):
+    utrs = list(BedIterator(bed))
+    return buildIntervalIndex([ utr.chromosome for utr in utrs ], [ utr.start for utr in utrs ], [ utr.stop for utr in utrs ], [ utr.name for utr in utrs ])
+
+def bedToRegions(bed, padding = 0):
+    # Sorted, merged intervals [start - padding, stop + padding) of all BED entries per chromosome
+    intervals = {}
     for utr in BedIterator(bed):
+        intervals.setdefault(utr.chromosome, []).append((max(0, utr.start - padding), utr.stop + padding))
+
+    regions = {}
+    for chromosome in intervals.keys():
+        merged = []
+        for start, stop in sorted(intervals[chromosome]):
+            if len(merged) > 0 and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+            else:
+                merged.append((start, stop))
+        regions[chromosome] = merged
+    return regions
 
-        if (not utrs.has_key(utr.chromosome)) :
-            utrs[utr.chromosome] = IntervalTree()
-        
-        utrs[utr.chromosome][utr.start:(utr.stop + 1)] = utr.name
-        
-    return utrs
 
 
 class BedEntry:
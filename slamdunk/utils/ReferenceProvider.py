@@ -0,0 +1,304 @@
+# Copyright (c) 2015 Tobias Neumann, Philipp Rescheneder.
+#
+# This file is part of Slamdunk.
+#
+# Slamdunk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Slamdunk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import collections
+import pysam
+import numpy as np
+
+# Maximum size (in MB) of the uppercased chromosomes kept in memory by all
+# processes of a run together (--reference-cache)
+DefaultCacheSize = 1024
+
+# Cache size (in MB) per process. Set by setCacheSize in the environment, so
+# worker processes started afterwards use the same size
+_cacheSizeVariable = "SLAMDUNK_REFERENCE_CACHE"
+
+def getDefaultCacheSize():
+    return int(os.environ.get(_cacheSizeVariable, DefaultCacheSize)) * 1024 * 1024
+
+def setCacheSize(cacheSize, processes = 1):
+    # Splits cacheSize (in MB) between processes. Applies to all providers
+    # of this process and to worker processes started afterwards
+    processCacheSize = max(1, int(cacheSize) // max(1, processes))
+    os.environ[_cacheSizeVariable] = str(processCacheSize)
+    for provider in _providers.values():
+        provider.setMaxCacheSize(processCacheSize * 1024 * 1024)
+
+# Version of the packed reference written by writePackedReference
+PackedReferenceVersion = "1"
+
+# 2 bit codes of the packed reference. Same codes as BaseCode in SlamSeqFile,
+# all other characters are stored as N in the N-mask
+_packedBases = "ACGTN"
+_packedCode = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate("ACGT"):
+    _packedCode[ord(_base)] = _code
+    _packedCode[ord(_base.lower())] = _code
+_packedAscii = np.frombuffer(_packedBases.encode("ascii"), dtype=np.uint8)
+
+def getPackedReferenceDirectory(referenceFile):
+    return referenceFile + ".packed"
+
+def _packedReferenceManifest(referenceFile, chromosomes):
+    # chromosomes: list of (name, length, sequence offset, N-mask offset)
+    stat = os.stat(referenceFile)
+    lines = [ "version\t" + PackedReferenceVersion, "size\t" + str(stat.st_size), "mtime\t" + repr(stat.st_mtime) ]
+    for chromosome in chromosomes:
+        lines.append("\t".join([ "chromosome" ] + [ str(value) for value in chromosome ]))
+    return "\n".join(lines) + "\n"
+
+def writePackedReference(referenceFile):
+    # Writes all chromosomes as 2 bit codes (4 bases per byte) plus a 1 bit
+    # N-mask. Chromosomes start at byte boundaries in both files
+
+    packedDirectory = getPackedReferenceDirectory(referenceFile)
+    if not os.path.exists(packedDirectory):
+        os.makedirs(packedDirectory)
+    manifestFile = os.path.join(packedDirectory, "manifest.txt")
+    if os.path.exists(manifestFile):
+        os.remove(manifestFile)
+
+    fasta = pysam.FastaFile(referenceFile)
+    chromosomes = []
+    sequenceOffset = 0
+    maskOffset = 0
+    with open(os.path.join(packedDirectory, "sequence.bin"), "wb") as sequenceFile, open(os.path.join(packedDirectory, "nmask.bin"), "wb") as maskFile:
+        for chromosome, length in zip(fasta.references, fasta.lengths):
+            codes = np.zeros(((length + 3) // 4) * 4, dtype=np.uint8)
+            if length > 0:
+                codes[:length] = _packedCode[np.frombuffer(fasta.fetch(reference=chromosome).encode("ascii"), dtype=np.uint8)]
+            isN = codes[:length] == 4
+            codes[codes == 4] = 0
+            codes = codes.reshape(-1, 4)
+            packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+            mask = np.packbits(isN)
+
+            sequenceFile.write(packed.astype(np.uint8).tostring())
+            maskFile.write(mask.tostring())
+            chromosomes.append((chromosome, length, sequenceOffset, maskOffset))
+            sequenceOffset += len(packed)
+            maskOffset += len(mask)
+    fasta.close()
+
+    # Written last: packed references without manifest are never used
+    with open(manifestFile, "w") as f:
+        f.write(_packedReferenceManifest(referenceFile, chromosomes))
+
+class PackedReference:
+
+    # Read-only view on a reference written by writePackedReference. Both files
+    # are memory-mapped, so all processes share the same pages
+
+    @classmethod
+    def open(cls, referenceFile):
+        # Returns the packed reference or None if there is no up-to-date one
+        manifestFile = os.path.join(getPackedReferenceDirectory(referenceFile), "manifest.txt")
+        if not os.path.exists(manifestFile):
+            return None
+        with open(manifestFile, "r") as f:
+            manifest = f.read()
+        chromosomes = []
+        for line in manifest.splitlines():
+            cols = line.split("\t")
+            if cols[0] == "chromosome":
+                chromosomes.append((cols[1], int(cols[2]), int(cols[3]), int(cols[4])))
+        if manifest != _packedReferenceManifest(referenceFile, chromosomes):
+            return None
+        return cls(referenceFile, chromosomes)
+
+    def __init__(self, referenceFile, chromosomes):
+        packedDirectory = getPackedReferenceDirectory(referenceFile)
+        self._chromosomes = dict((chromosome[0], chromosome[1:]) for chromosome in chromosomes)
+        self._sequence = None
+        self._mask = None
+        # Empty files can't be memory-mapped
+        if os.path.getsize(os.path.join(packedDirectory, "sequence.bin")) > 0:
+            self._sequence = np.memmap(os.path.join(packedDirectory, "sequence.bin"), dtype=np.uint8, mode="r")
+            self._mask = np.memmap(os.path.join(packedDirectory, "nmask.bin"), dtype=np.uint8, mode="r")
+
+    def fetchCodes(self, chromosome, start, end):
+        # Base codes (A = 0, C = 1, G = 2, T = 3, N = 4) of chromosome:start-end.
+        # start and end have to be within the chromosome
+        length, sequenceOffset, maskOffset = self._chromosomes[chromosome]
+        if start >= end:
+            return np.zeros(0, dtype=np.uint8)
+
+        packed = self._sequence[sequenceOffset + start // 4:sequenceOffset + (end + 3) // 4]
+        codes = np.empty((len(packed), 4), dtype=np.uint8)
+        for i in xrange(0, 4):
+            codes[:, i] = (packed >> (6 - 2 * i)) & 3
+        codes = codes.ravel()[start % 4:start % 4 + end - start]
+
+        isN = np.unpackbits(self._mask[maskOffset + start // 8:maskOffset + (end + 7) // 8])[start % 8:start % 8 + end - start]
+        codes[isN == 1] = 4
+        return codes
+
+    def fetchArray(self, chromosome, start, end):
+        # Uppercased ASCII bases of chromosome:start-end
+        return _packedAscii[self.fetchCodes(chromosome, start, end)]
+
+    def isBase(self, chromosome, start, end, base):
+        # Bitmap of the positions of base (e.g. T or A) in chromosome:start-end
+        return self.fetchCodes(chromosome, start, end) == _packedBases.index(base)
+
+# One provider per reference file and process
+_providers = {}
+
+def getReferenceProvider(referenceFile, maxCacheSize = None):
+    # Returns the shared provider for referenceFile. referenceFile can also be a
+    # ReferenceProvider
+    if isinstance(referenceFile, ReferenceProvider):
+        return referenceFile
+    key = os.path.abspath(referenceFile)
+    if key not in _providers:
+        _providers[key] = ReferenceProvider(referenceFile, maxCacheSize)
+    elif maxCacheSize != None:
+        _providers[key].setMaxCacheSize(maxCacheSize)
+    return _providers[key]
+
+class ReferenceProvider:
+
+    # Uppercased reference sequences. Sequences are read from the packed
+    # reference if there is an up-to-date one (see writePackedReference).
+    # Otherwise complete chromosomes are kept in a least-recently-used cache.
+    # Chromosomes that don't fit into the cache are fetched from the FASTA
+    # file region by region
+
+    def __init__(self, referenceFile, maxCacheSize = None):
+        self._referenceFile = pysam.FastaFile(referenceFile)
+        self.references = list(self._referenceFile.references)
+        self._referenceNames = set(self.references)
+        self._lengths = dict(zip(self.references, self._referenceFile.lengths))
+        self._packed = PackedReference.open(referenceFile)
+
+        if maxCacheSize == None:
+            maxCacheSize = getDefaultCacheSize()
+        self._maxCacheSize = maxCacheSize
+        # chromosome -> (sequence, numpy view on sequence)
+        self._cache = collections.OrderedDict()
+        self._cacheSize = 0
+
+    def setMaxCacheSize(self, maxCacheSize):
+        self._maxCacheSize = maxCacheSize
+        self._evict(0)
+
+    def isInReference(self, chromosome):
+        return chromosome in self._referenceNames
+
+    def getLength(self, chromosome):
+        return self._lengths[chromosome]
+
+    def _evict(self, size):
+        # Removes least recently used chromosomes until size bytes fit into the cache
+        while len(self._cache) > 0 and self._cacheSize + size > self._maxCacheSize:
+            _, (sequence, _) = self._cache.popitem(last=False)
+            self._cacheSize -= len(sequence)
+
+    def _getCached(self, chromosome):
+        if chromosome in self._cache:
+            entry = self._cache.pop(chromosome)
+            self._cache[chromosome] = entry
+            return entry
+
+        length = self._lengths[chromosome]
+        if length > self._maxCacheSize:
+            return None
+
+        self._evict(length)
+        sequence = self._referenceFile.fetch(reference=chromosome).upper()
+        if len(sequence) > 0:
+            entry = (sequence, np.frombuffer(sequence, dtype=np.uint8))
+        else:
+            entry = (sequence, np.zeros(0, dtype=np.uint8))
+        self._cache[chromosome] = entry
+        self._cacheSize += len(sequence)
+        return entry
+
+    def _clip(self, chromosome, start, end):
+        length = self._lengths[chromosome]
+        if start == None:
+            start = 0
+        if end == None:
+            end = length
+        return min(max(0, int(start)), length), min(max(0, int(end)), length)
+
+    def fetch(self, chromosome, start = None, end = None):
+        # Uppercased sequence of chromosome:start-end (0-based, end exclusive)
+        start, end = self._clip(chromosome, start, end)
+        if self._packed != None:
+            return self._packed.fetchArray(chromosome, start, end).tostring()
+        entry = self._getCached(chromosome)
+        if entry == None:
+            if start >= end:
+                return ""
+            return self._referenceFile.fetch(reference=chromosome, start=start, end=end).upper()
+        if start == 0 and end == len(entry[0]):
+            return entry[0]
+        return entry[0][start:end]
+
+    def fetchArray(self, chromosome, start = None, end = None):
+        # Same as fetch but returns a numpy uint8 array. For cached chromosomes
+        # this is a view on the cache and must not be modified
+        start, end = self._clip(chromosome, start, end)
+        if self._packed != None:
+            return self._packed.fetchArray(chromosome, start, end)
+        entry = self._getCached(chromosome)
+        if entry == None:
+            sequence = self.fetch(chromosome, start, end)
+            if len(sequence) == 0:
+                return np.zeros(0, dtype=np.uint8)
+            return np.frombuffer(sequence, dtype=np.uint8)
+        return entry[1][start:end]
+
+    def isBase(self, chromosome, start, end, base):
+        # Bitmap of the positions of base (e.g. T or A) in chromosome:start-end
+        start, end = self._clip(chromosome, start, end)
+        if self._packed != None:
+            return self._packed.isBase(chromosome, start, end, base)
+        return self.fetchArray(chromosome, start, end) == ord(base)
+
+    def getSequence(self, chromosome):
+        # Uppercased sequence of a complete chromosome. Only the slices that
+        # are accessed are fetched
+        return ReferenceSequence(self, chromosome)
+
+class ReferenceSequence:
+
+    # Read-only string-like view on a chromosome of a ReferenceProvider
+
+    def __init__(self, provider, chromosome):
+        self._provider = provider
+        self._chromosome = chromosome
+
+    def __len__(self):
+        return self._provider.getLength(self._chromosome)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return str(self)[index]
+            return self._provider.fetch(self._chromosome, start, stop)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("reference index out of range")
+        return self._provider.fetch(self._chromosome, index, index + 1)
+
+    def __str__(self):
+        return self._provider.fetch(self._chromosome)
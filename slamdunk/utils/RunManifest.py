@@ -0,0 +1,119 @@
+# Copyright (c) 2015 Tobias Neumann, Philipp Rescheneder.
+#
+# This file is part of Slamdunk.
+#
+# Slamdunk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Slamdunk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import os
+import json
+import fcntl
+import hashlib
+
+from slamdunk.version import __version__  # @UnresolvedImport
+
+ManifestFileName = "slamdunk_manifest.jsonl"
+
+# Size of the blocks read from the start, middle and end of a file
+FingerprintBlockSize = 64 * 1024
+
+StatusStarted = "started"
+StatusDone = "done"
+
+def fileFingerprint(fileName):
+    # File size and MD5 of three sampled blocks. Independent of path and
+    # modification time, so copied files have the same fingerprint
+    size = os.path.getsize(fileName)
+    md5 = hashlib.md5()
+    with open(fileName, "rb") as f:
+        for offset in sorted(set([ 0, max(0, size // 2 - FingerprintBlockSize // 2), max(0, size - FingerprintBlockSize) ])):
+            f.seek(offset)
+            md5.update(f.read(FingerprintBlockSize))
+    return str(size) + ":" + md5.hexdigest()
+
+def getRunManifest(outFiles):
+    # Manifest in the directory of the first output file
+    return RunManifest(os.path.dirname(os.path.abspath(outFiles[0])))
+
+class RunManifest:
+
+    # Records for every step (identified by its output files) the fingerprints
+    # of its input and output files, its parameters and the slamdunk version.
+    # Records are appended to <directory>/slamdunk_manifest.jsonl under an
+    # exclusive lock, so parallel jobs can share a directory. The last record
+    # of a step is the valid one
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._manifestFile = os.path.join(directory, ManifestFileName)
+
+    def _key(self, outFiles):
+        return "\t".join([ os.path.relpath(os.path.abspath(outFile), self._directory) for outFile in outFiles ])
+
+    def _readRecords(self):
+        records = {}
+        if not os.path.exists(self._manifestFile):
+            return records
+        with open(self._manifestFile, "r") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Incomplete line of an interrupted write
+                    continue
+                records[record["step"]] = record
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return records
+
+    def _appendRecord(self, record):
+        with open(self._manifestFile, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    def getRecord(self, outFiles):
+        # Last record of the step writing outFiles or None
+        return self._readRecords().get(self._key(outFiles))
+
+    def isValid(self, inFiles, outFiles, parameters):
+        # True if outFiles were written by a finished step with the same
+        # inputs, parameters and version and were not changed since
+        record = self.getRecord(outFiles)
+        if record == None or record["status"] != StatusDone or record["version"] != __version__:
+            return False
+        if record["parameters"] != [ str(parameter) for parameter in parameters ]:
+            return False
+        if record["inputs"] != [ fileFingerprint(inFile) for inFile in inFiles ]:
+            return False
+        return record["outputs"] == [ fileFingerprint(outFile) for outFile in outFiles ]
+
+    def start(self, inFiles, outFiles, parameters):
+        # Outputs of unfinished steps are never reused
+        self._appendRecord({
+            "step": self._key(outFiles),
+            "status": StatusStarted,
+            "version": __version__,
+            "parameters": [ str(parameter) for parameter in parameters ],
+            "inputs": [ fileFingerprint(inFile) for inFile in inFiles ],
+            "outputs": []
+        })
+
+    def finish(self, outFiles, started):
+        # Inputs and parameters are taken from the record written by start
+        record = dict(started)
+        record["status"] = StatusDone
+        record["outputs"] = [ fileFingerprint(outFile) for outFile in outFiles ]
+        self._appendRecord(record)
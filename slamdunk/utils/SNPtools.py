@@ -15,60 +15,187 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import print_function
+
 import os
+import sys
+import gzip
+import numpy as np
 
-from pybedtools import BedTool
+from slamdunk.utils.BedReader import BedIterator  # @UnresolvedImport
 
+# Version of the SNP index files written next to the VCF file
+SNPIndexVersion = "1"
 
 class SNPDictionary(object):
     
     def __init__(self, vcfFile):
         self._vcfFile = vcfFile
-        self._tcSNPs = {}
-        self._agSNPs = {}
+        # Sorted 0-based positions of T>C and A>G SNPs of all chromosomes. The
+        # SNPs of a chromosome are stored at [start:end] of _ranges[chromosome]
+        self._tcSNPs = np.zeros(0, dtype=np.int64)
+        self._agSNPs = np.zeros(0, dtype=np.int64)
+        self._tcRanges = {}
+        self._agRanges = {}
 
-    def _addSNP(self, snp):
+    def _indexFiles(self):
+        return self._vcfFile + ".snpidx", self._vcfFile + ".tc.npy", self._vcfFile + ".ag.npy"
 
-        if(snp[3].upper() == "T" and snp[4].upper() == "C"):
-            key = snp[0] + snp[1]
-            self._tcSNPs[key] = True
-        
-        if(snp[3].upper() == "A" and snp[4].upper() == "G"):
-            key = snp[0] + snp[1]
-            self._agSNPs[key] = True
+    def _fingerprint(self):
+        stat = os.stat(self._vcfFile)
+        return "\t".join([ "#snpindex", SNPIndexVersion, str(stat.st_size), repr(stat.st_mtime) ])
+
+    def _parseVCF(self):
+        tcSNPs = {}
+        agSNPs = {}
+        wrongFileType = False
+        if self._vcfFile.endswith(".gz"):
+            vcf = gzip.open(self._vcfFile, "rt")
+        else:
+            vcf = open(self._vcfFile, "r")
+        with vcf:
+            for line in vcf:
+                if line.startswith("#") or len(line.strip()) == 0:
+                    continue
+                snp = line.rstrip("\n").split("\t")
+                if len(snp) < 5:
+                    wrongFileType = True
+                    continue
+                if(snp[3].upper() == "T" and snp[4].upper() == "C"):
+                    tcSNPs.setdefault(snp[0], []).append(int(snp[1]) - 1)
+                if(snp[3].upper() == "A" and snp[4].upper() == "G"):
+                    agSNPs.setdefault(snp[0], []).append(int(snp[1]) - 1)
+        if wrongFileType:
+            print("Wrong file type. Empty or not a vcf file.", file=sys.stderr)
+        return tcSNPs, agSNPs
+
+    def _compile(self, snps):
+        # Concatenates the sorted positions of all chromosomes
+        ranges = {}
+        positions = []
+        start = 0
+        for chromosome in sorted(snps.keys()):
+            chromosomeSNPs = np.unique(np.array(snps[chromosome], dtype=np.int64))
+            ranges[chromosome] = (start, start + len(chromosomeSNPs))
+            positions.append(chromosomeSNPs)
+            start += len(chromosomeSNPs)
+        if len(positions) > 0:
+            return np.concatenate(positions), ranges
+        return np.zeros(0, dtype=np.int64), ranges
+
+    def _writeIndex(self):
+        indexFile, tcFile, agFile = self._indexFiles()
+        # Written to temporary files first: other processes might read the index at the same time
+        suffix = ".tmp" + str(os.getpid())
+        for fileName, positions in [ (tcFile, self._tcSNPs), (agFile, self._agSNPs) ]:
+            with open(fileName + suffix, "wb") as f:
+                np.save(f, positions)
+            os.rename(fileName + suffix, fileName)
+        with open(indexFile + suffix, "w") as f:
+            print(self._fingerprint(), file=f)
+            for snpType, ranges in [ ("tc", self._tcRanges), ("ag", self._agRanges) ]:
+                for chromosome in sorted(ranges.keys()):
+                    print(snpType, chromosome, ranges[chromosome][0], ranges[chromosome][1], sep="\t", file=f)
+        os.rename(indexFile + suffix, indexFile)
+
+    def _loadIndex(self):
+        indexFile, tcFile, agFile = self._indexFiles()
+        if not (os.path.exists(indexFile) and os.path.exists(tcFile) and os.path.exists(agFile)):
+            return False
+        with open(indexFile, "r") as f:
+            lines = f.read().splitlines()
+        if len(lines) == 0 or lines[0] != self._fingerprint():
+            return False
+
+        ranges = { "tc" : {}, "ag" : {} }
+        for line in lines[1:]:
+            snpType, chromosome, start, end = line.split("\t")
+            ranges[snpType][chromosome] = (int(start), int(end))
+        self._tcRanges = ranges["tc"]
+        self._agRanges = ranges["ag"]
+        # Empty files can't be memory-mapped
+        if len(self._tcRanges) > 0:
+            self._tcSNPs = np.load(tcFile, mmap_mode="r")
+        if len(self._agRanges) > 0:
+            self._agSNPs = np.load(agFile, mmap_mode="r")
+        return True
         
     def read(self):        
         if (self._vcfFile != None):
             if(os.path.exists(self._vcfFile)):
-                vcfReader = BedTool(self._vcfFile)
-                
-                if(vcfReader.file_type != "vcf"):
-                    print("Wrong file type. Empty or not a vcf file.")
-         
-                for snp in vcfReader:
-                    self._addSNP(snp)
+                if not self._loadIndex():
+                    tcSNPs, agSNPs = self._parseVCF()
+                    self._tcSNPs, self._tcRanges = self._compile(tcSNPs)
+                    self._agSNPs, self._agRanges = self._compile(agSNPs)
+                    try:
+                        self._writeIndex()
+                    except (IOError, OSError):
+                        print("Warning: could not write SNP index for " + self._vcfFile + ".", file=sys.stderr)
             else:
-                print("Warning: SNP file " + self._vcfFile + " not found.")
+                print("Warning: SNP file " + self._vcfFile + " not found.", file=sys.stderr)
+
+    def _chromosomeSNPs(self, snps, ranges, chromosome):
+        if chromosome in ranges:
+            start, end = ranges[chromosome]
+            return snps[start:end]
+        return snps[0:0]
+
+    def _isSnp(self, snps, ranges, chromosome, positions):
+        chromosomeSNPs = self._chromosomeSNPs(snps, ranges, chromosome)
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(chromosomeSNPs) == 0:
+            return np.zeros(positions.shape, dtype=np.bool_)
+        index = np.minimum(np.searchsorted(chromosomeSNPs, positions), len(chromosomeSNPs) - 1)
+        return chromosomeSNPs[index] == positions
+
+    def isAGSnpArray(self, chromosome, positions):
+        # Vectorized isAGSnp for an array of 0-based positions
+        return self._isSnp(self._agSNPs, self._agRanges, chromosome, positions)
+
+    def isTCSnpArray(self, chromosome, positions):
+        # Vectorized isTCSnp for an array of 0-based positions
+        return self._isSnp(self._tcSNPs, self._tcRanges, chromosome, positions)
             
     def isAGSnp(self, chromosome, position):
-        key = chromosome + str(int(position) + 1)
-        return key in self._agSNPs
+        return bool(self.isAGSnpArray(chromosome, int(position)))
     
     
     def isTCSnp(self, chromosome, position):
-        key = chromosome + str(int(position) + 1)
-        return key in self._tcSNPs
+        return bool(self.isTCSnpArray(chromosome, int(position)))
+
+    def _countSnps(self, snps, ranges, chromosome, starts, stops):
+        # Number of SNPs in [start, stop) with two binary searches per interval
+        chromosomeSNPs = self._chromosomeSNPs(snps, ranges, chromosome)
+        counts = np.searchsorted(chromosomeSNPs, np.asarray(stops, dtype=np.int64)) - np.searchsorted(chromosomeSNPs, np.asarray(starts, dtype=np.int64))
+        return np.maximum(counts, 0)
+
+    def countAGSNPs(self, chromosome, start, stop):
+        return int(self._countSnps(self._agSNPs, self._agRanges, chromosome, start, stop))
+
+    def countTCSNPs(self, chromosome, start, stop):
+        return int(self._countSnps(self._tcSNPs, self._tcRanges, chromosome, start, stop))
+
+    def countSNPsInIntervals(self, chromosomes, starts, stops):
+        # Bulk version of countTCSNPs/countAGSNPs. Returns T>C and A>G SNP
+        # counts for all intervals in input order
+        chromosomes = np.asarray(chromosomes)
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        tcCounts = np.zeros(len(chromosomes), dtype=np.int64)
+        agCounts = np.zeros(len(chromosomes), dtype=np.int64)
+        for chromosome in np.unique(chromosomes):
+            index = np.flatnonzero(chromosomes == chromosome)
+            tcCounts[index] = self._countSnps(self._tcSNPs, self._tcRanges, chromosome, starts[index], stops[index])
+            agCounts[index] = self._countSnps(self._agSNPs, self._agRanges, chromosome, starts[index], stops[index])
+        return tcCounts, agCounts
+
+    def countSNPsInBed(self, bed):
+        # T>C and A>G SNP counts of all entries of a BED file (in file order)
+        utrs = list(BedIterator(bed))
+        return self.countSNPsInIntervals([ utr.chromosome for utr in utrs ], [ utr.start for utr in utrs ], [ utr.stop for utr in utrs ])
 
     def getAGSNPsInUTR(self, chromosome, start, stop, snpType):
-        count = 0
-        for i in range(start, stop):
-                if(self.isAGSnp(chromosome, i)):
-                    count += 1
-        return count
+        return self.countAGSNPs(chromosome, start, stop)
 
     def getTCSNPsInUTR(self, chromosome, start, stop, snpType):
-        count = 0
-        for i in range(start, stop):
-                if(self.isTCSnp(chromosome, i)):
-                    count += 1
-        return count
+        return self.countTCSNPs(chromosome, start, stop)
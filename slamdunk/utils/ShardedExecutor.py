@@ -0,0 +1,114 @@
+# Copyright (c) 2015 Tobias Neumann, Philipp Rescheneder.
+#
+# This file is part of Slamdunk.
+#
+# Slamdunk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Slamdunk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import pysam
+
+from joblib import Parallel, delayed
+
+from slamdunk.utils.misc import removeFile, openBam  # @UnresolvedImport
+
+# BGZF end-of-file marker (empty block) at the end of every BAM file
+BgzfEof = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+def splitConsecutive(items, loads, shardNumber):
+    # Splits items into at most shardNumber runs of consecutive items with
+    # similar total loads. Concatenating the shards keeps the order of items
+    totalLoad = sum(loads)
+
+    shards = [ [] ]
+    shardsLoad = 0
+    for item, load in zip(items, loads):
+        # Next shard when the current ones have their share of the load
+        if len(shards[-1]) > 0 and len(shards) < shardNumber and shardsLoad >= totalLoad * len(shards) / float(shardNumber):
+            shards.append([])
+        shards[-1].append(item)
+        shardsLoad += load
+    return shards
+
+def getChromosomeShards(bam, chromosomes, shardNumber):
+    # Shards of consecutive chromosomes with similar numbers of mapped reads (BAM index)
+    mappedReads = {}
+    bamFile = pysam.AlignmentFile(bam, "rb")
+    for stats in bamFile.get_index_statistics():
+        mappedReads[stats.contig] = stats.mapped
+    bamFile.close()
+
+    return splitConsecutive(chromosomes, [ max(1, mappedReads.get(chromosome, 0)) for chromosome in chromosomes ], shardNumber)
+
+def getRegionShards(regions, shardNumber):
+    # Shards of consecutive regions (chromosome, start, end) with similar total length
+    return splitConsecutive(regions, [ max(1, end - start) for _, start, end in regions ], shardNumber)
+
+def runShards(function, shards, threads, *args):
+    # Calls function(shard, *args) for all shards in threads processes.
+    # function has to open its own BAM and reference files. Returns the
+    # results in the order of shards
+    if len(shards) <= 1 or threads <= 1:
+        return [ function(shard, *args) for shard in shards ]
+    return Parallel(n_jobs=threads)(delayed(function)(shard, *args) for shard in shards)
+
+def runSharded(function, bam, chromosomes, threads, *args):
+    # runShards for shards of chromosomes. Returns the shards and their
+    # results, both in chromosome order
+    shards = getChromosomeShards(bam, chromosomes, max(1, threads))
+    return shards, runShards(function, shards, threads, *args)
+
+def getFragmentFile(outputFile, suffix = ""):
+    # Temporary file next to outputFile for the output of one shard
+    handle, fileName = tempfile.mkstemp(suffix=suffix, prefix=os.path.basename(outputFile) + "_shard", dir=os.path.dirname(os.path.abspath(outputFile)))
+    os.close(handle)
+    return fileName
+
+def appendFragments(outputFile, fragmentFiles):
+    # Appends text fragments to outputFile (in the given order) and removes them
+    with open(outputFile, "ab") as output:
+        for fragmentFile in fragmentFiles:
+            with open(fragmentFile, "rb") as fragment:
+                shutil.copyfileobj(fragment, output)
+    removeFile(fragmentFiles)
+
+def concatenateBamFragments(outputBAM, fragmentFiles):
+    # Concatenates BAM fragments with the same header without recompression
+    # (like samtools cat) and removes them. htslib writes the header to separate
+    # BGZF blocks, so the compressed records of each fragment are copied as is
+    with open(outputBAM, "wb") as output:
+        for i, fragmentFile in enumerate(fragmentFiles):
+            fragment = openBam(fragmentFile, "rb")
+            recordsOffset = fragment.tell()
+            fragment.close()
+            if(recordsOffset & 0xFFFF != 0):
+                raise RuntimeError("Header and reads share a BGZF block in " + fragmentFile)
+            
+            fragmentEnd = os.path.getsize(fragmentFile) - len(BgzfEof)
+            with open(fragmentFile, "rb") as fragment:
+                fragment.seek(fragmentEnd)
+                if(fragment.read() != BgzfEof):
+                    raise RuntimeError("Truncated BAM fragment " + fragmentFile)
+                
+                # Header of the first fragment only
+                fragmentStart = 0 if i == 0 else recordsOffset >> 16
+                fragment.seek(fragmentStart)
+                remaining = fragmentEnd - fragmentStart
+                while remaining > 0:
+                    block = fragment.read(min(remaining, 1024 * 1024))
+                    output.write(block)
+                    remaining -= len(block)
+        output.write(BgzfEof)
+    removeFile(fragmentFiles)
@@ -0,0 +1,127 @@
+# Copyright (c) 2015 Tobias Neumann, Philipp Rescheneder.
+#
+# This file is part of Slamdunk.
+#
+# Slamdunk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Slamdunk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import sys
+import traceback
+import multiprocessing
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+# Seconds between checks for task processes that died without reporting
+PollInterval = 1.0
+
+def _runTask(queue, index, function, args):
+    success = False
+    try:
+        function(*args)
+        success = True
+    except:
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        queue.put((index, success))
+
+class Task:
+
+    def __init__(self, index, name, function, args, threads, dependencies, priority):
+        self.index = index
+        self.name = name
+        self.function = function
+        self.args = args
+        self.threads = threads
+        self.dependencies = set(dependencies)
+        self.priority = priority
+
+class TaskScheduler:
+
+    # Runs a graph of tasks with at most threads cores in use. Each task
+    # runs in its own process and states how many cores it uses (e.g. the
+    # threads of a NextGenMap or samtools subprocess, 1 for Python code).
+    # A task is started as soon as all of its dependencies are finished and
+    # enough cores are free. Ready tasks with higher priority are started
+    # first, smaller tasks fill up the remaining cores
+
+    def __init__(self, threads):
+        self._threads = max(1, int(threads))
+        self._tasks = []
+
+    def addTask(self, name, function, args, threads = 1, dependencies = [], priority = 0):
+        # Returns the task id used for dependencies. Tasks that use more
+        # cores than available are limited to all available cores
+        task = Task(len(self._tasks), name, function, args, min(self._threads, max(1, int(threads))), dependencies, priority)
+        for dependency in task.dependencies:
+            if dependency < 0 or dependency >= task.index:
+                raise RuntimeError("Unknown dependency " + str(dependency) + " of task " + name)
+        self._tasks.append(task)
+        return task.index
+
+    def _readyTasks(self, finished, started):
+        ready = [ task for task in self._tasks if task.index not in started and task.dependencies <= finished ]
+        return sorted(ready, key = lambda task: (-task.priority, task.index))
+
+    def _waitForTask(self, queue, processes):
+        # Returns (index, success) of the next finished task. Processes that
+        # exited without reporting a result (killed by the OOM killer, crashed
+        # in native code, os._exit) count as failed tasks
+        while True:
+            try:
+                return queue.get(timeout=PollInterval)
+            except Empty:
+                exited = [ index for index, process in processes.items() if process.exitcode != None ]
+                if len(exited) == 0:
+                    continue
+                # Results of processes that reported just before exiting are
+                # already in the queue
+                try:
+                    return queue.get(timeout=PollInterval)
+                except Empty:
+                    index = exited[0]
+                    print("Task " + self._tasks[index].name + " exited with code " + str(processes[index].exitcode) + " without result", file=sys.stderr)
+                    return index, False
+
+    def run(self):
+        queue = multiprocessing.Queue()
+        processes = {}
+        started = set()
+        finished = set()
+        failed = []
+        freeThreads = self._threads
+
+        while len(finished) + len(failed) < len(started) or (len(failed) == 0 and len(started) < len(self._tasks)):
+            if len(failed) == 0:
+                for task in self._readyTasks(finished, started):
+                    if task.threads <= freeThreads:
+                        process = multiprocessing.Process(target=_runTask, args=(queue, task.index, task.function, task.args))
+                        process.start()
+                        processes[task.index] = process
+                        started.add(task.index)
+                        freeThreads -= task.threads
+
+            index, success = self._waitForTask(queue, processes)
+            processes.pop(index).join()
+            freeThreads += self._tasks[index].threads
+            if success:
+                finished.add(index)
+            else:
+                failed.append(self._tasks[index].name)
+
+        # Running tasks are finished before reporting errors
+        if len(failed) > 0:
+            raise RuntimeError("Error while running task(s): " + ", ".join(failed))
@@ -27,6 +27,8 @@ import csv
 import ast
 import hashlib
 
+from slamdunk.utils.RunManifest import getRunManifest, StatusStarted  # @UnresolvedImport
+
 ReadStat = collections.namedtuple('ReadStat' , 'SequencedReads MappedReads DedupReads FilteredReads SNPs AnnotationName AnnotationMD5')
 SampleInfo = collections.namedtuple('SampleInfo' , 'ID Name Type Time')
 
@@ -144,25 +146,51 @@ def removeFile(files):
             os.remove(files)
 
 
-def checkStep(inFiles, outFiles, force=False):    
+def checkStep(inFiles, outFiles, force=False, parameters=[]):
+    # Returns True if the step reading inFiles and writing outFiles has to
+    # run. Outputs are reused only if the run manifest of the output directory
+    # has a finished record of the step with the same input file contents,
+    # parameters and slamdunk version and the outputs weren't changed since.
+    # Call finishStep(outFiles) when the step is done
     if not files_exist(inFiles):
         raise RuntimeError("One or more input files don't exist: " + str(inFiles))
-    inFileDate = os.path.getmtime(inFiles[0])
-    for x in inFiles[1:]:
-        inFileDate = max(inFileDate, os.path.getmtime(x))    
+    if len(outFiles) == 0:
+        return True
     
-    if len(outFiles) > 0 and files_exist(outFiles):
-        outFileDate = os.path.getmtime(outFiles[0])
-        for x in outFiles[1:]:
-            outFileDate = min(outFileDate, os.path.getmtime(x))        
-        if outFileDate > inFileDate:
-            if(force == True):
-                return True
-            else:
-                return False
+    manifest = getRunManifest(outFiles)
+    if not force and files_exist(outFiles) and manifest.isValid(inFiles, outFiles, parameters):
+        return False
     
+    try:
+        manifest.start(inFiles, outFiles, parameters)
+    except (IOError, OSError):
+        print("Warning: could not write run manifest for " + str(outFiles) + ".", file=sys.stderr)
     return True
 
+def getInputFiles(bam, referenceFile, snpsFile):
+    # Input files of steps with an optional SNP file
+    inFiles = [bam, referenceFile]
+    if(snpsFile != None and os.path.exists(snpsFile)):
+        inFiles.append(snpsFile)
+    return inFiles
+
+def finishStep(outFiles):
+    # Records that the step started by checkStep wrote outFiles successfully
+    manifest = getRunManifest(outFiles)
+    record = manifest.getRecord(outFiles)
+    if record == None or record["status"] != StatusStarted or not files_exist(outFiles):
+        return
+    try:
+        manifest.finish(outFiles, record)
+    except (IOError, OSError):
+        print("Warning: could not write run manifest for " + str(outFiles) + ".", file=sys.stderr)
+
+def isStepFinished(outFiles):
+    # True if the run manifest has a finished record of the step writing
+    # outFiles. For calls that complete a step started by an earlier call
+    record = getRunManifest(outFiles).getRecord(outFiles)
+    return record != None and record["status"] != StatusStarted and files_exist(outFiles)
+
 def getBinary(name):
     
     projectPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -214,6 +242,19 @@ def callR(cmd, log=sys.stderr, verbose=False, dry=False):
 def pysamIndex(outputBam):
     pysam.index(outputBam)  # @UndefinedVariable
 
+def getIOThreads(threads, jobs = 1):
+    # BGZF (de)compression threads of each of jobs parallel jobs sharing threads
+    return max(1, int(threads) // max(1, int(jobs)))
+
+def openBam(fileName, mode = "rb", threads = 1, compressionLevel = None, **kwargs):
+    # pysam.AlignmentFile with threads for BGZF (de)compression. compressionLevel
+    # (0 - 9) is only used for BAM output (default: htslib default level)
+    if(threads > 1):
+        kwargs["threads"] = threads
+    if(compressionLevel != None and mode.startswith("w")):
+        kwargs["format_options"] = [ "level=" + str(compressionLevel) ]
+    return pysam.AlignmentFile(fileName, mode, **kwargs)
+
 def countReads(bam):
     bamFile = pysam.AlignmentFile(bam)
     mapped = 0